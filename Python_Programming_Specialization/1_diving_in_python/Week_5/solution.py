@@ -6,28 +6,72 @@ synch text tcp client
 
 import time
 import socket
+import struct
 
 
+MIN_TIMESTAMP = -2 ** 63
+MAX_TIMESTAMP = 2 ** 63 - 1
+
+# binary protocol of the Week_6 servers: frame header (kind, length),
+# key id, point record (key id, timestamp, value)
+FRAME_HEADER = struct.Struct('<cI')
+KEY_ID = struct.Struct('<I')
+RECORD = struct.Struct('<Iqd')
+BATCH_SIZE = 65536
+
 
 class Client:
-    def __init__(self, host, port, timeout=None):
+    def __init__(self, host, port, timeout=None, binary=False):
         self._port = port
         self._host = host
         self._timeout = timeout
+        self._binary = False
+        self._key_ids = {}
         
         try:
             self._sock = socket.create_connection((self._host, self._port), self._timeout)
         except socket.error as err:
             raise ClientError(err)
 
+        if binary:
+            self._sock.sendall(b'binary\n')
+            if self._recv() != b'ok\n\n':
+                raise ClientError('binary protocol is not supported')
+            self._binary = True
+
+
+    def _recv(self, responses=1):
+        data = b''
+        while not data.endswith(b'\n\n') or data.count(b'\n\n') < responses:
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise ClientError('connection closed')
+            data += chunk
+        return data
+
+
+    def _frame(self, kind, payload):
+        return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+    def _command(self, command):
+        if self._binary:
+            return self._frame(b'T', command.encode('utf8'))
+        return f'{command}\n'.encode('utf8')
+
  
-    def get(self, key):
-        send_data = f'get {key}\n'.encode('utf8')
+    def get(self, key, start=None, end=None):
+        if start is None and end is None:
+            send_data = self._command(f'get {key}')
+        else:
+            start = MIN_TIMESTAMP if start is None else start
+            end = MAX_TIMESTAMP if end is None else end
+            send_data = self._command(f'get {key} {start} {end}')
         metric_dict = {}
 
         try:
             self._sock.sendall(send_data)
-            response = self._sock.recv(1024)
+            response = self._recv()
             if b'ok' not in response:
                 raise ClientError
 
@@ -39,12 +83,34 @@ class Client:
                     metric_key = metrics[0]
                     metric_value = float(metrics[1])
                     metric_timestamp = int(metrics[2])
-                    metric_list = metric_dict.get(metric_key, [])
-                    metric_list.append((metric_timestamp, metric_value))
-                    metric_dict.update({metric_key: sorted(metric_list)})
+                    metric_dict.setdefault(metric_key, []).append((metric_timestamp, metric_value))
                 elif metrics not in [["b'ok"], [""], ["'"]]:
                     raise ClientError
 
+            for metric_list in metric_dict.values():
+                metric_list.sort()
+            return metric_dict
+
+        except Exception as err:
+            raise ClientError(err)
+
+
+    def latest(self, key):
+        """
+        the newest point of every metric matching key, {metric: (timestamp, value)}
+        """
+        try:
+            self._sock.sendall(self._command(f'latest {key}'))
+            response = self._recv().decode('utf8')
+            status, payload = response.split('\n', 1)
+            if status != 'ok':
+                raise ClientError
+
+            metric_dict = {}
+            for line in payload.split('\n'):
+                if line:
+                    metric_key, metric_value, metric_timestamp = line.split(' ')
+                    metric_dict[metric_key] = (int(metric_timestamp), float(metric_value))
             return metric_dict
 
         except Exception as err:
@@ -52,18 +118,100 @@ class Client:
 
 
     def put(self, metric_key, metric_value, timestamp=None):
+        if self._binary:
+            return self.put_many([(metric_key, metric_value, timestamp)])
+
         timestamp = str(timestamp or int(time.time()))
         send_data = f'put {metric_key} {metric_value} {timestamp}\n'.encode('utf8')
 
         try:
             self._sock.sendall(send_data)
-            response = self._sock.recv(1024)
+            response = self._recv()
             if b'ok\n' not in response:
                 raise ClientError
         except Exception:
             raise ClientError
 
 
+    def watch(self, *patterns):
+        """
+        iterator of the (key, value, timestamp) points put to the server from now on
+        under keys, '*' or globs like cpu.host42.*; the server pushes them while the
+        connection is open, so it takes no other commands and waits without timeout
+        """
+        if not patterns or self._binary:
+            raise ClientError('watch needs patterns and the text protocol')
+
+        try:
+            self._sock.sendall(f"watch {' '.join(patterns)}\n".encode('utf8'))
+            self._sock.settimeout(None)
+            response, rest = self._message(b'')
+        except socket.error as err:
+            raise ClientError(err)
+        if response != b'ok\n\n':
+            raise ClientError
+        return self._watched(rest)
+
+
+    def _message(self, data):
+        while b'\n\n' not in data:
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise ClientError('connection closed')
+            data += chunk
+        end = data.index(b'\n\n') + 2
+        return data[:end], data[end:]
+
+
+    def _watched(self, data):
+        while True:
+            try:
+                response, data = self._message(data)
+            except socket.error as err:
+                raise ClientError(err)
+            if not response.startswith(b'ok\n'):
+                raise ClientError
+
+            for line in response.decode('utf8').split('\n')[1:]:
+                metrics = line.split(' ')
+                if len(metrics) == 3:
+                    yield metrics[0], float(metrics[1]), int(metrics[2])
+
+
+    def put_many(self, points, atomic=False):
+        points = list(points)
+        if not points:
+            return
+        now = int(time.time())
+
+        if self._binary:
+            send_data, responses = bytearray(), 0
+            for offset in range(0, len(points), BATCH_SIZE):
+                records = bytearray()
+                for metric_key, metric_value, timestamp in points[offset:offset + BATCH_SIZE]:
+                    key_id = self._key_ids.get(metric_key)
+                    if key_id is None:
+                        key_id = self._key_ids[metric_key] = len(self._key_ids)
+                        send_data += self._frame(b'K', KEY_ID.pack(key_id) + metric_key.encode('utf8'))
+                    records += RECORD.pack(key_id, timestamp or now, float(metric_value))
+                send_data += self._frame(b'P', records)
+                responses += 1
+        else:
+            send_data = ''.join(['mput atomic' if atomic else 'mput']
+                                + [f' {metric_key} {metric_value} {timestamp or now}'
+                                   for metric_key, metric_value, timestamp in points]
+                                + ['\n']).encode('utf8')
+            responses = 1
+
+        try:
+            self._sock.sendall(send_data)
+            response = self._recv(responses)
+        except Exception as err:
+            raise ClientError(err)
+        if response != b'ok\n\n' * responses:
+            raise ClientError
+
+
 
 
 
@@ -1,7 +1,20 @@
 import bisect
 import socket
+import struct
 import time
 
+# границы меток времени на сервере (int64) для открытых интервалов get
+MIN_TIMESTAMP = -2 ** 63
+MAX_TIMESTAMP = 2 ** 63 - 1
+
+# двоичный протокол сервера (Week_6/binary.py): заголовок кадра (тип, длина),
+# номер ключа, запись точки (номер ключа, метка, значение)
+FRAME_HEADER = struct.Struct('<cI')
+KEY_ID = struct.Struct('<I')
+RECORD = struct.Struct('<Iqd')
+# число точек в одном кадре put_many
+BATCH_SIZE = 65536
+
 
 class ClientError(Exception):
     """класс исключений клиента"""
@@ -9,28 +22,52 @@ class ClientError(Exception):
 
 
 class Client:
-    def __init__(self, host, port, timeout=None):
+    """binary=True - put идут пачками двоичного протокола вместо строк"""
+
+    def __init__(self, host, port, timeout=None, binary=False):
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.binary = False
+        # номера ключей, объявленных серверу в двоичном протоколе
+        self._key_ids = {}
 
         try:
             self.connection = socket.create_connection((host, port), timeout)
         except socket.error as err:
             raise ClientError("Cannot create connection", err)
 
-    def _read(self):
+        if binary:
+            self._send(b"binary\n")
+            if self._read() != 'ok\n\n':
+                raise ClientError('Server does not support the binary protocol')
+            self.binary = True
+
+    def _read(self, responses=1):
+        """responses ответов сервера, каждый заканчивается пустой строкой"""
 
         data = b""
 
-        while not data.endswith(b"\n\n"):
+        while not data.endswith(b"\n\n") or data.count(b"\n\n") < responses:
             try:
-                data += self.connection.recv(1024)
+                chunk = self.connection.recv(65536)
             except socket.error as err:
                 raise ClientError("Error reading data from socket", err)
+            if not chunk:
+                raise ClientError("Connection closed by server")
+            data += chunk
 
         return data.decode('utf-8')
 
+    def _frame(self, kind, payload):
+        return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+    def _request(self, command):
+        if self.binary:
+            self._send(self._frame(b'T', command.encode()))
+        else:
+            self._send(f"{command}\n".encode())
+
     def _send(self, data):
 
         try:
@@ -41,16 +78,59 @@ class Client:
     def put(self, key, value, timestamp=None):
 
         timestamp = timestamp or int(time.time())
-        self._send(f"put {key} {value} {timestamp}\n".encode())
+        if self.binary:
+            return self.put_many([(key, value, timestamp)])
+
+        self._request(f"put {key} {value} {timestamp}")
         raw_data = self._read()
 
         if raw_data == 'ok\n\n':
             return
         raise ClientError('Server returns an error')
 
-    def get(self, key):
+    def put_many(self, points, atomic=False):
+        """пачка точек (key, value, timestamp) с одним подтверждением.
 
-        self._send(f"get {key}\n".encode())
+        atomic=True - при неверной точке сервер не записывает ни одной;
+        в двоичном протоколе каждый кадр из BATCH_SIZE точек всегда атомарный.
+        """
+
+        points = list(points)
+        if not points:
+            return
+        now = int(time.time())
+
+        if self.binary:
+            data, responses = bytearray(), 0
+            for offset in range(0, len(points), BATCH_SIZE):
+                records = bytearray()
+                for key, value, timestamp in points[offset:offset + BATCH_SIZE]:
+                    key_id = self._key_ids.get(key)
+                    if key_id is None:
+                        key_id = self._key_ids[key] = len(self._key_ids)
+                        data += self._frame(b'K', KEY_ID.pack(key_id) + key.encode())
+                    records += RECORD.pack(key_id, timestamp or now, float(value))
+                data += self._frame(b'P', records)
+                responses += 1
+        else:
+            data = ''.join([f"mput{' atomic' if atomic else ''}"]
+                           + [f" {key} {value} {timestamp or now}"
+                              for key, value, timestamp in points] + ["\n"]).encode()
+            responses = 1
+
+        self._send(data)
+        if self._read(responses) != 'ok\n\n' * responses:
+            raise ClientError('Server returns an error')
+
+    def get(self, key, start=None, end=None):
+        """метрики ключа, при заданных start/end - только с метками из [start, end]"""
+
+        if start is None and end is None:
+            self._request(f"get {key}")
+        else:
+            start = MIN_TIMESTAMP if start is None else start
+            end = MAX_TIMESTAMP if end is None else end
+            self._request(f"get {key} {start} {end}")
         raw_data = self._read()
         data = {}
         status, payload = raw_data.split("\n", 1)
@@ -75,6 +155,96 @@ class Client:
 
         return data
 
+    def latest(self, key):
+        """самая новая точка каждого ключа по имени или шаблону: {key: (timestamp, value)}"""
+
+        self._request(f"latest {key}")
+        status, payload = self._read().split("\n", 1)
+
+        if status != 'ok':
+            raise ClientError('Server returns an error')
+
+        data = {}
+        try:
+            for row in payload.strip().splitlines():
+                key, value, timestamp = row.split()
+                data[key] = (int(timestamp), float(value))
+        except Exception as err:
+            raise ClientError('Server returns invalid data', err)
+
+        return data
+
+    def summary(self, key):
+        """сводка каждого ключа по имени или шаблону:
+        {key: {'count', 'sum', 'sum_squares', 'min', 'max', 'first', 'last'}}"""
+
+        self._request(f"summary {key}")
+        status, payload = self._read().split("\n", 1)
+
+        if status != 'ok':
+            raise ClientError('Server returns an error')
+
+        data = {}
+        try:
+            for row in payload.strip().splitlines():
+                name, value, _ = row.split()
+                key, field = name.rsplit('.', 1)
+                data.setdefault(key, {})[field] = \
+                    int(value) if field in ('count', 'first', 'last') else float(value)
+        except Exception as err:
+            raise ClientError('Server returns invalid data', err)
+
+        return data
+
+    def watch(self, *patterns):
+        """итератор точек (key, value, timestamp), записанных на сервер после вызова.
+
+        patterns - ключи, '*' или шаблоны вроде cpu.host42.*. Сервер присылает
+        точки сам, пока соединение открыто, поэтому других команд по нему
+        больше не выполнить, а ожидание точек не ограничено timeout.
+        Подписка работает только в текстовом протоколе.
+        """
+
+        if not patterns or self.binary:
+            raise ClientError('watch needs patterns and the text protocol')
+        self._send(f"watch {' '.join(patterns)}\n".encode())
+        self.connection.settimeout(None)
+
+        status, buffer = self._message(b"")
+        if status != b'ok\n\n':
+            raise ClientError('Server returns an error')
+        return self._watched(buffer)
+
+    def _message(self, buffer):
+        """первое сообщение сервера (до пустой строки включительно) и остаток данных"""
+
+        while b"\n\n" not in buffer:
+            try:
+                chunk = self.connection.recv(65536)
+            except socket.error as err:
+                raise ClientError("Error reading data from socket", err)
+            if not chunk:
+                raise ClientError("Connection closed by server")
+            buffer += chunk
+
+        end = buffer.index(b"\n\n") + 2
+        return buffer[:end], buffer[end:]
+
+    def _watched(self, buffer):
+        while True:
+            message, buffer = self._message(buffer)
+            status, payload = message.decode('utf-8').split("\n", 1)
+            if status != 'ok':
+                raise ClientError('Server returns an error')
+
+            try:
+                for row in payload.splitlines():
+                    if row:
+                        key, value, timestamp = row.split()
+                        yield key, float(value), int(timestamp)
+            except ValueError as err:
+                raise ClientError('Server returns invalid data', err)
+
     def close(self):
 
         try:
@@ -0,0 +1,795 @@
+"""
+benchmarks for the metrics servers
+
+python benchmark.py put [--points N] [--step N]
+python benchmark.py storage [--points N] [--keys N]
+python benchmark.py agg [--points N] [--step N]
+python benchmark.py wal [--points N] [--dir PATH]
+python benchmark.py snapshot [--points N] [--keys N] [--dir PATH]
+python benchmark.py compress [--points N]
+python benchmark.py keys [--keys N]
+python benchmark.py ingest [--points N] [--batch N]
+python benchmark.py mput [--points N] [--batch N]
+python benchmark.py cache [--points N] [--reads N]
+python benchmark.py shards [--server NAME] [--workers N] [--points N] [--clients N]
+python benchmark.py stats [--points N] [--rounds N]
+python benchmark.py replication [--points N] [--rounds N] [--followers N]
+python benchmark.py reorder [--points N] [--jitter N]
+python benchmark.py sqlite [--points N] [--keys N] [--reads N] [--dir PATH]
+"""
+
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from fnmatch import fnmatchcase
+
+import binary
+import gorilla
+import server
+import server_coursera
+import shard
+from cache import ResponseCache
+from keyindex import KeyIndex
+from replication import Leader
+from snapshot import Snapshotter
+from wal import WriteAheadLog
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Week_5'))
+import solution_coursera
+
+
+def bench_put(points, step, updates=10000):
+    """put throughput of server.put_handler while a single series grows"""
+    server.DATABASE.clear()
+    print(f'{"points":>12} {"append/s":>12} {"update/s":>12}')
+
+    for start in range(0, points, step):
+        requests = [f'put bench.metric {ts}.5 {ts}\n' for ts in range(start, start + step)]
+        began = time.perf_counter()
+        for request in requests:
+            server.put_handler(request)
+        appended = step / (time.perf_counter() - began)
+
+        # rewrite already stored timestamps: the bisect path of the upsert
+        requests = [f'put bench.metric 1.0 {random.randrange(start + step)}\n'
+                    for _ in range(updates)]
+        began = time.perf_counter()
+        for request in requests:
+            server.put_handler(request)
+        updated = updates / (time.perf_counter() - began)
+
+        print(f'{start + step:>12} {appended:>12.0f} {updated:>12.0f}')
+
+
+def bench_storage(points, keys):
+    """bytes per point of server_coursera.Storage against the old dict of dicts"""
+    per_key = points // keys
+
+    def fill(put):
+        tracemalloc.start()
+        for k in range(keys):
+            key = f'bench.metric.{k}'
+            for ts in range(per_key):
+                put(key, ts * 0.5, 1_500_000_000 + ts * 10)
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return used / (per_key * keys)
+
+    storage = server_coursera.Storage()
+    columnar = fill(storage.put)
+    del storage
+
+    data = {}
+    baseline = fill(lambda key, value, ts: data.setdefault(key, {}).__setitem__(ts, value))
+    del data
+
+    print(f'dict of dicts: {baseline:6.1f} bytes/point')
+    print(f'Storage:       {columnar:6.1f} bytes/point')
+
+
+def bench_agg(points, step):
+    """agg over rollups against a raw get aggregated on the client"""
+    storage = server_coursera.Storage()
+    for ts in range(points):
+        storage.put('bench.metric', ts % 100 * 0.5, ts)
+
+    def response(chunks):
+        return ''.join(f'{key} {value} {timestamp}\n'
+                       for key, timestamps, values in chunks
+                       for timestamp, value in zip(timestamps, values)).encode()
+
+    began = time.perf_counter()
+    raw = response(storage.get('bench.metric', 0, points))
+    buckets = {}
+    for line in raw.splitlines():
+        _, value, timestamp = line.split()
+        buckets.setdefault(int(timestamp) // step, []).append(float(value))
+    averages = {bucket: sum(values) / len(values) for bucket, values in buckets.items()}
+    raw_time = time.perf_counter() - began
+
+    began = time.perf_counter()
+    rolled = response(storage.aggregate('bench.metric', 0, points, step, 'avg'))
+    agg_time = time.perf_counter() - began
+
+    assert len(averages) == len(rolled.splitlines())
+    print(f'get + client avg: {len(raw):>12} bytes {raw_time * 1000:>10.1f} ms')
+    print(f'agg avg:          {len(rolled):>12} bytes {agg_time * 1000:>10.1f} ms')
+
+
+def bench_wal(points, directory):
+    """put throughput of StorageDriver for every durability setting of the journal"""
+    settings = [
+        ('memory only', None),
+        ('fsync every put', dict(flush_interval=0)),
+        ('group commit 1 ms', dict(flush_interval=0.001)),
+        ('group commit 10 ms', dict(flush_interval=0.01)),
+        ('group commit 100 ms', dict(flush_interval=0.1, batch_size=10_000)),
+        ('no fsync', dict(fsync=False)),
+    ]
+
+    async def run(wal):
+        driver = server_coursera.StorageDriver(server_coursera.Storage(), wal)
+        requests = [f'put bench.metric {ts}.5 {ts}' for ts in range(points)]
+        if wal is not None:
+            wal.open()
+
+        began = time.perf_counter()
+        for number, request in enumerate(requests):
+            driver(request)
+            # as in the server, puts arrive over many event loop iterations
+            if number % 100 == 0:
+                await asyncio.sleep(0)
+        if wal is not None:
+            await wal.close()
+        return points / (time.perf_counter() - began)
+
+    for name, options in settings:
+        path = os.path.join(directory, 'bench.wal')
+        wal = None if options is None else WriteAheadLog(path, **options)
+        try:
+            rate = asyncio.run(run(wal))
+        finally:
+            if wal is not None:
+                wal.remove_before(wal.segment + 1)
+        print(f'{name:<20} {rate:>12.0f} puts/s')
+
+
+def bench_snapshot(points, keys, directory):
+    """cold start from a snapshot against replaying the same points from the journal"""
+    per_key = points // keys
+    storage = server_coursera.Storage()
+    wal = WriteAheadLog(os.path.join(directory, 'bench.wal'))
+    snapshots = Snapshotter(os.path.join(directory, 'bench.snap'))
+
+    with open(f'{wal.path}.000001', 'w') as file:
+        for k in range(keys):
+            key = f'bench.metric.{k}'
+            for ts in range(1_500_000_000, 1_500_000_000 + per_key * 10, 10):
+                value = ts % 1000 * 0.25
+                storage.put(key, value, ts)
+                file.write(f'{key} {value} {ts}\n')
+
+    async def take():
+        snapshots.start(storage)
+        await snapshots.take()
+        await snapshots.stop()
+
+    try:
+        began = time.perf_counter()
+        asyncio.run(take())
+        print(f'snapshot write:  {time.perf_counter() - began:8.2f} s '
+              f'{os.path.getsize(snapshots.path) / (per_key * keys):6.1f} bytes/point')
+        del storage
+
+        began = time.perf_counter()
+        snapshots.load(server_coursera.Storage())
+        print(f'snapshot load:   {time.perf_counter() - began:8.2f} s')
+
+        began = time.perf_counter()
+        replayed = server_coursera.Storage()
+        for key, value, ts in wal.replay():
+            replayed.put(key, value, ts)
+        print(f'journal replay:  {time.perf_counter() - began:8.2f} s')
+    finally:
+        wal.remove_before(2)
+        os.remove(snapshots.path)
+
+
+def realistic_series(points, kind):
+    """10 s scrape interval with occasional jitter and a value typical for kind"""
+    timestamps = array('q')
+    values = array('d')
+    timestamp, value = 1_500_000_000, 50.0
+    for _ in range(points):
+        timestamp += 10 if random.random() < 0.95 else random.randint(9, 11)
+        if kind == 'counter':
+            value += random.randrange(0, 100)
+        elif kind == 'gauge':
+            value = round(value + random.choice((-0.5, 0.0, 0.0, 0.5)), 1)
+        elif kind == 'constant':
+            value = 1.0
+        else:
+            value = random.uniform(0, 100)
+        timestamps.append(timestamp)
+        values.append(value)
+    return timestamps, values
+
+
+def bench_compress(points):
+    """bytes per point and encode/decode throughput of gorilla blocks"""
+    size = server_coursera.Series.block_size
+    print(f'{"series":>10} {"bytes/point":>12} {"encode pts/s":>14} {"decode pts/s":>14}')
+
+    for kind in ('constant', 'counter', 'gauge', 'random'):
+        timestamps, values = realistic_series(points, kind)
+        ranges = [(start, min(start + size, points)) for start in range(0, points, size)]
+
+        began = time.perf_counter()
+        blocks = [gorilla.Block.encode(timestamps[start:end], values[start:end])
+                  for start, end in ranges]
+        encoded = points / (time.perf_counter() - began)
+
+        began = time.perf_counter()
+        for block in blocks:
+            block.decode()
+        decoded = points / (time.perf_counter() - began)
+
+        nbytes = sum(len(block.data) for block in blocks) / points
+        print(f'{kind:>10} {nbytes:>12.2f} {encoded:>14.0f} {decoded:>14.0f}')
+    print(f'{"raw arrays":>10} {16:>12.2f}')
+
+
+def bench_keys(keys, repeat=1000):
+    """get by exact key and by pattern through the key index against a scan of all keys"""
+    server.DATABASE.clear()
+    server.INDEX = KeyIndex()
+    for k in range(keys):
+        server.put_handler(f'put cpu.host{k}.load 0.5 1\n')
+
+    def rate(function):
+        began = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        return repeat / (time.perf_counter() - began)
+
+    queries = [('exact key', 'cpu.host42.load'), ('pattern, 10 keys', 'cpu.host4200?.load')]
+    print(f'{"query":<18} {"index get/s":>14} {"full scan/s":>14}')
+    for name, pattern in queries:
+        indexed = rate(lambda: server.get_handler(f'get {pattern}\n'))
+        scanned = rate(lambda: [key for key in server.DATABASE if fnmatchcase(key, pattern)])
+        print(f'{name:<18} {indexed:>14.0f} {scanned:>14.0f}')
+
+
+class NullTransport:
+    def write(self, data):
+        pass
+
+    def writelines(self, chunks):
+        pass
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+def drain(loop, protocol):
+    """run the loop until the protocol has written every answer it has queued"""
+    queue = protocol.answers if isinstance(protocol, server.ClientServerProtocol) \
+        else protocol._responses
+    while queue:
+        loop.run_until_complete(asyncio.sleep(0))
+
+
+def bench_ingest(points, batch, keys=100):
+    """server CPU per point of pipelined text puts against binary frames"""
+    names = [f'bench.metric.{k}' for k in range(keys)]
+    batches = [range(start, min(start + batch, points)) for start in range(0, points, batch)]
+
+    text = [b'']
+    text += [''.join(f'put {names[i % keys]} {i * 0.5} {1_500_000_000 + i}\n' for i in numbers).encode()
+             for numbers in batches]
+
+    declarations = b''.join(
+        binary.FRAME_HEADER.pack(binary.KEY, binary.KEY_ID.size + len(name))
+        + binary.KEY_ID.pack(key_id) + name.encode()
+        for key_id, name in enumerate(names))
+    frames = [binary.NEGOTIATE + b'\n' + declarations]
+    for numbers in batches:
+        records = b''.join(binary.RECORD.pack(i % keys, 1_500_000_000 + i, i * 0.5)
+                           for i in numbers)
+        frames.append(binary.FRAME_HEADER.pack(binary.POINTS, len(records)) + records)
+
+    def reset_coursera():
+        server_coursera.MetricsStorageServerProtocol.storage = server_coursera.Storage()
+        return server_coursera.MetricsStorageServerProtocol()
+
+    def reset_server():
+        server.DATABASE.clear()
+        server.INDEX = KeyIndex()
+        return server.ClientServerProtocol()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    print(f'{"server":<16} {"text puts/s":>12} {"binary puts/s":>14} {"speed-up":>9}')
+    for name, reset in (('server_coursera', reset_coursera), ('server', reset_server)):
+        rates = []
+        for packets in (text, frames):
+            protocol = reset()
+            protocol.connection_made(NullTransport())
+            began = time.perf_counter()
+            for packet in packets:
+                protocol.data_received(packet)
+                drain(loop, protocol)
+            rates.append(points / (time.perf_counter() - began))
+        print(f'{name:<16} {rates[0]:>12.0f} {rates[1]:>14.0f} {rates[1] / rates[0]:>8.1f}x')
+    loop.close()
+
+
+def bench_mput(points, batch, port=8899):
+    """client throughput over TCP: a round trip per put against one mput per batch"""
+    def serve():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        server_coursera.run_server('127.0.0.1', port)
+
+    threading.Thread(target=serve, daemon=True).start()
+    time.sleep(0.5)
+    client = solution_coursera.Client('127.0.0.1', port, 30)
+
+    def series(key):
+        return [(key, i * 0.5, 1_500_000_000 + i) for i in range(points)]
+
+    began = time.perf_counter()
+    for key, value, timestamp in series('bench.put'):
+        client.put(key, value, timestamp)
+    single = points / (time.perf_counter() - began)
+
+    rates = []
+    for atomic in (False, True):
+        data = series(f'bench.mput.{atomic}')
+        began = time.perf_counter()
+        for start in range(0, points, batch):
+            client.put_many(data[start:start + batch], atomic=atomic)
+        rates.append(points / (time.perf_counter() - began))
+    client.close()
+
+    print(f'put per point:      {single:>10.0f} points/s')
+    print(f'mput of {batch:<6}      {rates[0]:>10.0f} points/s')
+    print(f'mput atomic:        {rates[1]:>10.0f} points/s')
+
+
+def bench_stats(points, rounds, batch=1000, keys=100):
+    """
+    server CPU per put with the stats counters on against off: a round of each
+    setting back to back on one connection, the median pair hides the noise
+    """
+    names = [f'bench.metric.{k}' for k in range(keys)]
+
+    def reset_coursera():
+        server_coursera.MetricsStorageServerProtocol.storage = server_coursera.Storage()
+        return server_coursera.MetricsStorageServerProtocol(), server_coursera.MetricsStorageServerProtocol.stats
+
+    def reset_server():
+        server.DATABASE.clear()
+        server.INDEX = KeyIndex()
+        return server.ClientServerProtocol(), server.STATS
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    print(f'{"server":<16} {"off, us/put":>12} {"on, us/put":>11} {"overhead":>9}')
+    for name, reset in (('server_coursera', reset_coursera), ('server', reset_server)):
+        protocol, stats = reset()
+        protocol.connection_made(NullTransport())
+        first = 1_500_000_000
+        spent = {False: [], True: []}
+        for number in range(rounds):
+            for enabled in ((False, True) if number % 2 else (True, False)):
+                # every round appends newer points, as live metrics do
+                packets = [''.join(f'put {names[i % keys]} {i * 0.5} {first + i}\n'
+                                   for i in range(start, min(start + batch, points))).encode()
+                           for start in range(0, points, batch)]
+                first += points
+                stats.enabled = enabled
+                began = time.process_time()
+                for packet in packets:
+                    protocol.data_received(packet)
+                    drain(loop, protocol)
+                spent[enabled].append(time.process_time() - began)
+        stats.enabled = True
+
+        overhead = statistics.median(on / off - 1 for off, on in zip(spent[False], spent[True]))
+        off, on = (statistics.median(spent[enabled]) / points * 1e6 for enabled in (False, True))
+        print(f'{name:<16} {off:>12.2f} {on:>11.2f} {overhead * 100:>8.2f}%')
+    loop.close()
+
+
+def bench_replication(points, rounds, followers, batch=1000, keys=100):
+    """
+    server CPU per put without followers against with followers attached, paired
+    rounds as in bench_stats; followers are connections that read nothing
+    """
+    names = [f'bench.metric.{k}' for k in range(keys)]
+    protocol_class = server_coursera.MetricsStorageServerProtocol
+    protocol_class.storage = server_coursera.Storage()
+    protocol_class.leader = leader = Leader(protocol_class.storage)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    protocol = protocol_class()
+    protocol.connection_made(NullTransport())
+    for _ in range(followers):
+        follower = protocol_class()
+        follower.connection_made(NullTransport())
+        follower.data_received(b'replicate\n')
+        drain(loop, follower)
+    attached = leader.followers
+
+    first = 1_500_000_000
+    spent = {False: [], True: []}
+    for number in range(rounds):
+        for replicated in ((False, True) if number % 2 else (True, False)):
+            packets = [''.join(f'put {names[i % keys]} {i * 0.5} {first + i}\n'
+                               for i in range(start, min(start + batch, points))).encode()
+                       for start in range(0, points, batch)]
+            first += points
+            leader.followers = attached if replicated else {}
+            began = time.process_time()
+            for packet in packets:
+                protocol.data_received(packet)
+                drain(loop, protocol)
+            # the feed is encoded and sent once per loop iteration
+            loop.run_until_complete(asyncio.sleep(0))
+            spent[replicated].append(time.process_time() - began)
+
+    overhead = statistics.median(on / off - 1 for off, on in zip(spent[False], spent[True]))
+    off, on = (statistics.median(spent[replicated]) / points * 1e6 for replicated in (False, True))
+    print(f'{"followers":>9} {"alone, us/put":>14} {"replicated, us/put":>19} {"overhead":>9}')
+    print(f'{followers:>9} {off:>14.2f} {on:>19.2f} {overhead * 100:>8.2f}%')
+    protocol_class.leader = None
+    loop.close()
+
+
+def bench_reorder(points, jitter, keys=10):
+    """Storage.put of jittered arrivals, block compressions against the lateness window"""
+    arrivals = []
+    for ts in range(points // keys):
+        delay = random.randrange(jitter) if random.random() < 0.3 else 0
+        arrivals += [(ts + delay, ts, f'bench.metric.{k}') for k in range(keys)]
+    ordered = [(key, ts * 0.5, ts) for _, ts, key in sorted(arrivals)]
+    in_order = [(key, ts * 0.5, ts) for _, ts, key in sorted(arrivals, key=lambda item: item[1])]
+
+    encodes = [0]
+    encode = gorilla.Block.__dict__['encode']
+
+    def counted(cls, *args):
+        encodes[0] += 1
+        return encode.__func__(cls, *args)
+
+    print(f'{"stream":<10} {"lateness":>9} {"put/s":>10} {"encodes":>8} '
+          f'{"reordered":>10} {"late":>8}')
+    default = server_coursera.Series.lateness
+    gorilla.Block.encode = classmethod(counted)
+    try:
+        for title, stream, lateness in (('in order', in_order, default),
+                                        ('jittered', ordered, 0),
+                                        ('jittered', ordered, default)):
+            server_coursera.Series.lateness = lateness
+            storage = server_coursera.Storage()
+            encodes[0] = 0
+            began = time.perf_counter()
+            for key, value, ts in stream:
+                storage.put(key, value, ts)
+            rate = len(stream) / (time.perf_counter() - began)
+            print(f'{title:<10} {lateness:>9} {rate:>10.0f} {encodes[0]:>8} '
+                  f'{storage.reordered:>10} {storage.late:>8}')
+    finally:
+        gorilla.Block.encode = encode
+        server_coursera.Series.lateness = default
+
+
+def bench_sqlite(points, keys, reads, directory, batch=1000):
+    """put rate, get latency and memory of the in-memory Storage against SQLiteStorage"""
+    per_key = points // keys
+    stream = [(f'bench.metric.{k}', ts % 1000 * 0.25, 1_500_000_000 + ts * 10)
+              for ts in range(per_key) for k in range(keys)]
+    path = os.path.join(directory, 'bench.sqlite')
+
+    def remove():
+        for name in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(name):
+                os.remove(name)
+
+    async def fill(storage):
+        # puts come in packets as from the protocol; busy is the time the loop spends in put
+        busy = 0
+        for start in range(0, len(stream), batch):
+            began = time.perf_counter()
+            for point in stream[start:start + batch]:
+                storage.put(*point)
+            busy += time.perf_counter() - began
+            await asyncio.sleep(0)
+        return busy
+
+    async def fill_sqlite():
+        storage = server_coursera.SQLiteStorage(path)
+        storage.open()
+        busy = await fill(storage)
+        await storage.close()
+        return busy
+
+    async def latency(storage):
+        """median get of a whole series and of 100 points, microseconds"""
+        whole, window = [], []
+        for _ in range(reads):
+            key = f'bench.metric.{random.randrange(keys)}'
+            start = 1_500_000_000 + random.randrange(max(per_key - 100, 1)) * 10
+            for times, interval in ((whole, (None, None)), (window, (start, start + 990))):
+                began = time.perf_counter()
+                # SQLiteStorage reads in its executor and yields the future of each read
+                for chunk in storage.get(key, *interval):
+                    if isinstance(chunk, asyncio.Future):
+                        await chunk
+                times.append(time.perf_counter() - began)
+        return statistics.median(whole) * 1e6, statistics.median(window) * 1e6
+
+    async def latency_sqlite():
+        storage = server_coursera.SQLiteStorage(path)
+        storage.open()
+        try:
+            return await latency(storage)
+        finally:
+            await storage.close()
+
+    print(f'{"":<8} {"loop put/s":>11} {"durable put/s":>14} {"get series us":>14} '
+          f'{"get 100 us":>11} {"heap MiB":>9} {"disk MiB":>9}')
+
+    storage = server_coursera.Storage()
+    busy = asyncio.run(fill(storage))
+    whole, window = asyncio.run(latency(storage))
+    del storage
+    tracemalloc.start()
+    storage = server_coursera.Storage()
+    asyncio.run(fill(storage))
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del storage
+    print(f'{"memory":<8} {len(stream) / busy:>11.0f} {"-":>14} {whole:>14.0f} '
+          f'{window:>11.0f} {heap / 2 ** 20:>9.1f} {"-":>9}')
+
+    remove()
+    try:
+        began = time.perf_counter()
+        busy = asyncio.run(fill_sqlite())
+        rate = len(stream) / (time.perf_counter() - began)
+        disk = sum(os.path.getsize(name) for name in (path, path + '-wal') if os.path.exists(name))
+        # what the server keeps in the Python heap for a written database: the key index;
+        # the page cache of SQLite itself is bounded by its cache_size, about 2 MiB
+        tracemalloc.start()
+        storage = server_coursera.SQLiteStorage(path)
+        heap = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        asyncio.run(storage.close())
+        whole, window = asyncio.run(latency_sqlite())
+        print(f'{"sqlite":<8} {len(stream) / busy:>11.0f} {rate:>14.0f} {whole:>14.0f} '
+              f'{window:>11.0f} {heap / 2 ** 20:>9.1f} {disk / 2 ** 20:>9.1f}')
+    finally:
+        remove()
+
+
+def bench_cache(points, reads, keys=10, batch=100):
+    """repeated gets of a few unchanged keys and of get * with the response cache off and on"""
+    storage = server_coursera.Storage()
+    for key in range(keys):
+        for i in range(points):
+            storage.put(f'bench.metric.{key}', i * 0.5, 1_500_000_000 + i)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    protocol_class = server_coursera.MetricsStorageServerProtocol
+    protocol_class.storage = storage
+    print(f'{keys} keys of {points} points')
+    print(f'{"query":<10} {"no cache, get/s":>16} {"cache, get/s":>13} {"speed-up":>9}')
+    for query in ('key', '*'):
+        lines = [f'get {f"bench.metric.{n % keys}" if query == "key" else "*"}\n'
+                 for n in range(batch)]
+        packet = ''.join(lines).encode()
+        rates = []
+        for cache in (None, ResponseCache()):
+            protocol_class.cache = cache
+            protocol = protocol_class()
+            protocol.connection_made(NullTransport())
+            began = time.perf_counter()
+            for _ in range(reads // batch):
+                protocol.data_received(packet)
+                drain(loop, protocol)
+            rates.append(reads // batch * batch / (time.perf_counter() - began))
+        print(f'{query:<10} {rates[0]:>16.0f} {rates[1]:>13.0f} {rates[1] / rates[0]:>8.1f}x')
+    loop.close()
+
+
+def load_puts(port, points, batch, client):
+    """one client connection: pipelined puts, a batch at a time"""
+    sock = socket.create_connection(('127.0.0.1', port))
+    for start in range(0, points, batch):
+        count = min(batch, points - start)
+        sock.sendall(''.join(f'put bench.{client}.{i % 100} {i * 0.5} {1_500_000_000 + i}\n'
+                             for i in range(start, start + count)).encode())
+        # every answer is ok\n\n
+        expected, received = 4 * count, 0
+        while received < expected:
+            received += len(sock.recv(expected - received))
+    sock.close()
+
+
+def wait_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def bench_shards(name, workers, points, clients, batch=1000, port=8900):
+    """put throughput of one server process against shard.py clusters of 1..workers shards"""
+    setups = [('single', shard.serve_shard, (name, '127.0.0.1', port))]
+    count = 1
+    while count <= workers:
+        setups.append((f'{count} shards', shard.run_cluster, (name, '127.0.0.1', port, count)))
+        count *= 2
+
+    print(f'{multiprocessing.cpu_count()} cores, {clients} clients, {name}')
+    print(f'{"setup":<12} {"puts/s":>10} {"scaling":>8}')
+    base = None
+    for title, target, args in setups:
+        process = multiprocessing.Process(target=target, args=args)
+        process.start()
+        try:
+            wait_port(port)
+            with multiprocessing.Pool(clients) as pool:
+                began = time.perf_counter()
+                pool.starmap(load_puts, [(port, points // clients, batch, client)
+                                         for client in range(clients)])
+                rate = points // clients * clients / (time.perf_counter() - began)
+        finally:
+            process.terminate()
+            process.join()
+        base = base or rate
+        print(f'{title:<12} {rate:>10.0f} {rate / base:>7.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    put = commands.add_parser('put', help='put throughput against series length')
+    put.add_argument('--points', type=int, default=10_000_000)
+    put.add_argument('--step', type=int, default=1_000_000)
+
+    storage = commands.add_parser('storage', help='memory per point of the Storage engine')
+    storage.add_argument('--points', type=int, default=1_000_000)
+    storage.add_argument('--keys', type=int, default=100)
+
+    agg = commands.add_parser('agg', help='agg over rollups against raw get')
+    agg.add_argument('--points', type=int, default=1_000_000)
+    agg.add_argument('--step', type=int, default=3600)
+
+    wal = commands.add_parser('wal', help='put throughput for each journal setting')
+    wal.add_argument('--points', type=int, default=20_000)
+    wal.add_argument('--dir', default=tempfile.gettempdir(), help='directory for the journal')
+
+    snapshot = commands.add_parser('snapshot', help='cold start from snapshot against journal')
+    snapshot.add_argument('--points', type=int, default=5_000_000)
+    snapshot.add_argument('--keys', type=int, default=100)
+    snapshot.add_argument('--dir', default=tempfile.gettempdir(),
+                          help='directory for the snapshot and the journal')
+
+    compress = commands.add_parser('compress', help='gorilla block size and decode speed')
+    compress.add_argument('--points', type=int, default=1_000_000)
+
+    keys = commands.add_parser('keys', help='get by key and by pattern against a full scan')
+    keys.add_argument('--keys', type=int, default=100_000)
+
+    ingest = commands.add_parser('ingest', help='server CPU of text puts against binary frames')
+    ingest.add_argument('--points', type=int, default=1_000_000)
+    ingest.add_argument('--batch', type=int, default=1000, help='points per packet')
+
+    mput = commands.add_parser('mput', help='put round trips against batched mput')
+    mput.add_argument('--points', type=int, default=100_000)
+    mput.add_argument('--batch', type=int, default=1000, help='points per mput')
+
+    cache = commands.add_parser('cache', help='repeated gets with the response cache off and on')
+    cache.add_argument('--points', type=int, default=1000, help='points per key')
+    cache.add_argument('--reads', type=int, default=20_000)
+
+    shards = commands.add_parser('shards', help='put throughput of shard.py clusters')
+    shards.add_argument('--server', default='server_coursera',
+                        choices=('server_coursera', 'server', 'server_1'))
+    shards.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='largest cluster, clusters of 1, 2, 4... shards are measured')
+    shards.add_argument('--points', type=int, default=400_000)
+    shards.add_argument('--clients', type=int, default=8, help='client processes')
+
+    stats = commands.add_parser('stats', help='server CPU with the stats counters on against off')
+    stats.add_argument('--points', type=int, default=5000, help='puts per round')
+    stats.add_argument('--rounds', type=int, default=200)
+
+    replication = commands.add_parser('replication',
+                                      help='server CPU per put with followers attached against none')
+    replication.add_argument('--points', type=int, default=5000, help='puts per round')
+    replication.add_argument('--rounds', type=int, default=100)
+    replication.add_argument('--followers', type=int, default=4)
+
+    reorder = commands.add_parser('reorder',
+                                  help='put of out-of-order points with and without the lateness window')
+    reorder.add_argument('--points', type=int, default=1_000_000)
+    reorder.add_argument('--jitter', type=int, default=30, help='largest delay of a late point')
+
+    sqlite = commands.add_parser('sqlite', help='the in-memory Storage against SQLiteStorage')
+    sqlite.add_argument('--points', type=int, default=500_000)
+    sqlite.add_argument('--keys', type=int, default=100)
+    sqlite.add_argument('--reads', type=int, default=200)
+    sqlite.add_argument('--dir', default=tempfile.gettempdir(), help='directory for the database')
+
+    args = parser.parse_args()
+    if args.command == 'put':
+        bench_put(args.points, args.step)
+    elif args.command == 'storage':
+        bench_storage(args.points, args.keys)
+    elif args.command == 'agg':
+        bench_agg(args.points, args.step)
+    elif args.command == 'wal':
+        bench_wal(args.points, args.dir)
+    elif args.command == 'snapshot':
+        bench_snapshot(args.points, args.keys, args.dir)
+    elif args.command == 'compress':
+        bench_compress(args.points)
+    elif args.command == 'keys':
+        bench_keys(args.keys)
+    elif args.command == 'ingest':
+        bench_ingest(args.points, args.batch)
+    elif args.command == 'mput':
+        bench_mput(args.points, args.batch)
+    elif args.command == 'cache':
+        bench_cache(args.points, args.reads)
+    elif args.command == 'shards':
+        bench_shards(args.server, args.workers, args.points, args.clients)
+    elif args.command == 'stats':
+        bench_stats(args.points, args.rounds)
+    elif args.command == 'replication':
+        bench_replication(args.points, args.rounds, args.followers)
+    elif args.command == 'reorder':
+        bench_reorder(args.points, args.jitter)
+    elif args.command == 'sqlite':
+        bench_sqlite(args.points, args.keys, args.reads, args.dir)
+
+
+if __name__ == '__main__':
+    main()
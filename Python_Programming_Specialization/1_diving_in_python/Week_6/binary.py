@@ -0,0 +1,71 @@
+"""
+Двоичный протокол пакетной записи метрик.
+
+Клиент включает его командой "binary\\n" текстового протокола и получает "ok\\n\\n".
+После этого соединение передает кадры: заголовок FRAME_HEADER (тип, длина
+данных) и данные кадра.
+
+    K - объявление ключа: KEY_ID (номер ключа в соединении) и имя в utf-8,
+        ответа нет;
+    P - пачка точек: записи RECORD (номер ключа, int64 метка, float64 значение),
+        ответ "ok\\n\\n" или ошибка, пачка применяется целиком или не применяется;
+    T - команда текстового протокола без \\n, ответ как в текстовом протоколе.
+
+Записи разбираются struct.iter_unpack прямо из буфера, без разбора строк.
+"""
+
+
+import struct
+
+
+NEGOTIATE = b'binary'
+
+FRAME_HEADER = struct.Struct('<cI')
+KEY_ID = struct.Struct('<I')
+RECORD = struct.Struct('<Iqd')
+
+KEY, POINTS, TEXT = b'K', b'P', b'T'
+
+# кадр больше этого размера считается ошибкой клиента, соединение закрывается
+MAX_FRAME = 16 * 1024 * 1024
+
+
+def frames(buffer):
+    """Список полных кадров (тип, данные) из начала bytearray buffer.
+
+    Разобранные кадры удаляются из buffer. Слишком большой кадр - ValueError.
+    """
+
+    result, offset = [], 0
+    with memoryview(buffer) as view:
+        while len(view) - offset >= FRAME_HEADER.size:
+            kind, length = FRAME_HEADER.unpack_from(view, offset)
+            if length > MAX_FRAME:
+                raise ValueError(f'frame of {length} bytes is too large')
+            end = offset + FRAME_HEADER.size + length
+            if end > len(view):
+                break
+            result.append((kind, bytes(view[offset + FRAME_HEADER.size:end])))
+            offset = end
+
+    del buffer[:offset]
+    return result
+
+
+def declare(payload, keys):
+    """Добавляет объявленный кадром K ключ в словарь номеров keys"""
+    key_id, = KEY_ID.unpack_from(payload)
+    key = payload[KEY_ID.size:].decode()
+    # ключ текстового протокола - одно слово без пробельных символов
+    if key.split() != [key]:
+        raise ValueError(f'invalid key {key!r}')
+    keys[key_id] = key
+
+
+def points(payload, keys):
+    """Точки (key, value, timestamp) кадра P; неизвестный номер ключа - KeyError"""
+
+    if len(payload) % RECORD.size:
+        raise ValueError('truncated record')
+    return [(keys[key_id], value, timestamp)
+            for key_id, timestamp, value in RECORD.iter_unpack(payload)]
@@ -0,0 +1,88 @@
+"""
+Кэш закодированных ответов на get.
+
+Панели мониторинга опрашивают одни и те же ключи (и get *) много раз в секунду,
+и каждый опрос заново кодирует весь ряд. Кэш хранит готовые bytes ответа
+по тексту запроса. Storage нумерует свои изменения: у каждого ключа есть
+версия последнего put, у набора ключей - версия последнего добавления или
+удаления ключа. Запись кэша помнит версию хранилища на момент, когда ответ
+начал формироваться, и отдается, только если с тех пор ни один ее ключ
+не менялся, поэтому устаревший ответ не отдается никогда: повторное чтение
+неизменного ключа стоит поиска в словаре и одной записи в транспорт.
+
+Память под ответы ограничена max_bytes, при переполнении вытесняются записи,
+которые дольше всех не читались (LRU).
+"""
+
+
+from collections import OrderedDict
+
+from keyindex import GLOB
+
+
+class ResponseCache:
+    """Ответы на get по тексту запроса.
+
+    max_bytes - предел суммарного размера ответов; ответ больше max_entry
+    не кэшируется, чтобы один get * не вытеснил все остальное.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry=None):
+        self.max_bytes = max_bytes
+        self.max_entry = max_bytes // 16 if max_entry is None else max_entry
+        # запрос -> (версия хранилища, ключ или шаблон, шаблон ли это, ответ)
+        self._entries = OrderedDict()
+        self.size = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, request, storage):
+        """Готовый ответ на запрос request (bytes) или None"""
+
+        entry = self._entries.get(request)
+        if entry is not None:
+            version, key, pattern, data = entry
+            if not storage.changed(key, version, pattern):
+                self._entries.move_to_end(request)
+                self.hits += 1
+                return data
+            del self._entries[request]
+            self.size -= len(data)
+        self.misses += 1
+        return None
+
+    def store(self, request, version, data):
+        """Запоминает ответ data на request, сформированный с версии хранилища version"""
+
+        if len(data) > self.max_entry:
+            return
+        key = request.split()[1].decode()
+
+        previous = self._entries.pop(request, None)
+        if previous is not None:
+            self.size -= len(previous[3])
+        self._entries[request] = (version, key, GLOB.search(key) is not None, data)
+        self.size += len(data)
+
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted[3])
+            self.evictions += 1
+
+    def report(self):
+        """Пары (имя, значение) для ответа на stats"""
+
+        requests = self.hits + self.misses
+        return [('cache.hits', self.hits),
+                ('cache.misses', self.misses),
+                ('cache.hit_ratio', round(self.hits / requests, 3) if requests else 0),
+                ('cache.evictions', self.evictions),
+                ('cache.entries', len(self._entries)),
+                ('cache.bytes', self.size)]
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,145 @@
+"""
+Сжатие блоков временного ряда по схеме Gorilla (Facebook, VLDB 2015).
+
+Метки времени кодируются разностью разностей (delta-of-delta): у метрик,
+которые приходят с постоянным шагом, она почти всегда равна нулю и занимает
+один бит. Значения кодируются XOR с предыдущим значением: у медленно
+меняющихся величин совпадают знак, порядок и старшие биты мантиссы, поэтому
+хранятся только значащие биты XOR.
+
+Битовый поток собирается и разбирается как строка из '0' и '1': срезы строк
+и int(bits, 2) в CPython заметно быстрее побитовых операций над большим int.
+"""
+
+
+import sys
+from array import array
+
+
+# префикс и ширина кода разности разностей меток; последний - без ограничений
+DELTA_CODES = ((7, '10'), (9, '110'), (12, '1110'), (72, '1111'))
+
+
+def _signed(bits, width):
+    value = int(bits, 2)
+    return value - (1 << width) if value >> (width - 1) else value
+
+
+def encode(timestamps, values):
+    """Байты сжатого блока для отсортированных меток array('q') и значений array('d')"""
+
+    parts = []
+    append = parts.append
+
+    previous, delta = timestamps[0], 0
+    append(format(previous & 0xFFFFFFFFFFFFFFFF, '064b'))
+    for timestamp in timestamps[1:]:
+        current = timestamp - previous
+        dod, previous, delta = current - delta, timestamp, current
+        if not dod:
+            append('0')
+            continue
+        for width, prefix in DELTA_CODES:
+            if -(1 << (width - 1)) <= dod < 1 << (width - 1):
+                append(prefix + format(dod & ((1 << width) - 1), f'0{width}b'))
+                break
+
+    # значения как целые: биты IEEE 754 без преобразований
+    words = array('Q', values.tobytes()) if isinstance(values, array) \
+        else array('Q', array('d', values).tobytes())
+    previous = words[0]
+    append(format(previous, '064b'))
+    leading = trailing = 65
+
+    for word in words[1:]:
+        xor, previous = word ^ previous, word
+        if not xor:
+            append('0')
+            continue
+
+        lead = min(64 - xor.bit_length(), 31)
+        trail = (xor & -xor).bit_length() - 1
+        if lead >= leading and trail >= trailing:
+            # значащие биты укладываются в окно предыдущего значения
+            width = 64 - leading - trailing
+            append('10' + format(xor >> trailing, f'0{width}b'))
+        else:
+            leading, trailing = lead, trail
+            width = 64 - lead - trail
+            append('11' + format(lead, '05b') + format(width & 63, '06b')
+                   + format(xor >> trail, f'0{width}b'))
+
+    bits = ''.join(parts)
+    return int('1' + bits, 2).to_bytes(len(bits) // 8 + 1, 'big')
+
+
+def decode(data, count):
+    """Метки array('q') и значения array('d') блока из count точек"""
+
+    # ведущая единица из encode сохраняет ведущие нули потока
+    bits = bin(int.from_bytes(data, 'big'))[3:]
+    timestamps = array('q', [_signed(bits[:64], 64)])
+    position = 64
+    previous, delta = timestamps[0], 0
+
+    for _ in range(count - 1):
+        if bits[position] == '0':
+            position += 1
+        else:
+            for width, prefix in DELTA_CODES:
+                if bits.startswith(prefix, position):
+                    position += len(prefix)
+                    delta += _signed(bits[position:position + width], width)
+                    position += width
+                    break
+        previous += delta
+        timestamps.append(previous)
+
+    words = array('Q', [int(bits[position:position + 64], 2)])
+    position += 64
+    previous, leading, trailing = words[0], 0, 0
+
+    for _ in range(count - 1):
+        control = bits[position]
+        if control == '0':
+            position += 1
+        else:
+            if bits[position + 1] == '1':
+                leading = int(bits[position + 2:position + 7], 2)
+                width = int(bits[position + 7:position + 13], 2) or 64
+                trailing = 64 - leading - width
+                position += 13
+            else:
+                width = 64 - leading - trailing
+                position += 2
+            previous ^= int(bits[position:position + width], 2) << trailing
+            position += width
+        words.append(previous)
+
+    return timestamps, array('d', words.tobytes())
+
+
+class Block:
+    """Сжатый неизменяемый блок ряда: границы и число точек доступны без распаковки"""
+
+    __slots__ = ('first', 'last', 'count', 'data')
+
+    def __init__(self, first, last, count, data):
+        self.first = first
+        self.last = last
+        self.count = count
+        self.data = data
+
+    @classmethod
+    def encode(cls, timestamps, values):
+        return cls(timestamps[0], timestamps[-1], len(timestamps), encode(timestamps, values))
+
+    def decode(self):
+        """Распакованные (timestamps, values)"""
+        return decode(self.data, self.count)
+
+    def nbytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.data)
+
+    def __len__(self):
+        return self.count
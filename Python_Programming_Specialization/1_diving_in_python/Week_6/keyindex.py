@@ -0,0 +1,81 @@
+"""
+Индекс ключей метрик для запросов по шаблону.
+
+Ключи лежат в отсортированном списке, поэтому все ключи с общим префиксом
+занимают в нем непрерывный диапазон, который находится бинарным поиском.
+Шаблон fnmatch ("cpu.host42.*") проверяется только на ключах с его
+буквальным префиксом - до первого из символов *?[. Стоимость запроса зависит
+от числа подходящих ключей, а не от размера всего пространства ключей.
+Точный ключ проверяется по множеству за O(1).
+"""
+
+
+import re
+from bisect import bisect_left, insort
+from fnmatch import translate
+from functools import lru_cache
+
+
+GLOB = re.compile(r'[*?[]')
+
+
+@lru_cache(maxsize=1024)
+def _compile(pattern):
+    return re.compile(translate(pattern)).match
+
+
+class KeyIndex:
+    """Множество ключей и их отсортированный список"""
+
+    def __init__(self, keys=()):
+        self._set = set(keys)
+        self._sorted = sorted(self._set)
+
+    def add(self, key):
+        if key not in self._set:
+            self._set.add(key)
+            insort(self._sorted, key)
+
+    def discard(self, key):
+        if key in self._set:
+            self._set.remove(key)
+            del self._sorted[bisect_left(self._sorted, key)]
+
+    def match(self, pattern):
+        """Список ключей по шаблону: точный ключ, '*' или шаблон fnmatch"""
+
+        if pattern in self._set:
+            return [pattern]
+        if pattern == '*':
+            return list(self._sorted)
+
+        glob = GLOB.search(pattern)
+        if glob is None:
+            return []
+
+        prefix = pattern[:glob.start()]
+        matches = _compile(pattern)
+        keys, ordered = [], self._sorted
+        for position in range(bisect_left(ordered, prefix), len(ordered)):
+            key = ordered[position]
+            if not key.startswith(prefix):
+                break
+            if matches(key):
+                keys.append(key)
+        return keys
+
+    def __contains__(self, key):
+        return key in self._set
+
+    def __len__(self):
+        return len(self._set)
+
+    def __iter__(self):
+        return iter(self._sorted)
+
+
+def matches(pattern, key):
+    """Подходит ли ключ key под шаблон: точный ключ, '*' или шаблон fnmatch"""
+    if pattern == key or pattern == '*':
+        return True
+    return GLOB.search(pattern) is not None and _compile(pattern)(key) is not None
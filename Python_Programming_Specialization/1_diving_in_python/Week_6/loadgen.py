@@ -0,0 +1,184 @@
+"""
+asyncio load generator for the metrics servers
+
+every server named by --servers is started in its own process on localhost and
+driven in turn with the same load: --connections connections spread over
+--processes client processes, each connection keeping up to --pipeline commands
+in flight. a command is a get with probability --get-ratio, otherwise a put;
+keys are drawn uniformly from --keys names padded so that a put is --payload
+bytes long. gets ask for the last --get-window seconds of their key.
+
+latency is the time from writing a command to reading its whole answer, so with
+a deep pipeline it includes the wait behind the commands sent before it.
+the results go to stdout as a JSON list, one object per server, to be kept
+and compared across commits:
+
+python loadgen.py [--servers NAME ...] [--connections N] [--processes N]
+    [--pipeline N] [--keys N] [--get-ratio F] [--payload N] [--duration S]
+"""
+
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import subprocess
+import sys
+import time
+from collections import deque
+
+import shard
+from benchmark import wait_port
+from stats import Histogram
+
+
+SERVERS = ('server_coursera', 'server', 'server_1')
+PERCENTILES = (('p50', 50), ('p95', 95), ('p99', 99), ('p999', 99.9))
+KINDS = ('put', 'get')
+
+
+def key_names(keys, payload):
+    """key names padded so that a put of a 0.0..1.0 value is payload bytes long"""
+    # put <key> 0.123456789 1700000000000\n
+    width = max(payload - len('put  0.123456789 1700000000000\n'), len(f'load.{keys}.'))
+    return [f'load.{key}.'.ljust(width, 'x') for key in range(keys)]
+
+
+async def drive(host, port, names, settings, seed, deadline, histograms):
+    """one connection: commands until the deadline, then the answers still in flight"""
+    reader, writer = await asyncio.open_connection(host, port, limit=16 * 1024 * 1024)
+    rng = random.Random(seed)
+    window = settings['get_window'] * 1000
+    sent = deque()
+    errors = 0
+
+    def send():
+        key = names[rng.randrange(len(names))]
+        # millisecond timestamps, so that a key takes many points a second
+        now = time.time_ns() // 1_000_000
+        if rng.random() < settings['get_ratio']:
+            writer.write(f'get {key} {now - window} {now}\n'.encode())
+            sent.append(('get', time.perf_counter_ns()))
+        else:
+            writer.write(f'put {key} {rng.random():.9f} {now}\n'.encode())
+            sent.append(('put', time.perf_counter_ns()))
+
+    for _ in range(settings['pipeline']):
+        send()
+    while sent:
+        answer = await reader.readuntil(b'\n\n')
+        kind, began = sent.popleft()
+        histograms[kind].record(time.perf_counter_ns() - began)
+        if not answer.startswith(b'ok\n'):
+            errors += 1
+        if time.monotonic() < deadline:
+            send()
+
+    writer.close()
+    await writer.wait_closed()
+    return errors
+
+
+def run_clients(host, port, settings, connections, seed):
+    """one client process: connections of drive, returns (histograms, errors)"""
+
+    async def clients():
+        deadline = time.monotonic() + settings['duration']
+        names = key_names(settings['keys'], settings['payload'])
+        histograms = {kind: Histogram() for kind in KINDS}
+        errors = await asyncio.gather(*(
+            drive(host, port, names, settings, seed * 1000 + number, deadline, histograms)
+            for number in range(connections)))
+        return histograms, sum(errors)
+
+    return asyncio.run(clients())
+
+
+def summary(histogram, elapsed):
+    """throughput and latencies in microseconds of one histogram"""
+    result = {'requests': histogram.count,
+              'throughput': round(histogram.count / elapsed, 1)}
+    for name, percent in PERCENTILES:
+        result[f'{name}_us'] = round(histogram.percentile(percent) / 1000, 1)
+    result['max_us'] = round(histogram.max / 1000, 1)
+    return result
+
+
+def load(name, host, port, settings):
+    """starts server module name, drives it with settings and returns the result"""
+    process = multiprocessing.Process(target=shard.serve_shard, args=(name, host, port))
+    process.start()
+    try:
+        wait_port(port)
+        processes = min(settings['processes'], settings['connections'])
+        shares = [settings['connections'] // processes
+                  + (number < settings['connections'] % processes)
+                  for number in range(processes)]
+        with multiprocessing.Pool(processes) as pool:
+            began = time.perf_counter()
+            runs = pool.starmap(run_clients, [(host, port, settings, share, number)
+                                              for number, share in enumerate(shares)])
+            elapsed = time.perf_counter() - began
+    finally:
+        process.terminate()
+        process.join()
+
+    histograms = {kind: Histogram() for kind in KINDS}
+    for partial, _ in runs:
+        for kind in KINDS:
+            histograms[kind].merge(partial[kind])
+    total = Histogram()
+    for histogram in histograms.values():
+        total.merge(histogram)
+
+    result = {'server': name, 'revision': revision(), 'settings': settings,
+              'elapsed': round(elapsed, 3), 'errors': sum(errors for _, errors in runs)}
+    result.update(summary(total, elapsed))
+    for kind in KINDS:
+        result[kind] = summary(histograms[kind], elapsed)
+    return result
+
+
+def revision():
+    """the git commit of the tree being measured, None outside a checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', nargs='+', default=list(SERVERS), choices=SERVERS)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8910)
+    parser.add_argument('--connections', type=int, default=16)
+    parser.add_argument('--processes', type=int, default=1, help='client processes')
+    parser.add_argument('--pipeline', type=int, default=8, help='commands in flight per connection')
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--get-ratio', type=float, default=0.1, help='share of gets, the rest are puts')
+    parser.add_argument('--get-window', type=int, default=1, help='seconds of points a get asks for')
+    parser.add_argument('--payload', type=int, default=48, help='bytes per put command')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per server')
+    args = parser.parse_args()
+    if args.connections < 1 or args.processes < 1 or args.pipeline < 1 or args.keys < 1:
+        parser.error('connections, processes, pipeline and keys must be positive')
+    if not 0 <= args.get_ratio <= 1:
+        parser.error('get ratio must be between 0 and 1')
+
+    settings = {name: getattr(args, name)
+                for name in ('connections', 'processes', 'pipeline', 'keys', 'get_ratio',
+                             'get_window', 'payload', 'duration')}
+    results = []
+    for name in args.servers:
+        print(f'loading {name}...', file=sys.stderr)
+        results.append(load(name, args.host, args.port, settings))
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
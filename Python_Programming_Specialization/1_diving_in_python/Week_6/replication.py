@@ -0,0 +1,286 @@
+"""
+Репликация хранилища метрик с ведущего сервера на ведомые.
+
+Ведомый сервер (--follow host:port) подключается к ведущему командой
+"replicate\\n" текстового протокола и получает "ok\\n\\n", после чего соединение
+передает кадры в формате binary.py:
+
+    K - объявление ключа, номера ключей общие для всех ведомых;
+    D - запись снимка одного ключа (Storage.dump_key): ряд, rollup, сводка
+        и самая новая точка целиком;
+    E - конец снимка: ключи, которых в нем не было, ведомый удаляет;
+    P - точки, записанные на ведущем после начала снимка;
+    H - метка времени ведущего (REPLICATION_TIME) после очередной порции точек
+        или раз в heartbeat секунд без записи.
+
+Снимок формируется лениво, ключ за ключом, по мере того как ведомый его читает,
+а точки, записанные тем временем, копятся и уходят сразу за снимком. Ключ,
+изменившийся до того, как попал в снимок, придет и в снимке, и в потоке точек:
+повторная запись той же точки ничего не меняет (last-write-wins).
+
+Ведущий не кодирует точки в момент put: put_many только запоминает пачку,
+а кодирует и рассылает их один раз за итерацию цикла событий, одними и теми же
+bytes для всех ведомых. Ведомый, который не успевает читать, отключается, как
+только его очередь превысит max_backlog байт, и после переподключения получает
+снимок заново.
+
+Ведомый принимает только чтение: put, mput и кадры P клиентов - ошибка.
+Его отставание (replication.lag в ответе stats) - время, прошедшее с метки
+ведущего в последнем примененном кадре H, то есть не меньше, чем запаздывает
+каждая прочитанная точка. Сроки хранения ведомый применяет сам (--retention).
+"""
+
+
+import asyncio
+import io
+import logging
+import struct
+import time
+
+import binary
+
+
+REPLICATE = b'replicate'
+
+SNAPSHOT, END, HEARTBEAT = b'D', b'E', b'H'
+REPLICATION_TIME = struct.Struct('<d')
+
+RECORD = binary.RECORD
+# точек в одном кадре P: кадр не превышает binary.MAX_FRAME
+FRAME_POINTS = 64 * 1024
+
+logger = logging.getLogger('replication')
+
+
+def frame(kind, payload):
+    return binary.FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+class Leader:
+    """Рассылка изменений хранилища storage ведомым серверам.
+
+    heartbeat - период кадров H, когда записей нет; max_backlog - байт в очереди
+    ведомого, после которых он отключается.
+    """
+
+    def __init__(self, storage, heartbeat=0.1, max_backlog=64 * 1024 * 1024):
+        self.storage = storage
+        self.heartbeat = heartbeat
+        self.max_backlog = max_backlog
+        # соединение ведомого -> кадры, накопленные за время его снимка, или None после него
+        self.followers = {}
+        # номера ключей для кадров K, общие для всех ведомых
+        self._ids = {}
+        # точки, записанные с прошлой рассылки
+        self._points = []
+        self._loop = None
+        self._scheduled = False
+        self._timer = None
+        self.disconnects = 0
+
+    def publish(self, points):
+        """Добавляет записанную пачку точек (key, value, timestamp) к рассылке"""
+
+        self._points += points
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def subscribe(self, protocol):
+        """Подключает ведомого; возвращает его ответ: кадры снимка, затем поток точек"""
+
+        self._loop = asyncio.get_event_loop()
+        self.followers[protocol] = bytearray()
+        if self._timer is None:
+            self._timer = self._loop.call_later(self.heartbeat, self._beat)
+        return self._snapshot(protocol)
+
+    def unsubscribe(self, protocol):
+        self.followers.pop(protocol, None)
+        if not self.followers and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _snapshot(self, protocol):
+        yield b''.join(self._declare(key, key_id) for key, key_id in self._ids.items())
+
+        storage = self.storage
+        buffer = io.BytesIO()
+        # между шагами ключи могут удаляться: удаленные пропускаются
+        for key in storage.keys():
+            if key in storage:
+                storage.dump_key(buffer, key)
+                yield frame(SNAPSHOT, buffer.getvalue())
+                buffer.seek(0)
+                buffer.truncate()
+
+        pending = self.followers.get(protocol)
+        if pending is None:
+            return
+        # с этого момента точки пишутся в соединение сразу при рассылке
+        self.followers[protocol] = None
+        yield frame(END, b'') + pending
+
+    @staticmethod
+    def _declare(key, key_id):
+        name = key.encode()
+        return frame(binary.KEY, binary.KEY_ID.pack(key_id) + name)
+
+    def _encode(self, points):
+        """Кадры K новых ключей и кадры P точек (key, value, timestamp)"""
+
+        ids, out = self._ids, []
+        for key in {key for key, _, _ in points if key not in ids}:
+            ids[key] = len(ids)
+            out.append(self._declare(key, ids[key]))
+
+        pack, ids = RECORD.pack, ids.__getitem__
+        for start in range(0, len(points), FRAME_POINTS):
+            out.append(frame(binary.POINTS, b''.join(
+                [pack(ids(key), timestamp, value)
+                 for key, value, timestamp in points[start:start + FRAME_POINTS]])))
+        return out
+
+    def _flush(self):
+        self._scheduled = False
+        points, self._points = self._points, []
+        out = self._encode(points)
+        out.append(frame(HEARTBEAT, REPLICATION_TIME.pack(time.time())))
+        data = b''.join(out)
+
+        for protocol, pending in list(self.followers.items()):
+            transport = protocol.transport
+            if pending is not None:
+                pending += data
+                backlog = len(pending)
+            else:
+                transport.write(data)
+                backlog = transport.get_write_buffer_size()
+            if backlog > self.max_backlog:
+                logger.warning('follower %s is %d bytes behind, disconnecting',
+                               transport.get_extra_info('peername'), backlog)
+                self.disconnects += 1
+                self.unsubscribe(protocol)
+                transport.abort()
+
+    def _beat(self):
+        self._timer = self._loop.call_later(self.heartbeat, self._beat)
+        if not self._scheduled:
+            self._flush()
+
+    def report(self):
+        """Пары (имя, значение) для ответа на stats"""
+
+        backlogs = [len(pending) if pending is not None
+                    else protocol.transport.get_write_buffer_size()
+                    for protocol, pending in self.followers.items()]
+        return [('replication.followers', len(self.followers)),
+                ('replication.syncing', sum(pending is not None
+                                            for pending in self.followers.values())),
+                ('replication.backlog_bytes', max(backlogs, default=0)),
+                ('replication.disconnects', self.disconnects)]
+
+
+class Follower:
+    """Копия хранилища storage, которую поддерживает ведущий сервер host:port.
+
+    При обрыве соединения ведомый продолжает отдавать прежние данные
+    и переподключается через reconnect секунд. Точки ведущего раздаются
+    подпискам watchers (watch.Watchers) ведомого.
+    """
+
+    def __init__(self, storage, host, port, reconnect=1.0, watchers=None):
+        self.storage = storage
+        self.host = host
+        self.port = port
+        self.reconnect = reconnect
+        self.watchers = watchers
+
+        self.connected = False
+        self.synced = False
+        self.syncs = 0
+        self.points = 0
+        # метка ведущего в последнем кадре H
+        self.leader_time = None
+        self._task = None
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    @property
+    def lag(self):
+        """Секунды с момента, до которого ведомый применил все записи ведущего"""
+        if self.leader_time is None:
+            return None
+        return max(time.time() - self.leader_time, 0.0)
+
+    async def _run(self):
+        while True:
+            try:
+                await self._replicate()
+            except (OSError, EOFError, asyncio.IncompleteReadError, ValueError,
+                    KeyError, struct.error) as error:
+                logger.warning('replication from %s:%d stopped: %r', self.host, self.port, error)
+            finally:
+                self.connected = self.synced = False
+            await asyncio.sleep(self.reconnect)
+
+    async def _replicate(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(REPLICATE + b'\n')
+            if await reader.readuntil(b'\n\n') != b'ok\n\n':
+                raise ValueError('leader refused to replicate')
+            self.connected = True
+            logger.info('replicating from %s:%d', self.host, self.port)
+
+            storage, keys, seen = self.storage, {}, set()
+            while True:
+                kind, length = binary.FRAME_HEADER.unpack(
+                    await reader.readexactly(binary.FRAME_HEADER.size))
+                payload = await reader.readexactly(length)
+
+                if kind == binary.POINTS:
+                    points = binary.points(payload, keys)
+                    for key, value, timestamp in points:
+                        storage.put(key, value, timestamp)
+                    self.points += len(points)
+                    if self.watchers is not None and self.watchers.subscribers:
+                        self.watchers.publish(points)
+                elif kind == HEARTBEAT:
+                    self.leader_time, = REPLICATION_TIME.unpack(payload)
+                elif kind == binary.KEY:
+                    binary.declare(payload, keys)
+                elif kind == SNAPSHOT:
+                    key, series, rollups, summary, latest, _ = storage.unpack_key(payload)
+                    storage.replace(key, series, rollups, summary, latest)
+                    seen.add(key)
+                elif kind == END:
+                    for key in storage.keys():
+                        if key not in seen:
+                            storage.discard(key)
+                    seen = set()
+                    self.synced = True
+                    self.syncs += 1
+                    logger.info('%d keys replicated from %s:%d',
+                                len(storage.keys()), self.host, self.port)
+                else:
+                    raise ValueError(f'unknown replication frame {kind!r}')
+        finally:
+            writer.close()
+
+    def report(self):
+        """Пары (имя, значение) для ответа на stats; отставание -1, пока оно неизвестно"""
+
+        lag = self.lag
+        return [('replication.connected', int(self.connected)),
+                ('replication.synced', int(self.synced)),
+                ('replication.syncs', self.syncs),
+                ('replication.points', self.points),
+                ('replication.lag', -1 if lag is None else round(lag, 6))]
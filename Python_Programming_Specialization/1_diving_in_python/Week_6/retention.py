@@ -0,0 +1,186 @@
+"""
+Политики хранения метрик и фоновое уплотнение.
+
+Правило "PATTERN=RAW[:ROLLUP]" задает для ключей, подходящих под шаблон fnmatch,
+сколько хранить сырые точки и сколько - предрасчитанные агрегаты, например
+"cpu.*=7d:1y". Длительности: 45s, 30m, 12h, 7d, 2w, 1y; без суффикса - секунды.
+
+Фоновая задача периодически проходит по всем ключам и обрезает устаревшие
+блоки. Работа идет короткими квантами: после каждого кванта задача уступает
+цикл событий, так что запросы клиентов не ждут окончания прохода.
+"""
+
+
+import asyncio
+import logging
+import os
+import time
+from fnmatch import fnmatchcase
+
+from segment import write_segment
+
+
+log = logging.getLogger(__name__)
+
+DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400, 'y': 365 * 86400}
+
+
+def parse_duration(text):
+    """Длительность вида 7d в секундах"""
+
+    text = text.strip()
+    unit = DURATIONS.get(text[-1:].lower())
+    number = int(text[:-1] if unit else text) * (unit or 1)
+    if number <= 0:
+        raise ValueError(f'retention must be positive: {text}')
+    return number
+
+
+class RetentionPolicy:
+    """Правила хранения, для ключа действует первое подходящее правило"""
+
+    def __init__(self, rules=()):
+        self.rules = []
+        self._cache = {}
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        """Добавляет правило "PATTERN=RAW[:ROLLUP]", ROLLUP по умолчанию равен RAW"""
+
+        pattern, _, durations = rule.rpartition('=')
+        if not pattern or not durations:
+            raise ValueError(f'retention rule must be PATTERN=RAW[:ROLLUP]: {rule}')
+
+        raw, _, rollup = durations.partition(':')
+        raw = parse_duration(raw)
+        rollup = parse_duration(rollup) if rollup else raw
+        if rollup < raw:
+            raise ValueError(f'rollups must be kept at least as long as raw points: {rule}')
+
+        self.rules.append((pattern, raw, rollup))
+        self._cache.clear()
+
+    def match(self, key):
+        """(raw, rollup) в секундах для ключа или None, если ключ хранится вечно"""
+
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        result = next(((raw, rollup) for pattern, raw, rollup in self.rules
+                       if fnmatchcase(key, pattern)), None)
+        self._cache[key] = result
+        return result
+
+    def __bool__(self):
+        return bool(self.rules)
+
+
+class RetentionTask:
+    """Фоновое применение политики к Storage каждые interval секунд.
+
+    slice - длительность кванта работы в цикле событий, секунды.
+    Сегмент на диске, в котором устарело не меньше compact_ratio точек,
+    переписывается без них в потоке-исполнителе, целиком устаревший - выводится.
+    """
+
+    compact_ratio = 0.5
+
+    def __init__(self, storage, policy, interval=60, slice=0.005, clock=time.time):
+        self.storage = storage
+        self.policy = policy
+        self.interval = interval
+        self.slice = slice
+        self.clock = clock
+
+        # освобождено за все время работы, байты
+        self.reclaimed_memory = 0
+        self.reclaimed_disk = 0
+
+        self._loop = None
+        self._task = None
+
+    def start(self, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._task = self._loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('retention pass failed')
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        """Один проход: обрезка ключей, затем уплотнение сегментов.
+
+        Возвращает (память, диск) - освобожденные за проход байты.
+        """
+
+        loop = self._loop or asyncio.get_event_loop()
+        now = int(self.clock())
+        memory = 0
+        deadline = loop.time() + self.slice
+
+        for key in self.storage.keys():
+            limits = self.policy.match(key)
+            if limits is not None:
+                raw, rollup = limits
+                memory += self.storage.expire(key, now - raw, now - rollup)
+
+            if loop.time() >= deadline:
+                await asyncio.sleep(0)
+                deadline = loop.time() + self.slice
+
+        disk = 0
+        for segment in self.storage.segments():
+            disk += await self._compact(loop, segment)
+
+        self.reclaimed_memory += memory
+        self.reclaimed_disk += disk
+        if memory or disk:
+            log.info('retention reclaimed %d bytes of memory and %d bytes on disk '
+                     '(%d and %d in total)', memory, disk,
+                     self.reclaimed_memory, self.reclaimed_disk)
+        return memory, disk
+
+    async def _compact(self, loop, segment):
+        """Переписывает сегмент без устаревших точек, возвращает освобожденные байты"""
+
+        live, total = {}, 0
+        deadline = loop.time() + self.slice
+        for key, series in segment.items():
+            total += len(series)
+            horizon = self.storage.horizon(key)
+            if horizon is not None:
+                series = series.since(horizon)
+            live[key] = series
+
+            if loop.time() >= deadline:
+                await asyncio.sleep(0)
+                deadline = loop.time() + self.slice
+
+        remaining = sum(len(series) for series in live.values())
+        if remaining == total or remaining > total * (1 - self.compact_ratio):
+            return 0
+
+        size = os.path.getsize(segment.path)
+        if not remaining:
+            self.storage.replace_segment(segment, None)
+            return size
+
+        path = self.storage.new_segment_path()
+        await loop.run_in_executor(None, write_segment, path, live)
+        self.storage.replace_segment(segment, path)
+        return size - os.path.getsize(path)
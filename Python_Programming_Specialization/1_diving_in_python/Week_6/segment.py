@@ -0,0 +1,159 @@
+"""
+Неизменяемые сегменты истории метрик на диске.
+
+Когда голова хранилища в памяти разрастается, она целиком запечатывается
+в файл сегмента: для каждого ключа отсортированные метки времени (int64),
+затем значения (float64), в конце файла - индекс ключей.
+Сегмент открывается через mmap, поэтому в память попадают только страницы,
+которые действительно читает запрос.
+"""
+
+
+import glob
+import mmap
+import os
+import struct
+from bisect import bisect_left, bisect_right
+
+
+# заголовок: сигнатура, число ключей, смещение индекса;
+# запись индекса: длина имени ключа, смещение данных ключа, число точек
+SEGMENT_HEADER = struct.Struct('<8sQQ')
+SEGMENT_KEY = struct.Struct('<HQQ')
+SEGMENT_MAGIC = b'METRSEG1'
+
+
+def segment_files(directory):
+    """Файлы сегментов segment.NNNNNN в каталоге directory"""
+    paths = glob.glob(os.path.join(glob.escape(directory), 'segment.*'))
+    return [path for path in paths if path.rsplit('.', 1)[1].isdigit()]
+
+
+def segment_path(directory, number):
+    return os.path.join(directory, f'segment.{number:06d}')
+
+
+def write_segment(path, data):
+    """Пишет ряды {key: Series} в файл сегмента path.
+
+    Файл сначала пишется во временный, сбрасывается на диск и только потом
+    переименовывается, так что после сбоя не остается недописанных сегментов.
+    """
+
+    temporary = path + '.tmp'
+    index = []
+
+    with open(temporary, 'wb') as file:
+        file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, 0, 0))
+        for key, series in data.items():
+            if len(series):
+                index.append((key.encode(), file.tell(), len(series)))
+                series.dump(file)
+
+        offset = file.tell()
+        for name, position, points in index:
+            file.write(SEGMENT_KEY.pack(len(name), position, points))
+            file.write(name)
+
+        file.seek(0)
+        file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(index), offset))
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temporary, path)
+
+
+class SegmentSeries:
+    """Ряд одного ключа в сегменте: memoryview меток и значений поверх mmap.
+
+    Повторяет интерфейс чтения Series: chunks, bounds, lookup.
+    """
+
+    # число точек в одном срезе chunks
+    chunk_size = 1024
+
+    def __init__(self, timestamps, values):
+        self.timestamps = timestamps
+        self.values = values
+
+    def _range(self, start, end):
+        left = 0 if start is None else bisect_left(self.timestamps, start)
+        right = len(self.timestamps) if end is None else bisect_right(self.timestamps, end)
+        return left, right
+
+    def chunks(self, start=None, end=None):
+        """Срезы (timestamps, values) с метками из [start, end] по возрастанию времени"""
+        left, right = self._range(start, end)
+        for offset in range(left, right, self.chunk_size):
+            stop = min(offset + self.chunk_size, right)
+            yield self.timestamps[offset:stop], self.values[offset:stop]
+
+    def bounds(self, start=None, end=None):
+        """Первая и последняя метки в [start, end] или None"""
+        left, right = self._range(start, end)
+        if left >= right:
+            return None
+        return self.timestamps[left], self.timestamps[right - 1]
+
+    def since(self, start):
+        """Ряд из точек с метками не меньше start, без копирования"""
+        left = bisect_left(self.timestamps, start)
+        return SegmentSeries(self.timestamps[left:], self.values[left:])
+
+    def dump(self, file):
+        file.write(self.timestamps)
+        file.write(self.values)
+
+    def lookup(self, timestamp):
+        """Значение для метки timestamp или None"""
+        position = bisect_left(self.timestamps, timestamp)
+        if position < len(self.timestamps) and self.timestamps[position] == timestamp:
+            return self.values[position]
+        return None
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+class Segment:
+    """Открытый через mmap файл сегмента"""
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        buffer = memoryview(self._mmap)
+        magic, keys, offset = SEGMENT_HEADER.unpack_from(buffer)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f'{path} is not a metrics segment')
+
+        self._series = {}
+        for _ in range(keys):
+            length, position, points = SEGMENT_KEY.unpack_from(buffer, offset)
+            offset += SEGMENT_KEY.size
+            key = bytes(buffer[offset:offset + length]).decode()
+            offset += length
+
+            size = points * 8
+            self._series[key] = SegmentSeries(
+                buffer[position:position + size].cast('q'),
+                buffer[position + size:position + 2 * size].cast('d'))
+
+    def get(self, key):
+        """SegmentSeries ключа или None"""
+        return self._series.get(key)
+
+    def items(self):
+        return self._series.items()
+
+    def __len__(self):
+        """Число точек в сегменте"""
+        return sum(len(series) for series in self._series.values())
+
+    def keys(self):
+        return self._series.keys()
+
+    def __contains__(self, key):
+        return key in self._series
@@ -7,30 +7,257 @@ async text tcp server for metrics
 
 import asyncio
 import json
+import logging
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import chain, islice
+
+import binary
+from gorilla import Block
+from keyindex import KeyIndex
+from stats import OTHER, Stats
+from watch import Watchers
 
 
 DATABASE = {}
+# sorted metric names of DATABASE for get by pattern
+INDEX = KeyIndex()
+# wal.WriteAheadLog for puts, set up by run_server
+WAL = None
+# counters and latencies of all connections, the stats command
+STATS = Stats()
+# watch subscriptions of all connections
+WATCHERS = Watchers()
 SUCCESS = 'ok\n\n'
+# the whole int64 range, for get without bounds
+EVERYTHING = (-2 ** 63, 2 ** 63 - 1)
+# points per piece of a lazily produced get answer
+GET_CHUNK = 1024
 WRONG = 'error\nwrong command\n\n'
 ALLOWED = ('put', 'get', 'DATABASE')
 
 
 
+class TimeSeries:
+    """
+    sorted metric history: the newest points are parallel timestamp and value
+    lists, every block_size points they are sealed into a gorilla.Block
+    (delta-of-delta timestamps, xor-ed values) that is decoded only when read;
+    timestamps are looked up with bisect in O(log n). a late point for a sealed
+    block waits uncompressed beside it until enough of them gather to re-encode
+    the block once. the newest point is kept aside as latest, so the latest
+    command never reads the history
+    """
+
+    block_size = 1024
+    # late points written over a block are merged into it once there are
+    # block_size // late_ratio of them: one decode and encode per that many puts
+    late_ratio = 4
+
+    def __init__(self):
+        # sealed history: first timestamp of every block and the blocks
+        self.starts = []
+        self.blocks = []
+        self.sealed_last = None
+        # block -> sorted (timestamps, values) of late points written over it
+        self.late = {}
+        self.timestamps = []
+        self.values = []
+        # (timestamp, value) of the newest point
+        self.latest = None
+
+    def put(self, timestamp, value):
+        timestamps = self.timestamps
+        if self.sealed_last is not None and timestamp <= self.sealed_last:
+            self._put_sealed(timestamp, value)
+        # metrics come mostly in time order, so a plain append is the fast path
+        elif not timestamps or timestamp > timestamps[-1]:
+            timestamps.append(timestamp)
+            self.values.append(value)
+            self.latest = timestamp, value
+            if len(timestamps) >= self.block_size:
+                self._seal()
+            return
+        else:
+            self._upsert(timestamps, self.values, timestamp, value)
+
+        # an older point can only rewrite the newest one
+        if timestamp == self.latest[0]:
+            self.latest = timestamp, value
+
+    @staticmethod
+    def _upsert(timestamps, values, timestamp, value):
+        i = bisect_left(timestamps, timestamp)
+        if i < len(timestamps) and timestamps[i] == timestamp:
+            values[i] = value
+        else:
+            timestamps.insert(i, timestamp)
+            values.insert(i, value)
+
+    def _put_sealed(self, timestamp, value):
+        # a late point waits uncompressed next to its block instead of decoding it
+        i = max(bisect_right(self.starts, timestamp) - 1, 0)
+        late = self.late.get(self.blocks[i])
+        if late is None:
+            late = self.late[self.blocks[i]] = [], []
+        self._upsert(*late, timestamp, value)
+        if len(late[0]) >= self.block_size // self.late_ratio:
+            self._merge(i)
+
+    def _merge(self, i):
+        """write the late points into block i, split it if it grew past twice block_size"""
+        timestamps, values = self._decoded(self.blocks[i], self.late.pop(self.blocks[i]))
+        count = max(len(timestamps) // self.block_size, 1)
+        bounds = [len(timestamps) * part // count for part in range(count + 1)]
+        self.blocks[i:i + 1] = [Block.encode(timestamps[left:right], values[left:right])
+                                for left, right in zip(bounds, bounds[1:])]
+        self.starts[i:i + 1] = [timestamps[left] for left in bounds[:-1]]
+
+    @classmethod
+    def _decoded(cls, block, late):
+        """points of a sealed block with its late points written over them"""
+        timestamps, values = block.decode()
+        if late is not None:
+            for timestamp, value in zip(*late):
+                cls._upsert(timestamps, values, timestamp, value)
+        return timestamps, values
+
+    def _seal(self):
+        self.blocks.append(Block.encode(array('q', self.timestamps), array('d', self.values)))
+        self.starts.append(self.timestamps[0])
+        self.sealed_last = self.timestamps[-1]
+        self.timestamps, self.values = [], []
+
+    def trim(self, before):
+        """drop points older than before, returns the bytes freed"""
+        freed = dropped = 0
+        for block in self.blocks:
+            late = self.late.get(block)
+            if block.last >= before or late is not None and late[0][-1] >= before:
+                break
+            freed += block.nbytes()
+            if late is not None:
+                freed += self._nbytes(*self.late.pop(block))
+            dropped += 1
+        del self.blocks[:dropped]
+        del self.starts[:dropped]
+
+        if self.blocks:
+            block = self.blocks[0]
+            late = self.late.get(block)
+            if block.first < before or late is not None and late[0][0] < before:
+                timestamps, values = self._decoded(block, self.late.pop(block, None))
+                i = bisect_left(timestamps, before)
+                self.blocks[0] = Block.encode(timestamps[i:], values[i:])
+                self.starts[0] = timestamps[i]
+                freed += block.nbytes() - self.blocks[0].nbytes()
+                if late is not None:
+                    freed += self._nbytes(*late)
+            return freed
+
+        self.sealed_last = None
+        i = bisect_left(self.timestamps, before)
+        freed += self._nbytes(self.timestamps[:i], self.values[:i])
+        del self.timestamps[:i]
+        del self.values[:i]
+        return freed
+
+    @staticmethod
+    def _nbytes(timestamps, values):
+        """bytes of points kept as python objects in lists"""
+        return sum(map(sys.getsizeof, timestamps)) + sum(map(sys.getsizeof, values)) \
+            + 16 * len(timestamps)
+
+    def __iter__(self):
+        for block in self.blocks:
+            yield from zip(*self._decoded(block, self.late.get(block)))
+        yield from zip(self.timestamps, self.values)
+
+    def range(self, start, end):
+        """points with start <= timestamp <= end, only the blocks in range are decoded"""
+        first = max(bisect_right(self.starts, start) - 1, 0)
+        last = max(bisect_right(self.starts, end), first + 1)
+        # blocks are taken now: a merge may replace them while the answer is written
+        blocks = [(block, self.late.get(block)) for block in self.blocks[first:last]]
+        for timestamps, values in chain((self._decoded(*block) for block in blocks),
+                                        [(self.timestamps, self.values)]):
+            left = bisect_left(timestamps, start)
+            right = bisect_right(timestamps, end)
+            yield from zip(timestamps[left:right], values[left:right])
+            if right < len(timestamps):
+                return
+
+    def __bool__(self):
+        return bool(self.blocks or self.timestamps)
+
+    def __len__(self):
+        # a late point may rewrite a sealed one, so they are merged before counting
+        for block in list(self.late):
+            self._merge(self.blocks.index(block))
+        return sum(map(len, self.blocks)) + len(self.timestamps)
+
+    def __repr__(self):
+        return repr([list(item) for item in self])
+
+
+
+def get_lines(recv_data):
+    """the get answer in pieces of GET_CHUNK points, produced as they are consumed"""
+    # get <key> [<from> <to>]
+    command_list = recv_data.split()
+    if len(command_list) not in (2, 4):
+        yield WRONG
+        return
+
+    key = command_list[1]    
+    try:
+        interval = [int(bound) for bound in command_list[2:]] or EVERYTHING
+    except ValueError:
+        yield WRONG
+        return
+
+    yield 'ok\n'
+    # a metric name, '*' or a glob like cpu.host42.*
+    for k in INDEX.match(key):
+        value = DATABASE.get(k)
+        if value is None:
+            continue
+        # range copies what it reads, so puts between pieces do not shift the points
+        points = value.range(*interval)
+        while True:
+            lines = ''.join(f'{k} {val} {timestamp}\n'
+                            for timestamp, val in islice(points, GET_CHUNK))
+            if not lines:
+                break
+            yield lines
+    yield '\n'
+
 def get_handler(recv_data):
+    return ''.join(get_lines(recv_data))
+
+def latest_handler(recv_data):
+    # latest <key>: the newest point of every matching metric, history is not read
     command_list = recv_data.split()
     if len(command_list) != 2:
         return WRONG
 
-    key = command_list[1]    
-    answer = 'ok\n'
-    for k, value in DATABASE.items():
-        if k == key or key == '*':
-            for val in value:
-                answer += f'{k} {val[1]} {val[0]}\n'
-    answer += '\n'
-    return answer    
+    lines = []
+    for k in INDEX.match(command_list[1]):
+        value = DATABASE.get(k)
+        if value is not None and value.latest is not None:
+            timestamp, val = value.latest
+            lines.append(f'{k} {val} {timestamp}\n')
+    return 'ok\n' + ''.join(lines) + '\n'
 
 def parse_request(recv_data):
+    if recv_data[:5] == 'mput ':
+        return mput_handler(recv_data)
+    if recv_data[:7] == 'latest ':
+        return latest_handler(recv_data)
     if len(recv_data) > 4 and (recv_data[:3] in ALLOWED or recv_data[:7] in ALLOWED): 
         if recv_data[:3] == ALLOWED[0]:
             return put_handler(recv_data)
@@ -41,26 +268,54 @@ def parse_request(recv_data):
         else:
             return WRONG
     else:    
+        return stats_handler(recv_data)
+
+def get_series(metric):
+    """TimeSeries of the metric, created and indexed on its first put"""
+    if metric not in DATABASE:
+        DATABASE[metric] = TimeSeries()
+        INDEX.add(metric)
+    return DATABASE[metric]
+
+def put_points(points):
+    """store parsed (metric, value, timestamp) points as one batch"""
+    if WAL is not None:
+        WAL.append_many(points)
+    for metric, value, timestamp in points:
+        get_series(metric).put(timestamp, value)
+    if WATCHERS.subscribers:
+        WATCHERS.publish(points)
+    return SUCCESS
+
+def mput_handler(recv_data):
+    # mput [atomic] <metric> <value> <timestamp> ...
+    # without atomic the valid points are stored and the bad ones reported
+    params = recv_data.split()[1:]
+    atomic = len(params) % 3 == 1 and params[0] == 'atomic'
+    if atomic:
+        params = params[1:]
+    if not params or len(params) % 3:
         return WRONG
 
+    points, rejected = [], 0
+    for i in range(0, len(params), 3):
+        metric, value, timestamp = params[i:i + 3]
+        try:
+            points.append((metric, float(value), int(timestamp)))
+        except ValueError:
+            rejected += 1
+
+    if rejected and atomic:
+        return WRONG
+    put_points(points)
+    return WRONG if rejected else SUCCESS
+
 def put_handler(recv_data):        
     try:
         metric, value, timestamp = recv_data.split()[1:]
-        if metric not in DATABASE.keys():
-            DATABASE[metric] = []            
-        
-        l = DATABASE.get(metric)
-        updated = False
-        for element in l:
-            if element[0] == int(timestamp):
-                element[1] = float(value)
-                updated = True
-        if not updated:
-            DATABASE[metric].append([int(timestamp), float(value)])
-
-        return SUCCESS
-    except Exception as e:
-        print(e)        
+        value, timestamp = float(value), int(timestamp)
+        return put_points([(metric, value, timestamp)])
+    except Exception:
         return WRONG    
 
 
@@ -69,9 +324,6 @@ async def handle_echo(reader, writer):
     recv_data = await reader.read(1024)
     client_answer = parse_request(recv_data.decode())
 
-    print(f'Received {recv_data} from {writer.get_extra_info("peername")}')
-    print(f'Send to client {client_answer.encode()}')
-    
     writer.write(client_answer.encode())
     await writer.drain()
     
@@ -82,21 +334,301 @@ async def handle_echo(reader, writer):
 def DATABASE_handler():
     return str(DATABASE)
 
+def stats_handler(recv_data):
+    # stats [on|off|reset]
+    command, *params = recv_data.split() or ['']
+    if command != 'stats':
+        return WRONG
+    try:
+        report = STATS.command(params)
+    except ValueError:
+        return WRONG
+    if report is not None:
+        report += WATCHERS.report()
+    now = int(time.time())
+    return 'ok\n' + ''.join(f'{name} {value} {now}\n' for name, value in report or ()) + '\n'
+
+
+
+def answer_lines(lines):
+    """
+    lazy answers to text commands; answer_lazily counts every command but put,
+    so the puts are the lines of the batch it did not count.
+    STATS times every sample-th command
+    """
+    if not STATS.enabled:
+        return list(map(answer_lazily, lines))
+    counts = STATS.counts
+    counted = sum(counts.values())
+    answers = list(map(answer_lazily, lines))
+    counts['put'] += len(lines) - (sum(counts.values()) - counted)
+    for number in STATS.sampled(len(lines)):
+        answers[number] = STATS.timed(STATS.kind(lines[number]), answers[number])
+    return answers
+
+def answer_points(points):
+    answer = deferred(put_points, points)
+    if STATS.enabled:
+        STATS.counts['points'] += len(points)
+        if STATS.sampled():
+            answer = STATS.timed('points', answer)
+    return answer
+
+def count_command(kind):
+    if STATS.enabled:
+        STATS.counts[kind] += 1
+
+def deferred(handler, *args):
+    """an answer computed only when it is about to be written"""
+    yield handler(*args)
+
+def answer_lazily(line):
+    """
+    the answer to one command as a generator of pieces; nothing runs until
+    it is consumed, so pipelined commands take effect in order
+    """
+    try:
+        recv_data = line.decode()
+    except UnicodeDecodeError:
+        count_command(OTHER)
+        return iter((WRONG,))
+    if recv_data[:4] == 'put ':
+        # most of the traffic, straight to its handler and counted in answer_lines
+        return deferred(put_handler, recv_data)
+    if len(recv_data) > 4 and recv_data[:3] == ALLOWED[1]:
+        count_command('get')
+        return get_lines(recv_data)
+    count_command(STATS.kind(line) or OTHER)
+    return deferred(parse_request, recv_data)
+
+
+
+def parse_frames(frames, keys):
+    """
+    lazy answers to binary.py frames as in answer_lazily,
+    keys maps the connection's key ids to metrics
+    """
+    answers = []
+    for kind, payload in frames:
+        if kind == binary.KEY:
+            # a bad declaration fails the batch that refers to its key id
+            try:
+                binary.declare(payload, keys)
+            except (ValueError, struct.error):
+                pass
+        elif kind == binary.POINTS:
+            try:
+                answers.append(answer_points(binary.points(payload, keys)))
+            except (ValueError, KeyError):
+                answers.append(iter((WRONG,)))
+        elif kind == binary.TEXT:
+            answers.extend(answer_lines([payload]))
+        else:
+            answers.append(iter((WRONG,)))
+    return answers
+
 
 
 class ClientServerProtocol(asyncio.Protocol):
+    """
+    commands are framed by newlines: a packet may carry a partial command
+    or many pipelined ones, they are answered in order;
+    after the binary command the connection carries binary.py frames instead,
+    after watch it only receives the new points of its patterns (watch.py)
+
+    answers are written while the transport buffer stays under buffer_limit:
+    past it the transport calls pause_writing, answering and reading stop
+    until resume_writing, so a slow reader holds a bounded amount of memory
+    """
+
+    # high-water mark of the transport write buffer, bytes
+    buffer_limit = 64 * 1024
+    # answers written per event loop iteration before yielding to other clients
+    chunk_size = 64 * 1024
+    # commands waiting for an answer before the connection stops reading
+    max_pending = 1024
+    # a command without a newline longer than this closes the connection
+    max_request = 16 * 1024 * 1024
+
     def data_received(self, data):
-        resp = parse_request(data.decode())
-        self.transport.write(resp.encode())
+        if STATS.enabled:
+            STATS.bytes_in += len(data)
+        if self.subscriber is not None:
+            return
+        buffer = self.buffer
+        buffer += data
+
+        if not self.binary:
+            end = buffer.rfind(b'\n')
+            if end < 0:
+                if len(buffer) > self.max_request:
+                    self.transport.close()
+                return
+
+            lines = buffer[:end].split(b'\n')
+            # a watch line is rare, so look for it in the whole batch first
+            watch = buffer.find(b'watch ', 0, end) >= 0 and next(
+                (line for line in lines if line[:6] == b'watch ' and len(line.split()) > 1), None)
+            if watch:
+                self.answers.extend(answer_lines(lines[:lines.index(watch)]))
+                self.answers.append(self.watch(watch))
+                buffer.clear()
+                if not self.writing:
+                    self.write_answers()
+                return
+            if binary.NEGOTIATE in lines:
+                lines = lines[:lines.index(binary.NEGOTIATE)]
+                end = sum(len(line) + 1 for line in lines) + len(binary.NEGOTIATE)
+                self.binary = True
+                self.answers.extend(answer_lines(lines))
+                self.answers.append(iter((SUCCESS,)))
+            else:
+                self.answers.extend(answer_lines(lines))
+            del buffer[:end + 1]
+
+        if self.binary:
+            try:
+                self.answers.extend(parse_frames(binary.frames(buffer), self.keys))
+            except ValueError:
+                self.transport.close()
+                return
+
+        if not self.writing:
+            self.write_answers()
+
+    def watch(self, line):
+        """
+        the answer to watch <pattern> ...: the connection is subscribed when
+        it is consumed and the points are pushed once the answer is written
+        """
+        try:
+            patterns = line.decode().split()[1:]
+        except UnicodeDecodeError:
+            patterns = None
+        if not patterns:
+            yield WRONG
+            return
+        self.subscriber = WATCHERS.subscribe(patterns, self.transport)
+        self.subscriber.pause()
+        yield SUCCESS
+        asyncio.get_event_loop().call_soon(self.resume_subscriber)
+
+    def resume_subscriber(self):
+        if not self.paused and not self.answers:
+            self.subscriber.resume()
+
+    def write_answers(self):
+        """write about chunk_size bytes of answers, the rest on the next loop iteration"""
+        self.writing = False
+        if self.paused:
+            return
+
+        pieces, size = [], 0
+        while self.answers and size < self.chunk_size:
+            piece = next(self.answers[0], None)
+            if piece is None:
+                self.answers.popleft()
+                continue
+            pieces.append(piece.encode())
+            size += len(pieces[-1])
+        self.transport.writelines(pieces)
+        if STATS.enabled:
+            STATS.bytes_out += size
+
+        if self.answers and not self.paused:
+            self.writing = True
+            asyncio.get_event_loop().call_soon(self.write_answers)
+        self.update_reading()
+
+    def update_reading(self):
+        reading = not self.paused and len(self.answers) < self.max_pending
+        if reading != self.reading and not self.transport.is_closing():
+            self.reading = reading
+            if reading:
+                self.transport.resume_reading()
+            else:
+                self.transport.pause_reading()
+
+    def pause_writing(self):
+        self.paused = True
+        if self.subscriber is not None:
+            self.subscriber.pause()
+        self.update_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        if not self.writing:
+            self.write_answers()
+        if self.subscriber is not None:
+            self.resume_subscriber()
         
     def connection_made(self, transport):
         self.transport = transport
+        transport.set_write_buffer_limits(self.buffer_limit)
+        self.buffer = bytearray()
+        self.binary = False
+        self.keys = {}
+        # watch.Subscriber once the connection is a watch subscription
+        self.subscriber = None
+        # iterators of answer pieces in the order of the commands
+        self.answers = deque()
+        self.writing = False
+        self.paused = False
+        self.reading = True
+        STATS.connections += 1
+
+    def connection_lost(self, exc):
+        self.answers.clear()
+        STATS.connections -= 1
+        if self.subscriber is not None:
+            WATCHERS.unsubscribe(self.subscriber)
+
+
+
+async def expire(policy, interval=60, time_slice=0.005):
+    """
+    background retention of DATABASE by retention.RetentionPolicy: every interval
+    seconds expired points are trimmed, the loop is yielded after each time_slice
+    seconds of work so requests keep being served
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        now = int(time.time())
+        freed = 0
+        deadline = loop.time() + time_slice
+        for metric in list(DATABASE):
+            limits = policy.match(metric)
+            if limits is not None:
+                series = DATABASE[metric]
+                freed += series.trim(now - limits[0])
+                if not series:
+                    del DATABASE[metric]
+                    INDEX.discard(metric)
+
+            if loop.time() >= deadline:
+                await asyncio.sleep(0)
+                deadline = loop.time() + time_slice
+
+        if freed:
+            logging.info('retention reclaimed %d bytes', freed)
+        await asyncio.sleep(interval)
 
 
 
-def run_server(host, port):        
+def run_server(host, port, wal=None, retention=None):        
+    global WAL
     
     loop = asyncio.get_event_loop()
+    if wal is not None:
+        for metric, value, timestamp in wal.replay():
+            get_series(metric).put(timestamp, value)
+        wal.open(loop)
+        WAL = wal
+
+    # retention.RetentionPolicy: only raw points are kept here, so its rollup limit is unused
+    if retention:
+        task = loop.create_task(expire(retention))
+
     coro = loop.create_server(ClientServerProtocol, host, port)
     server = loop.run_until_complete(coro)
 
@@ -107,4 +639,9 @@ def run_server(host, port):
 
     server.close()
     loop.run_until_complete(server.wait_closed())
+    if retention:
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+    if wal is not None:
+        loop.run_until_complete(wal.close())
     loop.close()    
@@ -1,55 +1,1681 @@
+import argparse
 import asyncio
-from collections import defaultdict
-from copy import deepcopy
+import heapq
+import logging
+import math
+import os
+import sqlite3
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+
+import binary
+from cache import ResponseCache
+from gorilla import Block
+from keyindex import KeyIndex
+from replication import REPLICATE, Follower, Leader
+from retention import RetentionPolicy, RetentionTask
+from segment import Segment, segment_files, segment_path
+from snapshot import Snapshotter
+from stats import OTHER, TEXT_COMMANDS, Stats
+from wal import WriteAheadLog
+from watch import Watchers
 
 
 class StorageDriverError(ValueError):
     pass
 
 
+# формат снимка хранилища: заголовок (сигнатура, сегмент журнала, число файлов
+# сегментов, число ключей, число границ устаревания), имена файлов сегментов,
+# границы устаревания ключей (имя и метка), затем для каждого ключа имя,
+# блоки головы, rollup и сводка ряда; массивы в порядке байт машины.
+# Блок: число точек, размер сжатых данных (0 - несжатый), первая и последняя метки
+SNAPSHOT_HEADER = struct.Struct('<8sQQQQ')
+SNAPSHOT_NAME = struct.Struct('<H')
+SNAPSHOT_HORIZON = struct.Struct('<Hq')
+SNAPSHOT_KEY = struct.Struct('<HB')
+SNAPSHOT_SERIES = struct.Struct('<Q')
+SNAPSHOT_BLOCK = struct.Struct('<IIqq')
+SNAPSHOT_ROLLUP = struct.Struct('<qQ')
+# сводка: число точек, сумма, сумма квадратов, min, max, первая и последняя метки
+SNAPSHOT_SUMMARY = struct.Struct('<Qddddqq')
+# есть ли у ключа точки, метка и значение самой новой из них
+SNAPSHOT_LATEST = struct.Struct('<?qd')
+SNAPSHOT_MAGIC = b'METRICS6'
+
+# схема SQLiteStorage: точки в таблице без rowid, упорядоченной по (key, ts),
+# так что чтение интервала ключа - просмотр диапазона первичного ключа
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS points (
+    key TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (key, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY) WITHOUT ROWID;
+"""
+# LIMIT -1 - без ограничения
+SQLITE_RANGE = ('SELECT ts, value FROM points WHERE key = ? AND ts BETWEEN ? AND ? '
+                'ORDER BY ts LIMIT ?')
+SQLITE_LATEST = 'SELECT ts, value FROM points WHERE key = ? ORDER BY ts DESC LIMIT 1'
+SQLITE_SUMMARY = ('SELECT count(*), total(value), total(value * value), min(value), max(value), '
+                  'min(ts), max(ts) FROM points WHERE key = ?')
+# начало интервала - ts, округленная вниз до кратного step, как ts - ts % step в Python
+SQLITE_BUCKETS = ('SELECT ts - ((ts % :step) + :step) % :step AS bucket, count(*), total(value), '
+                  'min(value), max(value) FROM points '
+                  'WHERE key = :key AND ts BETWEEN :start AND :end GROUP BY bucket ORDER BY bucket')
+# границы меток int64 для чтения без интервала
+MIN_TIMESTAMP, MAX_TIMESTAMP = -2 ** 63, 2 ** 63 - 1
+
+logger = logging.getLogger('storage')
+
+
+# функции агрегации команды agg над (count, sum, min, max) интервала
+AGGREGATES = {
+    'avg': lambda count, total, low, high: total / count,
+    'min': lambda count, total, low, high: low,
+    'max': lambda count, total, low, high: high,
+    'sum': lambda count, total, low, high: total,
+    'count': lambda count, total, low, high: count,
+}
+
+
+class Series:
+    """Временной ряд одной метрики.
+
+    Точки лежат блоками: метки времени в array('q'), значения в array('d'),
+    то есть 16 байт на точку без объектов int/float и слотов словаря.
+    Заполненные блоки сжимаются в gorilla.Block, у регулярных метрик это около
+    байта на точку, и распаковываются только при чтении. Последний блок,
+    в который дописываются новые точки, всегда несжатый.
+    Блоки упорядочены по времени и не пересекаются, внутри блока точки отсортированы,
+    поэтому чтению никогда не нужно ничего сортировать.
+
+    Точки, пришедшие не по порядку, вставляются на свое место бинарным поиском.
+    Заполненный блок остается несжатым, пока новые точки не уйдут от его конца
+    дальше чем на lateness, и сжимается один раз, когда из него вышло окно
+    опоздания: опоздавшая в пределах окна точка стоит вставки в массив. Более
+    поздняя точка распаковывает сжатый блок, который сжимается заново позже.
+    """
+
+    # точек в блоке, после которых дописывание открывает новый; вставками блок растет вдвое
+    block_size = 1024
+    # окно опоздания в единицах меток времени
+    lateness = 60
+
+    def __init__(self):
+        # первая метка каждого блока, по ним bisect находит нужный блок
+        self._starts = []
+        self._blocks = []
+        self._len = 0
+        # после этой метки из какого-то несжатого блока выйдет окно опоздания;
+        # распакованные записью в середину блоки сжимаются вместе с очередным заполненным
+        self._seal_at = math.inf
+        # последний распакованный сжатый блок: чтение обращается к нему несколько раз подряд
+        self._decoded = None, None
+        # самая новая записанная метка
+        self.newest = None
+
+    def put(self, timestamp, value):
+        """Записывает точку, возвращает прежнее значение для этой метки или None"""
+
+        blocks = self._blocks
+
+        # метрики почти всегда приходят по возрастанию времени: дописываем в конец
+        if not blocks or timestamp > blocks[-1][0][-1]:
+            if not blocks or len(blocks[-1][0]) >= self.block_size:
+                blocks.append((array('q'), array('d')))
+                self._starts.append(timestamp)
+                if len(blocks) > 1:
+                    self._seal(timestamp)
+            elif timestamp > self._seal_at:
+                self._seal(timestamp)
+            timestamps, values = blocks[-1]
+            timestamps.append(timestamp)
+            values.append(value)
+            self._len += 1
+            self.newest = timestamp
+            return None
+
+        index = max(bisect_right(self._starts, timestamp) - 1, 0)
+        timestamps, values = self._thaw(index)
+        position = bisect_left(timestamps, timestamp)
+
+        # last-write-wins: значение для уже известной метки перезаписывается
+        if position < len(timestamps) and timestamps[position] == timestamp:
+            previous = values[position]
+            values[position] = value
+            return previous
+
+        timestamps.insert(position, timestamp)
+        values.insert(position, value)
+        self._starts[index] = timestamps[0]
+        self._len += 1
+
+        # опоздавшие точки не дробят только что заполненный блок: делится вдвое переросший
+        if len(timestamps) > 2 * self.block_size:
+            self._split(index)
+        return None
+
+    def _split(self, index):
+        timestamps, values = self._blocks[index]
+        middle = len(timestamps) // 2
+        self._blocks.insert(index + 1, (timestamps[middle:], values[middle:]))
+        self._starts.insert(index + 1, timestamps[middle])
+        del timestamps[middle:]
+        del values[middle:]
+
+    def _seal(self, newest):
+        """Сжимает несжатые блоки, кроме последнего, из которых вышло окно опоздания"""
+
+        blocks, horizon = self._blocks, newest - self.lateness
+        self._seal_at = math.inf
+        for index in range(len(blocks) - 1):
+            block = blocks[index]
+            if isinstance(block, Block):
+                continue
+            last = block[0][-1]
+            if last < horizon:
+                blocks[index] = Block.encode(*block)
+            else:
+                self._seal_at = min(self._seal_at, last + self.lateness)
+
+    def _block(self, index):
+        """(timestamps, values) блока, сжатый блок распаковывается"""
+
+        block = self._blocks[index]
+        if not isinstance(block, Block):
+            return block
+        if self._decoded[0] is not block:
+            self._decoded = block, block.decode()
+        return self._decoded[1]
+
+    def _thaw(self, index):
+        """(timestamps, values) блока для изменения: сжатый блок заменяется распакованным"""
+
+        block = self._blocks[index]
+        if isinstance(block, Block):
+            block = self._blocks[index] = self._block(index)
+            self._decoded = None, None
+        return block
+
+    def _last(self, index):
+        block = self._blocks[index]
+        return block.last if isinstance(block, Block) else block[0][-1]
+
+    def _size(self, index):
+        block = self._blocks[index]
+        return block.count if isinstance(block, Block) else len(block[0])
+
+    def items(self):
+        """Пары (timestamp, value) по возрастанию времени"""
+        for timestamps, values in self.chunks():
+            yield from zip(timestamps, values)
+
+    def chunks(self, start=None, end=None):
+        """Срезы блоков (timestamps, values) по возрастанию времени.
+
+        start и end ограничивают метки времени включительно, границы находятся
+        бинарным поиском, так что стоимость зависит от числа отданных точек.
+        Между шагами ряд может измениться, поэтому следующий срез ищется заново
+        по последней отданной метке: точки не повторяются и блоки не пропускаются.
+        """
+
+        if start is None or not self._blocks:
+            index, position = 0, 0
+        else:
+            index = max(bisect_right(self._starts, start) - 1, 0)
+            position = bisect_left(self._block(index)[0], start)
+
+        while index < len(self._blocks):
+            timestamps, values = self._block(index)
+            stop = len(timestamps) if end is None else bisect_right(timestamps, end)
+            if position < stop:
+                last = timestamps[stop - 1]
+                yield timestamps[position:stop], values[position:stop]
+
+                index = max(bisect_right(self._starts, last) - 1, 0)
+                position = bisect_right(self._block(index)[0], last)
+            elif stop < len(timestamps):
+                return
+            else:
+                index, position = index + 1, 0
+
+    def bounds(self, start=None, end=None):
+        """Первая и последняя метки ряда в [start, end] или None.
+
+        Сжатые блоки распаковываются, только если граница попадает внутрь блока.
+        """
+
+        starts = self._starts
+        if not starts:
+            return None
+
+        if start is None:
+            first = starts[0]
+        else:
+            index = max(bisect_right(starts, start) - 1, 0)
+            if start <= starts[index]:
+                first = starts[index]
+            elif start <= self._last(index):
+                timestamps = self._block(index)[0]
+                first = timestamps[bisect_left(timestamps, start)]
+            elif index + 1 < len(starts):
+                first = starts[index + 1]
+            else:
+                return None
+
+        if end is None:
+            last = self._last(-1)
+        else:
+            index = bisect_right(starts, end) - 1
+            if index < 0:
+                return None
+            last = self._last(index)
+            if end < last:
+                timestamps = self._block(index)[0]
+                last = timestamps[bisect_right(timestamps, end) - 1]
+
+        return (first, last) if first <= last else None
+
+    def lookup(self, timestamp):
+        """Значение для метки timestamp или None"""
+
+        if not self._blocks:
+            return None
+
+        index = max(bisect_right(self._starts, timestamp) - 1, 0)
+        if timestamp > self._last(index):
+            return None
+        timestamps, values = self._block(index)
+        position = bisect_left(timestamps, timestamp)
+        if position < len(timestamps) and timestamps[position] == timestamp:
+            return values[position]
+        return None
+
+    def trim(self, before):
+        """Удаляет точки с метками меньше before: сначала целые блоки, затем начало первого"""
+
+        blocks = self._blocks
+        dropped = 0
+        while dropped < len(blocks) and self._last(dropped) < before:
+            self._len -= self._size(dropped)
+            dropped += 1
+        del blocks[:dropped]
+        del self._starts[:dropped]
+
+        if blocks and self._starts[0] < before:
+            timestamps, values = self._thaw(0)
+            position = bisect_left(timestamps, before)
+            del timestamps[:position]
+            del values[:position]
+            self._starts[0] = timestamps[0]
+            self._len -= position
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """Ряд из срезов (timestamps, values) по возрастанию времени"""
+
+        series = cls()
+        for timestamps, values in chunks:
+            for timestamp, value in zip(timestamps, values):
+                series.put(timestamp, value)
+        return series
+
+    def dump(self, file):
+        """Пишет метки всех блоков, затем значения: по 8 * len(self) байт"""
+
+        values = []
+        for index in range(len(self._blocks)):
+            block_timestamps, block_values = self._block(index)
+            file.write(block_timestamps)
+            values.append(block_values)
+        for block_values in values:
+            file.write(block_values)
+
+    def pack(self, file):
+        """Пишет блоки как есть: сжатые - байтами gorilla, несжатые - массивами"""
+
+        file.write(SNAPSHOT_SERIES.pack(len(self._blocks)))
+        for block in self._blocks:
+            if isinstance(block, Block):
+                file.write(SNAPSHOT_BLOCK.pack(block.count, len(block.data), block.first, block.last))
+                file.write(block.data)
+            else:
+                timestamps, values = block
+                file.write(SNAPSHOT_BLOCK.pack(len(timestamps), 0, timestamps[0], timestamps[-1]))
+                file.write(timestamps)
+                file.write(values)
+
+    @classmethod
+    def unpack(cls, buffer, offset):
+        """Ряд из буфера в формате pack и смещение за ним"""
+
+        series = cls()
+        blocks, = SNAPSHOT_SERIES.unpack_from(buffer, offset)
+        offset += SNAPSHOT_SERIES.size
+
+        for _ in range(blocks):
+            count, size, first, last = SNAPSHOT_BLOCK.unpack_from(buffer, offset)
+            offset += SNAPSHOT_BLOCK.size
+            if size:
+                block = Block(first, last, count, bytes(buffer[offset:offset + size]))
+                offset += size
+            else:
+                block = array('q'), array('d')
+                block[0].frombytes(buffer[offset:offset + count * 8])
+                block[1].frombytes(buffer[offset + count * 8:offset + count * 16])
+                offset += count * 16
+            series._blocks.append(block)
+            series._starts.append(first)
+            series._len += count
+
+        # последний блок должен быть несжатым, чтобы в него можно было дописывать
+        if series._blocks:
+            series._thaw(-1)
+            series.newest = series._blocks[-1][0][-1]
+        return series, offset
+
+    def copy(self):
+        """Независимая копия ряда: сжатые блоки неизменяемы и делятся с оригиналом"""
+
+        series = Series()
+        series._starts = list(self._starts)
+        series._blocks = [block if isinstance(block, Block) else (block[0][:], block[1][:])
+                          for block in self._blocks]
+        series._len = self._len
+        series._seal_at = self._seal_at
+        series.newest = self.newest
+        return series
+
+    def nbytes(self):
+        """Память, занятая блоками ряда"""
+        return sum(block.nbytes() if isinstance(block, Block)
+                   else sys.getsizeof(block[0]) + sys.getsizeof(block[1])
+                   for block in self._blocks)
+
+    def __len__(self):
+        return self._len
+
+
+class Rollup:
+    """Агрегаты ряда (count, sum, min, max) по интервалам фиксированной ширины.
+
+    Обновляется на каждом put, так что agg читает готовые интервалы, а не сырые точки.
+    Интервалы выровнены по width и хранятся в параллельных array по возрастанию начала.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.starts = array('q')
+        self.counts = array('q')
+        self.sums = array('d')
+        self.mins = array('d')
+        self.maxs = array('d')
+
+    def add(self, timestamp, value):
+        """Учитывает новую точку ряда"""
+
+        bucket = timestamp - timestamp % self.width
+        starts = self.starts
+
+        if starts and bucket <= starts[-1]:
+            index = bisect_left(starts, bucket)
+            if starts[index] == bucket:
+                self.counts[index] += 1
+                self.sums[index] += value
+                self.mins[index] = min(self.mins[index], value)
+                self.maxs[index] = max(self.maxs[index], value)
+                return
+        else:
+            index = len(starts)
+
+        starts.insert(index, bucket)
+        self.counts.insert(index, 1)
+        self.sums.insert(index, value)
+        self.mins.insert(index, value)
+        self.maxs.insert(index, value)
+
+    def replace(self, timestamp, previous, value, chunks):
+        """Учитывает перезапись значения точки previous -> value.
+
+        chunks(start, end) - срезы (timestamps, values) всех точек ряда в интервале.
+        """
+
+        bucket = timestamp - timestamp % self.width
+        index = bisect_left(self.starts, bucket)
+        self.sums[index] += value - previous
+
+        # прежнее значение было экстремумом интервала: пересчитываем по сырым точкам
+        if previous == self.mins[index] or previous == self.maxs[index]:
+            values = [value for _, values in chunks(bucket, bucket + self.width - 1)
+                      for value in values]
+            self.mins[index] = min(values)
+            self.maxs[index] = max(values)
+        else:
+            self.mins[index] = min(self.mins[index], value)
+            self.maxs[index] = max(self.maxs[index], value)
+
+    def trim(self, before):
+        """Удаляет интервалы, целиком лежащие до before, возвращает освобожденные байты"""
+
+        count = bisect_right(self.starts, before - self.width)
+        if not count:
+            return 0
+
+        size = sum(sys.getsizeof(column) for column in self.columns())
+        for column in self.columns():
+            del column[:count]
+        return size - sum(sys.getsizeof(column) for column in self.columns())
+
+    def columns(self):
+        return self.starts, self.counts, self.sums, self.mins, self.maxs
+
+    def copy(self):
+        rollup = Rollup(self.width)
+        for column, source in zip(rollup.columns(), self.columns()):
+            column.extend(source)
+        return rollup
+
+    def dump(self, file):
+        file.write(SNAPSHOT_ROLLUP.pack(self.width, len(self.starts)))
+        for column in self.columns():
+            file.write(column)
+
+    @classmethod
+    def load(cls, buffer, offset):
+        """Rollup из буфера в формате dump и смещение за ним"""
+
+        width, size = SNAPSHOT_ROLLUP.unpack_from(buffer, offset)
+        offset += SNAPSHOT_ROLLUP.size
+        rollup = cls(width)
+        for column in rollup.columns():
+            column.frombytes(buffer[offset:offset + size * 8])
+            offset += size * 8
+        return rollup, offset
+
+    def items(self, start, end):
+        """Интервалы (start, count, sum, min, max), начало которых лежит в [start, end]"""
+
+        left = bisect_left(self.starts, start)
+        right = bisect_right(self.starts, end)
+        return zip(self.starts[left:right], self.counts[left:right], self.sums[left:right],
+                   self.mins[left:right], self.maxs[left:right])
+
+
+class Summary:
+    """Сводка всего ряда: число точек, сумма, сумма квадратов, min, max, первая и последняя метки.
+
+    Как и Rollup, обновляется на каждом put: перезапись поправляет сумму и сумму
+    квадратов, а экстремумы пересчитываются по сырым точкам, только если
+    перезаписан сам экстремум.
+    """
+
+    __slots__ = ('count', 'sum', 'squares', 'min', 'max', 'first', 'last')
+
+    def __init__(self, chunks=()):
+        """Сводка точек из срезов (timestamps, values) по возрастанию времени"""
+
+        self._clear()
+        for timestamps, values in chunks:
+            self._extend(values)
+            if self.first is None:
+                self.first = timestamps[0]
+            self.last = timestamps[-1]
+
+    def _clear(self):
+        self.count, self.sum, self.squares = 0, 0.0, 0.0
+        self.min, self.max = math.inf, -math.inf
+        self.first = self.last = None
+
+    def _extend(self, values):
+        self.count += len(values)
+        self.sum += sum(values)
+        self.squares += sum(value * value for value in values)
+        self.min = min(self.min, min(values))
+        self.max = max(self.max, max(values))
+
+    def add(self, timestamp, value):
+        """Учитывает новую точку ряда"""
+
+        self.count += 1
+        self.sum += value
+        self.squares += value * value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if self.first is None or timestamp < self.first:
+            self.first = timestamp
+        if self.last is None or timestamp > self.last:
+            self.last = timestamp
+
+    def replace(self, previous, value, chunks):
+        """Учитывает перезапись значения точки previous -> value.
+
+        chunks() - срезы (timestamps, values) всех точек ряда.
+        """
+
+        self.sum += value - previous
+        self.squares += value * value - previous * previous
+        if previous == self.min or previous == self.max:
+            self._extremes(chunks())
+        else:
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+    def remove(self, removed, remaining):
+        """Вычитает устаревшие точки срезов removed; remaining() - срезы оставшихся точек"""
+
+        extreme = False
+        for _, values in removed:
+            self.count -= len(values)
+            self.sum -= sum(values)
+            self.squares -= sum(value * value for value in values)
+            extreme = extreme or min(values) <= self.min or max(values) >= self.max
+
+        chunks = remaining()
+        first = next(chunks, None)
+        if first is None:
+            self._clear()
+            return
+        self.first = first[0][0]
+        if extreme:
+            self._extremes(chain((first,), chunks))
+
+    def _extremes(self, chunks):
+        self.min, self.max = math.inf, -math.inf
+        for _, values in chunks:
+            self.min = min(self.min, min(values))
+            self.max = max(self.max, max(values))
+
+    def copy(self):
+        summary = Summary()
+        for name in self.__slots__:
+            setattr(summary, name, getattr(self, name))
+        return summary
+
+    def fields(self):
+        """Пары (поле, значение)"""
+        return (('count', self.count), ('sum', self.sum), ('sum_squares', self.squares),
+                ('min', self.min), ('max', self.max), ('first', self.first), ('last', self.last))
+
+    def dump(self, file):
+        file.write(SNAPSHOT_SUMMARY.pack(self.count, self.sum, self.squares, self.min, self.max,
+                                         self.first or 0, self.last or 0))
+
+    @classmethod
+    def load(cls, buffer, offset):
+        """Сводка из буфера в формате dump и смещение за ней"""
+
+        summary = cls()
+        (summary.count, summary.sum, summary.squares, summary.min, summary.max,
+         first, last) = SNAPSHOT_SUMMARY.unpack_from(buffer, offset)
+        if summary.count:
+            summary.first, summary.last = first, last
+        return summary, offset + SNAPSHOT_SUMMARY.size
+
+
 class Storage:
-    """Класс для хранения метрик в памяти процесса"""
+    """Класс для хранения метрик в памяти процесса.
+
+    Новые точки пишутся в голову - ряды Series в памяти. Когда в голове набирается
+    head_limit точек, вызывается on_full, и владелец хранилища (Snapshotter)
+    запечатывает голову в неизменяемый сегмент на диске, открытый через mmap.
+    Чтение сливает сегменты с головой, при совпадении меток побеждает более новая запись.
+
+    expire обрезает устаревшие точки головы и интервалы rollup, а в сегментах
+    только скрывает их от чтения: место на диске освобождает replace_segment.
+
+    Изменения нумеруются (version): для каждого ключа помнится номер последнего
+    изменения его точек, для набора ключей - номер последнего добавления или
+    удаления ключа. По ним кэш ответов (cache.py) узнает, что ответ устарел.
+
+    Самая новая точка ключа для команды latest и сводка Summary для команды summary,
+    как и rollup, ведутся с первого put и хранятся в снимке: запросы не читают историю.
+    """
+
+    # ширина интервалов предрасчитанных агрегатов, секунды
+    rollup_widths = (60, 3600)
+    # размер головы в точках, после которого ее пора запечатать; None - не запечатывать
+    head_limit = None
 
     def __init__(self):
-        self._data = defaultdict(dict)
+        self._data = defaultdict(Series)
+        # rollup заводятся для каждого ключа, поэтому служат и реестром всех ключей
+        self._rollups = defaultdict(lambda: [Rollup(width) for width in self.rollup_widths])
+        # ключи _rollups по порядку для запросов по шаблону
+        self._index = KeyIndex()
+        self._head_points = 0
+        # сегменты на диске от старых к новым и голова, которая сейчас запечатывается
+        self._segments = []
+        self._frozen = None
+        # последняя метка каждого ключа в сегментах и запечатываемой голове
+        self._sealed_last = {}
+        # метка, раньше которой точки ключа устарели и не читаются
+        self._horizons = {}
+        # выведенные сегменты, файлы которых еще может упоминать последний снимок
+        self._retired = []
+        self._segment_number = None
+        self.segment_directory = '.'
+        self.on_full = None
+        # номер последнего изменения хранилища, ключа и набора ключей; ключ без номера
+        # не менялся с последней очистки хранилища
+        self._version = 0
+        self._versions = {}
+        self._keys_version = 0
+        self._cleared = 0
+        # ключ -> (метка, значение) самой новой точки; как и сводка, ведется с первого put
+        self._latest = {}
+        # ключ -> Summary всех точек ключа; как и rollup, ведется с первого put
+        self._summaries = defaultdict(Summary)
+        self.reset_stats()
+
+    def reset_stats(self):
+        # точки, пришедшие не по порядку в пределах окна опоздания и позже него
+        self.reordered = 0
+        self.late = 0
+
+    def report(self):
+        """Пары (имя, значение) для ответа на stats"""
+        return [('storage.reordered', self.reordered), ('storage.late', self.late)]
 
     def put(self, key, value, timestamp):
-        self._data[key][timestamp] = value
+        # точка старше срока хранения устарела бы на следующем проходе retention
+        if timestamp < self._horizons.get(key, timestamp):
+            return
+
+        self._version += 1
+        self._versions[key] = self._version
+        if key not in self._rollups:
+            self._index.add(key)
+            self._keys_version = self._version
+
+        series = self._data[key]
+        size = len(series)
+        previous = series.put(timestamp, value)
+        self._head_points += len(series) - size
+
+        latest = self._latest.get(key)
+        if latest is None or timestamp >= latest[0]:
+            self._latest[key] = timestamp, value
+
+        # точка могла уже лежать в сегменте: тогда это перезапись, а не новая точка
+        last = self._sealed_last.get(key)
+        sealed = last is not None and timestamp <= last
+        if previous is None and sealed:
+            previous = self._sealed_value(key, timestamp)
+
+        # точка не по порядку: в окне опоздания она дешево вставлена в несжатый блок,
+        # а более поздняя распаковала сжатый блок или легла поверх сегмента
+        if timestamp < series.newest or sealed:
+            if sealed or timestamp < series.newest - series.lateness:
+                self.late += 1
+            else:
+                self.reordered += 1
+
+        for rollup in self._rollups[key]:
+            if previous is None:
+                rollup.add(timestamp, value)
+            else:
+                rollup.replace(timestamp, previous, value, partial(self._chunks, key))
+
+        summary = self._summaries[key]
+        if previous is None:
+            summary.add(timestamp, value)
+        else:
+            summary.replace(previous, value, partial(self._chunks, key))
+
+        if self.head_limit and self._head_points >= self.head_limit \
+                and self._frozen is None and self.on_full is not None:
+            self.on_full()
+
+    @property
+    def head_points(self):
+        return self._head_points
 
-    def get(self, key):
+    @property
+    def version(self):
+        return self._version
 
-        if key == '*':
-            return deepcopy(self._data)
+    def changed(self, key, since, pattern=False):
+        """Менялся ли ответ на get ключа key после изменения номер since.
 
+        pattern - key шаблон, и ответ зависит еще и от набора ключей.
+        """
+
+        if self._version <= since:
+            return False
+        versions = self._versions
+        if not pattern:
+            return versions.get(key, self._cleared) > since
+        if self._keys_version > since:
+            return True
+        return any(versions.get(name, self._cleared) > since for name in self._keys(key))
+
+    def freeze(self):
+        """Отделяет текущую голову для записи в сегмент, новые put идут в пустую голову"""
+
+        self._frozen, self._data = self._data, defaultdict(Series)
+        self._head_points = 0
+        for key, series in self._frozen.items():
+            self._seal_bounds(key, series)
+        return self._frozen
+
+    def attach(self, path):
+        """Подключает сегмент, записанный из отделенной головы"""
+        self._segments.append(Segment(path))
+        self._frozen = None
+
+    def thaw(self):
+        """Возвращает отделенную голову в память, если сегмент записать не удалось"""
+
+        frozen, self._frozen = self._frozen, None
+        for key, series in frozen.items():
+            head = self._data[key]
+            for timestamps, values in series.chunks():
+                for timestamp, value in zip(timestamps, values):
+                    if head.lookup(timestamp) is None:
+                        head.put(timestamp, value)
+        self._head_points = sum(len(series) for series in self._data.values())
+
+    def segment_paths(self):
+        return [segment.path for segment in self._segments]
+
+    def segments(self):
+        return list(self._segments)
+
+    def new_segment_path(self):
+        """Путь для нового файла сегмента, номера не повторяются"""
+
+        if self._segment_number is None:
+            numbers = (int(path.rsplit('.', 1)[1]) for path in segment_files(self.segment_directory))
+            self._segment_number = max(numbers, default=0)
+        self._segment_number += 1
+        return segment_path(self.segment_directory, self._segment_number)
+
+    def replace_segment(self, segment, path):
+        """Заменяет сегмент уплотненной копией из файла path или выводит его, если path None.
+
+        Файл прежнего сегмента удаляет remove_retired после следующего снимка.
+        """
+
+        index = self._segments.index(segment)
+        if path is None:
+            del self._segments[index]
+        else:
+            self._segments[index] = Segment(path)
+        self._retired.append(segment.path)
+
+        # ключ, которого больше нигде нет, не нуждается в границах
+        for key in segment.keys():
+            if key not in self._rollups and not any(key in stored for stored in self._segments):
+                self._horizons.pop(key, None)
+                self._sealed_last.pop(key, None)
+
+    def remove_retired(self, keep=()):
+        """Удаляет файлы выведенных сегментов, кроме упомянутых в снимке keep"""
+
+        keep = {os.path.basename(name) for name in keep}
+        retired, self._retired = self._retired, []
+        for path in retired:
+            if os.path.basename(path) in keep:
+                self._retired.append(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def keys(self):
+        return list(self._rollups)
+
+    def __contains__(self, key):
+        return key in self._rollups
+
+    def horizon(self, key):
+        """Метка, раньше которой точки ключа устарели, или None"""
+        return self._horizons.get(key)
+
+    def expire(self, key, raw_before, rollup_before):
+        """Удаляет точки ключа с метками меньше raw_before и интервалы rollup до rollup_before.
+
+        Ключ, от которого ничего не осталось, удаляется целиком.
+        Возвращает число освобожденных байт памяти.
+        """
+
+        if raw_before > self._horizons.get(key, raw_before - 1):
+            # точки между прежней и новой границей пропадают из ответов get
+            if next(self._chunks(key, None, raw_before - 1), None) is not None:
+                self._version += 1
+                self._versions[key] = self._version
+                summary = self._summaries.get(key)
+                if summary is not None:
+                    summary.remove(self._chunks(key, None, raw_before - 1),
+                                   partial(self._chunks, key, raw_before))
+            self._horizons[key] = raw_before
+
+        freed = 0
+        series = self._data.get(key)
+        if series is not None:
+            size, nbytes = len(series), series.nbytes()
+            series.trim(raw_before)
+            self._head_points -= size - len(series)
+            freed += nbytes - series.nbytes()
+
+        rollups = self._rollups.get(key, ())
+        for rollup in rollups:
+            freed += rollup.trim(rollup_before)
+
+        latest = self._latest.get(key)
+        if latest is not None and latest[0] < raw_before:
+            del self._latest[key]
+
+        # rollup хранятся не меньше сырых точек: пустые rollup значат, что точек нет нигде
+        frozen = self._frozen is not None and key in self._frozen
+        if not frozen and not (series is not None and len(series)) \
+                and not any(len(rollup.starts) for rollup in rollups):
+            self.discard(key)
+
+        return freed
+
+    def discard(self, key):
+        """Удаляет ключ из головы и набора ключей"""
+
+        series = self._data.pop(key, None)
+        if series is not None:
+            self._head_points -= len(series)
+        self._rollups.pop(key, None)
+        self._latest.pop(key, None)
+        self._summaries.pop(key, None)
+        self._index.discard(key)
+        self._version += 1
+        self._versions.pop(key, None)
+        self._keys_version = self._cleared = self._version
+        if not any(key in stored for stored in self._segments):
+            self._horizons.pop(key, None)
+            self._sealed_last.pop(key, None)
+
+    def dump(self, file, segment=0, segments=()):
+        """Пишет снимок хранилища.
+
+        segment - первый сегмент журнала, не вошедший в снимок, segments - имена
+        файлов сегментов, которые вместе со снимком составляют хранилище.
+        В снимок попадают голова, rollup, сводки и самые новые точки всех ключей, а также
+        границы устаревания: retention не удаляет точки из сегментов, а только скрывает их.
+        """
+
+        file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, segment, len(segments),
+                                        len(self._rollups), len(self._horizons)))
+        for name in segments:
+            name = name.encode()
+            file.write(SNAPSHOT_NAME.pack(len(name)))
+            file.write(name)
+
+        for key, horizon in self._horizons.items():
+            name = key.encode()
+            file.write(SNAPSHOT_HORIZON.pack(len(name), horizon))
+            file.write(name)
+
+        for key in self._rollups:
+            self._pack_key(file, key, self._data.get(key) or Series())
+
+    def snapshot_keys(self):
+        """Ключи, которые попадают в снимок: все ключи и ключи с границей устаревания"""
+        return list(dict.fromkeys(chain(self._rollups, self._horizons)))
+
+    def copy(self, keys, into=None):
+        """Копия ключей keys для снимка (голова, rollup, сводки, самые новые точки, границы).
+
+        dump копии можно писать в потоке-исполнителе, пока хранилище принимает put.
+        Копия собирается частями, если передавать в into одну и ту же.
+        """
+
+        copy = Storage() if into is None else into
+        for key in keys:
+            if key in self._horizons:
+                copy._horizons[key] = self._horizons[key]
+            if key not in self._rollups:
+                continue
+            series = self._data.get(key)
+            if series is not None:
+                copy._data[key] = series.copy()
+            copy._rollups[key] = [rollup.copy() for rollup in self._rollups[key]]
+            copy._summaries[key] = self._summaries[key].copy()
+            if key in self._latest:
+                copy._latest[key] = self._latest[key]
+        return copy
+
+    def dump_key(self, file, key):
+        """Пишет запись снимка одного ключа со всеми его точками, в том числе из сегментов.
+
+        Так хранилище передается другому серверу ключ за ключом (replication.py).
+        """
+
+        sources = self._sources(key)
+        if len(sources) == 1 and key in self._data and key not in self._horizons:
+            series = sources[0]
+        else:
+            series = Series.from_chunks(self._chunks(key))
+        self._pack_key(file, key, series)
+
+    def _pack_key(self, file, key, series):
+        name = key.encode()
+        rollups = self._rollups[key]
+        file.write(SNAPSHOT_KEY.pack(len(name), len(rollups)))
+        file.write(name)
+        series.pack(file)
+        for rollup in rollups:
+            rollup.dump(file)
+        self._summaries[key].dump(file)
+        latest = self._latest.get(key)
+        file.write(SNAPSHOT_LATEST.pack(latest is not None, *(latest or (0, 0.0))))
+
+    @staticmethod
+    def unpack_key(buffer, offset=0):
+        """(key, ряд, rollup, сводка, самая новая точка или None) записи ключа и смещение за ней"""
+
+        length, count = SNAPSHOT_KEY.unpack_from(buffer, offset)
+        offset += SNAPSHOT_KEY.size
+        key = bytes(buffer[offset:offset + length]).decode()
+        offset += length
+
+        series, offset = Series.unpack(buffer, offset)
+        rollups = []
+        for _ in range(count):
+            rollup, offset = Rollup.load(buffer, offset)
+            rollups.append(rollup)
+        summary, offset = Summary.load(buffer, offset)
+        present, timestamp, value = SNAPSHOT_LATEST.unpack_from(buffer, offset)
+        offset += SNAPSHOT_LATEST.size
+        return key, series, rollups, summary, (timestamp, value) if present else None, offset
+
+    def replace(self, key, series, rollups, summary, latest):
+        """Заменяет точки, rollup, сводку и самую новую точку ключа,
+        например записью снимка другого сервера.
+
+        Хранилище без сегментов: ключ целиком лежит в голове.
+        """
+
+        previous = self._data.pop(key, None)
+        if previous is not None:
+            self._head_points -= len(previous)
+        if len(series):
+            self._data[key] = series
+            self._head_points += len(series)
+
+        self._version += 1
+        self._versions[key] = self._version
+        if key not in self._rollups:
+            self._index.add(key)
+            self._keys_version = self._version
+        self._rollups[key] = rollups
+        self._summaries[key] = summary
+        self._horizons.pop(key, None)
+        if latest is None:
+            self._latest.pop(key, None)
+        else:
+            self._latest[key] = latest
+
+    def load(self, buffer, directory='.'):
+        """Заменяет содержимое хранилища снимком из буфера.
+
+        Сегменты из снимка открываются в каталоге directory.
+        Возвращает первый сегмент журнала, который нужно повторить поверх снимка.
+        """
+
+        buffer = memoryview(buffer)
+        magic, segment, segments, keys, horizons = SNAPSHOT_HEADER.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('not a metrics storage snapshot')
+
+        self._data.clear()
+        self._rollups.clear()
+        self._head_points = 0
+        self._segments = []
+        self._frozen = None
+        self._sealed_last = {}
+        self._horizons = {}
+        self._latest = {}
+        self._summaries = defaultdict(Summary)
+        self._version += 1
+        self._versions = {}
+        self._keys_version = self._cleared = self._version
+        offset = SNAPSHOT_HEADER.size
+
+        for _ in range(segments):
+            length, = SNAPSHOT_NAME.unpack_from(buffer, offset)
+            offset += SNAPSHOT_NAME.size
+            name = bytes(buffer[offset:offset + length]).decode()
+            offset += length
+            self._segments.append(Segment(os.path.join(directory, name)))
+
+        for _ in range(horizons):
+            length, horizon = SNAPSHOT_HORIZON.unpack_from(buffer, offset)
+            offset += SNAPSHOT_HORIZON.size
+            self._horizons[bytes(buffer[offset:offset + length]).decode()] = horizon
+            offset += length
+
+        for _ in range(keys):
+            key, series, self._rollups[key], self._summaries[key], latest, offset = \
+                self.unpack_key(buffer, offset)
+            if latest is not None:
+                self._latest[key] = latest
+            if len(series):
+                self._data[key] = series
+                self._head_points += len(series)
+
+        for stored in self._segments:
+            for key in stored.keys():
+                self._seal_bounds(key, stored.get(key))
+        self._index = KeyIndex(self._rollups)
+
+        buffer.release()
+        return segment
+
+    def _seal_bounds(self, key, series):
+        bounds = series.bounds()
+        if bounds is not None:
+            self._sealed_last[key] = max(self._sealed_last.get(key, bounds[1]), bounds[1])
+
+    def _keys(self, key):
+        """Ключи по имени, '*' или шаблону вроде cpu.host42.*"""
+        return self._index.match(key)
+
+    def _sources(self, key):
+        """Ряды ключа от старых к новым: сегменты, отделенная голова, голова"""
+
+        sources = [stored.get(key) for stored in self._segments if key in stored]
+        if self._frozen is not None and key in self._frozen:
+            sources.append(self._frozen[key])
         if key in self._data:
-            return {key: deepcopy(self._data.get(key))}
+            sources.append(self._data[key])
+        return sources
+
+    def _sealed_value(self, key, timestamp):
+        """Значение метки в сегментах или отделенной голове, от новых к старым"""
+
+        for source in reversed(self._sources(key)[:-1]):
+            value = source.lookup(timestamp)
+            if value is not None:
+                return value
+        return None
+
+    def _chunks(self, key, start=None, end=None):
+        """Срезы (timestamps, values) ключа в [start, end] по всем источникам"""
+
+        horizon = self._horizons.get(key)
+        if horizon is not None and (start is None or start < horizon):
+            start = horizon
+
+        sources = []
+        for priority, source in enumerate(self._sources(key)):
+            bounds = source.bounds(start, end)
+            if bounds is not None:
+                sources.append((bounds, priority, source))
+
+        # обычный случай: старые данные в сегментах, свежие в голове, интервалы не пересекаются
+        sources.sort(key=lambda source: source[0])
+        if all(previous[0][1] < current[0][0] for previous, current in zip(sources, sources[1:])):
+            for _, _, source in sources:
+                yield from source.chunks(start, end)
+            return
+
+        # интервалы пересекаются: слияние по точкам, для одной метки берется самый новый источник
+        streams = [self._prioritized(source, priority, start, end)
+                   for _, priority, source in sources]
+        timestamps, values, last = array('q'), array('d'), None
+
+        for timestamp, _, value in heapq.merge(*streams):
+            if timestamp == last:
+                continue
+            last = timestamp
+            timestamps.append(timestamp)
+            values.append(value)
+            if len(timestamps) >= Series.block_size:
+                yield timestamps, values
+                timestamps, values = array('q'), array('d')
+
+        if timestamps:
+            yield timestamps, values
+
+    @staticmethod
+    def _prioritized(source, priority, start, end):
+        for timestamps, values in source.chunks(start, end):
+            for timestamp, value in zip(timestamps, values):
+                yield timestamp, -priority, value
+
+    def get(self, key, start=None, end=None):
+        """Куски (key, timestamps, values) запрошенных рядов.
+
+        Данные отдаются лениво, срезами отдельных блоков, без копии всего хранилища.
+        start и end задают необязательный интервал меток времени [start, end].
+        """
+
+        for key in self._keys(key):
+            for timestamps, values in self._chunks(key, start, end):
+                yield key, timestamps, values
+
+    def latest(self, key):
+        """Куски (key, timestamps, values) с одной, самой новой, точкой каждого ключа"""
+
+        for key in self._keys(key):
+            point = self._latest.get(key)
+            if point is not None:
+                yield key, (point[0],), (point[1],)
+
+    def summary(self, key):
+        """Куски (имя, timestamps, values) со сводкой каждого ключа, как в ответе stats.
+
+        Поле сводки - строка <key>.<поле> с меткой последней точки ключа.
+        """
+
+        for key in self._keys(key):
+            summary = self._summaries.get(key)
+            if summary is None or not summary.count:
+                continue
+            for name, value in summary.fields():
+                yield f'{key}.{name}', (summary.last,), (value,)
+
+    def aggregate(self, key, start, end, step, function):
+        """Куски (key, timestamps, values) агрегатов по интервалам шириной step.
+
+        Метка интервала - его начало, кратное step. Внутренняя часть [start, end]
+        берется из самого крупного rollup, ширина которого делит step,
+        по сырым точкам считаются только неполные интервалы на краях.
+        """
+
+        aggregate = AGGREGATES[function]
+        for key in self._keys(key):
+            yield from self._intervals(key, self._partials(key, start, end, step), step, aggregate)
+
+    @staticmethod
+    def _intervals(key, partials, step, aggregate):
+        """Куски (key, timestamps, values) агрегатов ключа из частичных агрегатов.
+
+        partials - (timestamp, count, sum, min, max) по возрастанию времени,
+        aggregate - функция из AGGREGATES.
+        """
+
+        timestamps, values = [], []
+        current, count, total, low, high = None, 0, 0.0, 0.0, 0.0
+
+        for timestamp, *stats in partials:
+            bucket = timestamp - timestamp % step
+            if bucket != current:
+                if current is not None:
+                    timestamps.append(current)
+                    values.append(aggregate(count, total, low, high))
+                if len(timestamps) >= Series.block_size:
+                    yield key, timestamps, values
+                    timestamps, values = [], []
+                current, (count, total, low, high) = bucket, stats
+            else:
+                count += stats[0]
+                total += stats[1]
+                low = min(low, stats[2])
+                high = max(high, stats[3])
+
+        if current is not None:
+            timestamps.append(current)
+            values.append(aggregate(count, total, low, high))
+        if timestamps:
+            yield key, timestamps, values
+
+    def _partials(self, key, start, end, step):
+        """Частичные агрегаты (timestamp, count, sum, min, max) по возрастанию времени"""
+
+        rollup = next((rollup for rollup in reversed(self._rollups.get(key, ()))
+                       if step % rollup.width == 0), None)
+
+        if rollup is not None:
+            # границы части интервала, целиком покрытой интервалами rollup
+            inner_start = -(-start // rollup.width) * rollup.width
+            inner_end = (end + 1) // rollup.width * rollup.width
+            if inner_start < inner_end:
+                yield from self._raw_partials(key, start, inner_start - 1)
+                yield from rollup.items(inner_start, inner_end - 1)
+                yield from self._raw_partials(key, inner_end, end)
+                return
+
+        yield from self._raw_partials(key, start, end)
+
+    def _raw_partials(self, key, start, end):
+        for timestamps, values in self._chunks(key, start, end):
+            for timestamp, value in zip(timestamps, values):
+                yield timestamp, 1, value, value, value
+
+
+class SQLiteStorage:
+    """Хранилище метрик в файле базы SQLite path: второй движок StorageDriver.
+
+    Файл открывается в режиме WAL. Запросы к базе, и запись, и чтение, выполняются
+    в одном потоке-исполнителе: get, agg, latest и summary отдают future чтения,
+    и ответ продолжается, когда оно готово, не блокируя цикл событий.
+    put только копит точки в памяти; пачки пишутся одной транзакцией в отдельном
+    потоке, как пачки журнала (wal.py): по истечении flush_interval секунд или
+    при накоплении batch_size точек. Чтение видит и еще не записанные точки.
+    fsync=False - транзакции без ожидания записи на диск (synchronous=NORMAL).
+
+    Rollup, снимков, сегментов и репликации нет: agg и summary считаются
+    запросами SQL по первичному ключу (key, ts).
+    """
+
+    def __init__(self, path, flush_interval=0.05, batch_size=10000, fsync=True):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        # запись и чтение - только в потоке-исполнителе, по очереди
+        self._writer = sqlite3.connect(path, check_same_thread=False)
+        self._writer.execute('PRAGMA journal_mode = WAL')
+        self._writer.execute(f'PRAGMA synchronous = {"FULL" if fsync else "NORMAL"}')
+        self._writer.executescript(SQLITE_SCHEMA)
+        self._reader = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._index = KeyIndex(key for key, in self._reader.execute('SELECT key FROM keys'))
+
+        self._loop = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # ключ -> {метка: значение}: накопленные точки и пачка, которая сейчас пишется
+        self._pending = {}
+        self._count = 0
+        self._writing = {}
+        self._flushing = None
+        self._timer = None
+
+        # нумерация изменений для кэша ответов - как у Storage
+        self._version = 0
+        self._versions = {}
+        self._keys_version = 0
+        self._cleared = 0
+        self.reset_stats()
+
+    version = Storage.version
+    changed = Storage.changed
+
+    def open(self, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+
+    def reset_stats(self):
+        self.flushes = 0
+        self.flushed = 0
+        self.errors = 0
+
+    def report(self):
+        """Пары (имя, значение) для ответа на stats"""
+        return [('sqlite.pending', self._count + sum(map(len, self._writing.values()))),
+                ('sqlite.flushes', self.flushes),
+                ('sqlite.flushed', self.flushed),
+                ('sqlite.errors', self.errors)]
+
+    def put(self, key, value, timestamp):
+        self._version += 1
+        self._versions[key] = self._version
+        if key not in self._index:
+            self._index.add(key)
+            self._keys_version = self._version
+
+        points = self._pending.get(key)
+        if points is None:
+            points = self._pending[key] = {}
+        points[timestamp] = value
+        self._count += 1
+
+        if self._count >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Отдает накопленную пачку потоку-исполнителю"""
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # пачки пишутся по одной: накопленное за время записи уйдет следующей из _flushed
+        if not self._pending or self._flushing is not None:
+            return
+
+        self._writing, self._pending, self._count = self._pending, {}, 0
+        self._flushing = self._loop.run_in_executor(self._executor, self._write, self._writing)
+        self._flushing.add_done_callback(self._flushed)
+
+    def _write(self, batch):
+        with self._writer:
+            self._writer.executemany('INSERT OR IGNORE INTO keys VALUES (?)',
+                                     ((key,) for key in batch))
+            self._writer.executemany('INSERT OR REPLACE INTO points VALUES (?, ?, ?)',
+                                     ((key, timestamp, value) for key, points in batch.items()
+                                      for timestamp, value in points.items()))
+
+    def _flushed(self, future):
+        batch, self._writing, self._flushing = self._writing, {}, None
+        error = future.exception()
+        if error is None:
+            self.flushes += 1
+            self.flushed += sum(map(len, batch.values()))
+        else:
+            # пачка возвращается в очередь, точки, записанные позже, новее ее
+            logger.error('sqlite write of %d keys failed: %r', len(batch), error)
+            self.errors += 1
+            for key, points in batch.items():
+                points.update(self._pending.get(key, ()))
+                self._pending[key] = points
+            self._count = sum(map(len, self._pending.values()))
+
+        # после ошибки - повтор не раньше чем через flush_interval
+        if self._count >= self.batch_size and error is None:
+            self.flush()
+        elif self._pending and self._timer is None:
+            self._timer = self._loop.call_later(self.flush_interval, self.flush)
+
+    async def close(self):
+        """Дожидается записи всех пачек и закрывает базу"""
+
+        # _flushing сбрасывает колбэк _flushed: если пачка уже записана,
+        # а колбэк еще не выполнен, циклу событий нужно дать ход
+        while self._flushing is not None:
+            if self._flushing.done():
+                await asyncio.sleep(0)
+            else:
+                await asyncio.shield(self._flushing)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._executor.shutdown()
+        if self._pending:
+            self._writing, self._pending, self._count = self._pending, {}, 0
+            self._write(self._writing)
+            self._writing = {}
+        self._reader.close()
+        self._writer.close()
+
+    def keys(self):
+        return list(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def _keys(self, key):
+        """Ключи по имени, '*' или шаблону вроде cpu.host42.*"""
+        return self._index.match(key)
+
+    def _unwritten(self, key, start, end):
+        """{метка: значение} еще не записанных в базу точек ключа в [start, end]"""
+
+        unwritten = {}
+        for batch in (self._writing, self._pending):
+            points = batch.get(key)
+            if points:
+                unwritten.update((timestamp, value) for timestamp, value in points.items()
+                                 if start <= timestamp <= end)
+        return unwritten
+
+    def _read(self, function, *args):
+        """Future результата function(*args), выполненной в потоке-исполнителе.
+
+        Чтения стоят в одной очереди с записью пачек, так что база к началу чтения
+        содержит все пачки, отданные на запись раньше, и ни одной более поздней.
+        Поэтому еще не записанные точки нужно взять в том же шаге цикла событий.
+        """
+        return self._loop.run_in_executor(self._executor, function, *args)
 
-        return {}
+    def _rows(self, query, params):
+        return self._reader.execute(query, params).fetchall()
+
+    def _chunks(self, key, start=None, end=None):
+        """Срезы (timestamps, values) ключа в [start, end] по возрастанию времени.
+
+        Точки читаются страницами по Series.block_size: перед каждой страницей
+        генератор отдает future ее чтения и продолжается, когда она готова.
+        """
+
+        start = MIN_TIMESTAMP if start is None else start
+        end = MAX_TIMESTAMP if end is None else end
+        while True:
+            unwritten = self._unwritten(key, start, end)
+            page = self._read(self._rows, SQLITE_RANGE, (key, start, end, Series.block_size))
+            yield page
+            rows = page.result()
+            full = len(rows) == Series.block_size
+            last = rows[-1][0] if full else end
+
+            if unwritten:
+                # редкий случай: чтение сразу после записи, точки базы и очереди сливаются
+                points = dict(rows)
+                points.update((timestamp, value) for timestamp, value in unwritten.items()
+                              if timestamp <= last)
+                rows = sorted(points.items())
+            if rows:
+                timestamps, values = zip(*rows)
+                yield timestamps, values
+            if last >= end:
+                return
+            start = last + 1
+
+    def get(self, key, start=None, end=None):
+        """Куски (key, timestamps, values) запрошенных рядов, см. Storage.get.
+
+        Между кусками генератор отдает future чтения из базы, как _chunks.
+        """
+
+        for key in self._keys(key):
+            for chunk in self._chunks(key, start, end):
+                if isinstance(chunk, asyncio.Future):
+                    yield chunk
+                else:
+                    yield (key, *chunk)
+
+    def aggregate(self, key, start, end, step, function):
+        """Куски (key, timestamps, values) агрегатов по интервалам шириной step, см. Storage.aggregate.
+
+        Интервалы считает база запросом GROUP BY; перед ответом каждого ключа
+        генератор отдает future этого запроса.
+        """
+
+        aggregate = AGGREGATES[function]
+        for key in self._keys(key):
+            unwritten = self._unwritten(key, start, end)
+            if unwritten:
+                # редкий случай: чтение сразу после записи, интервалы считаются по точкам
+                rows = self._read(self._rows, SQLITE_RANGE, (key, start, end, -1))
+                yield rows
+                points = dict(rows.result())
+                points.update(unwritten)
+                partials = ((timestamp, 1, value, value, value)
+                            for timestamp, value in sorted(points.items()))
+            else:
+                rows = self._read(self._rows, SQLITE_BUCKETS, {'key': key, 'start': start,
+                                                               'end': end, 'step': step})
+                yield rows
+                partials = rows.result()
+            yield from Storage._intervals(key, partials, step, aggregate)
+
+    def latest(self, key):
+        """Куски (key, timestamps, values) с одной, самой новой, точкой каждого ключа.
+
+        Новые точки всех ключей читаются одним заданием потока-исполнителя,
+        его future генератор отдает первой.
+        """
+
+        keys = self._keys(key)
+        unwritten = [self._unwritten(key, MIN_TIMESTAMP, MAX_TIMESTAMP) for key in keys]
+        rows = self._read(self._latest_rows, keys)
+        yield rows
+
+        for key, point, points in zip(keys, rows.result(), unwritten):
+            if points:
+                timestamp = max(points)
+                if point is None or timestamp >= point[0]:
+                    point = timestamp, points[timestamp]
+            if point is not None:
+                yield key, (point[0],), (point[1],)
+
+    def _latest_rows(self, keys):
+        return [self._reader.execute(SQLITE_LATEST, (key,)).fetchone() for key in keys]
+
+    def summary(self, key):
+        """Куски (имя, timestamps, values) со сводкой каждого ключа, см. Storage.summary.
+
+        Сводки всех ключей читаются одним заданием потока-исполнителя,
+        его future генератор отдает первой.
+        """
+
+        keys = self._keys(key)
+        unwritten = [self._unwritten(key, MIN_TIMESTAMP, MAX_TIMESTAMP) for key in keys]
+        rows = self._read(self._summary_rows, keys, [bool(points) for points in unwritten])
+        yield rows
+
+        for key, row, points in zip(keys, rows.result(), unwritten):
+            if points:
+                # ключ с еще не записанными точками: сводка по слитым точкам
+                row = dict(row)
+                row.update(points)
+                summary = Summary([tuple(zip(*sorted(row.items())))])
+            else:
+                summary = Summary()
+                (summary.count, summary.sum, summary.squares, summary.min, summary.max,
+                 summary.first, summary.last) = row
+            if summary.count:
+                for name, value in summary.fields():
+                    yield f'{key}.{name}', (summary.last,), (value,)
+
+    def _summary_rows(self, keys, raw):
+        """Сводка SQL каждого ключа или, где raw, все его точки"""
+        return [self._reader.execute(SQLITE_RANGE, (key, MIN_TIMESTAMP, MAX_TIMESTAMP, -1)).fetchall()
+                if points else self._reader.execute(SQLITE_SUMMARY, (key,)).fetchone()
+                for key, points in zip(keys, raw)]
 
 
 class StorageDriver:
     """Класс, предосталяющий интерфейс для работы с хранилищем данных"""
 
-    def __init__(self, storage):
+    def __init__(self, storage, wal=None, stats=None, cache=None, leader=None, follower=None,
+                 watchers=None):
         self.storage = storage
+        self.wal = wal
+        self.stats = stats
+        self.cache = cache
+        # подписки watch на записанные точки
+        self.watchers = watchers
+        # Leader рассылает записанные точки ведомым; ведомый (follower) только читает
+        self.leader = leader
+        self.follower = follower
+        # выполненные команды, кроме put: put протокол считает остатком пакета
+        self.counted = 0
 
     def __call__(self, data):
 
-        method, *params = data.split()
-
+        method, *params = data.split() or [None]
         if method == "put":
             key, value, timestamp = params
             value, timestamp = float(value), int(timestamp)
-            self.storage.put(key, value, timestamp)
-            return {}
+            return self.put_many([(key, value, timestamp)])
+
+        self.count(method)
+        if method == "mput":
+            # mput [atomic] <key> <value> <timestamp> ...
+            points, rejected = self._parse_points(params)
+            self.put_many(points)
+            # без atomic верные точки записаны, но клиент узнает об отброшенных
+            if rejected:
+                raise StorageDriverError
+            return ()
         elif method == "get":
-            key = params.pop()
-            if params:
+            # get <key> [<from> <to>]
+            key, *interval = params
+            if len(interval) not in (0, 2):
+                raise StorageDriverError
+            start, end = map(int, interval) if interval else (None, None)
+            return self.storage.get(key, start, end)
+        elif method == "agg":
+            # agg <key> <from> <to> <step> avg|min|max|sum|count
+            key, start, end, step, function = params
+            start, end, step = int(start), int(end), int(step)
+            if step <= 0 or function not in AGGREGATES:
                 raise StorageDriverError
-            return self.storage.get(key)
+            return self.storage.aggregate(key, start, end, step, function)
+        elif method == "latest":
+            # latest <key|pattern>: самая новая точка каждого ключа
+            key, = params
+            return self.storage.latest(key)
+        elif method == "summary":
+            # summary <key|pattern>: count, sum, sum_squares, min, max, first, last каждого ключа
+            key, = params
+            return self.storage.summary(key)
+        elif method == "stats" and self.stats is not None:
+            # stats [on|off|reset]: отчет в формате ответа get
+            report = self.stats.command(params)
+            if report is not None:
+                for part in (self.storage, self.cache, self.leader, self.follower, self.watchers):
+                    if part is not None:
+                        report += part.report()
+            elif params == ['reset']:
+                for part in (self.storage, self.cache):
+                    if part is not None:
+                        part.reset_stats()
+            now = int(time.time())
+            return [(name, (now,), (value,)) for name, value in report or ()]
         else:
             raise StorageDriverError
 
+    def count(self, method):
+        """Считает команду method, кроме put; None и неизвестные - как OTHER"""
+
+        self.counted += 1
+        if self.stats is not None and self.stats.enabled:
+            self.stats.counts[method if method in TEXT_COMMANDS else OTHER] += 1
+
+    @staticmethod
+    def _parse_points(params):
+        """Точки команды mput и число отброшенных неверных точек.
+
+        С atomic одна неверная точка отменяет всю команду.
+        """
+
+        atomic = len(params) % 3 == 1 and params[0] == 'atomic'
+        if atomic:
+            params = params[1:]
+        if not params or len(params) % 3:
+            raise StorageDriverError
+
+        points, rejected = [], 0
+        for index in range(0, len(params), 3):
+            key, value, timestamp = params[index:index + 3]
+            try:
+                points.append((key, float(value), int(timestamp)))
+            except ValueError:
+                if atomic:
+                    raise StorageDriverError
+                rejected += 1
+
+        return points, rejected
+
+    def put_many(self, points):
+        """Записывает разобранные точки (key, value, timestamp) одной пачкой.
+
+        Пачка применяется за один шаг цикла событий: чтение не видит ее частично.
+        На ведомом сервере запись - ошибка.
+        """
+
+        if self.follower is not None:
+            raise StorageDriverError
+        if self.wal is not None:
+            self.wal.append_many(points)
+        put = self.storage.put
+        for key, value, timestamp in points:
+            put(key, value, timestamp)
+        if self.leader is not None and self.leader.followers:
+            self.leader.publish(points)
+        if self.watchers is not None and self.watchers.subscribers:
+            self.watchers.publish(points)
+        return ()
+
 
 class MetricsStorageServerProtocol(asyncio.Protocol):
     """Класс для реализации сервера при помощи asyncio"""
@@ -58,51 +1684,389 @@ class MetricsStorageServerProtocol(asyncio.Protocol):
     # доступ к хранилищу данных для всех экземпляров класса MetricsStorageServerProtocol
     # через обращение к атрибуту self.storage.
     storage = Storage()
+    # журнал put, общий для всех соединений; None - без сохранения на диск
+    wal = None
+    # счетчики и задержки команд всех соединений, команда stats
+    stats = Stats()
+    # кэш ответов на get, общий для всех соединений; None - без кэша
+    cache = ResponseCache()
+    # рассылка записей ведомым серверам (команда replicate) или, на ведомом,
+    # источник его данных; None - без репликации
+    leader = None
+    follower = None
+    # подписки watch всех соединений
+    watchers = Watchers()
     # настройки сообщений сервера
     sep = '\n'
     error_message = "wrong command"
     code_err = 'error'
     code_ok = 'ok'
 
+    # примерный объем ответа, который пишется в сокет за одну итерацию цикла событий
+    chunk_size = 64 * 1024
+    # предел буфера отправки соединения: выше него транспорт вызывает pause_writing
+    # и ответы перестают формироваться, пока клиент не прочитает отправленное
+    buffer_limit = 64 * 1024
+    # команд в очереди, после которых соединение перестает читать новые
+    max_pending = 1024
+    # неполная команда длиннее этого - ошибка клиента, соединение закрывается
+    max_request = 16 * 1024 * 1024
+
     def __init__(self):
         super().__init__()
-        self.driver = StorageDriver(self.storage)
-        self._buffer = b''
+        self.driver = StorageDriver(self.storage, self.wal, self.stats, self.cache,
+                                    self.leader, self.follower, self.watchers)
+        # driver.counted к концу предыдущего пакета, см. _count_puts
+        self._counted = 0
+        self._buffer = bytearray()
+        # очередь ответов на принятые команды, каждый ответ - итератор кусков bytes
+        self._responses = deque()
+        self._writing = False
+        self._paused = False
+        self._reading = True
+        # после команды binary соединение передает кадры binary.py вместо строк
+        self._binary = False
+        self._keys = {}
+        # после команды replicate соединение только передает изменения ведомому,
+        # после watch - только присылает подписчику новые точки
+        self._replicating = False
+        self._subscriber = None
 
     def connection_made(self, transport):
         self.transport = transport
+        self._loop = asyncio.get_event_loop()
+        transport.set_write_buffer_limits(self.buffer_limit)
+        self.stats.connections += 1
+
+    def connection_lost(self, exc):
+        self._responses.clear()
+        self.stats.connections -= 1
+        if self._replicating:
+            self.leader.unsubscribe(self)
+        if self._subscriber is not None:
+            self.watchers.unsubscribe(self._subscriber)
+
+    def pause_writing(self):
+        self._paused = True
+        if self._subscriber is not None:
+            self._subscriber.pause()
+        self._update_reading()
+
+    def resume_writing(self):
+        self._paused = False
+        if not self._writing:
+            self._write()
+        if self._subscriber is not None:
+            self._resume_subscriber()
+
+    def _update_reading(self):
+        """Читает новые команды, только пока клиент успевает забирать ответы"""
+
+        reading = not self._paused and len(self._responses) < self.max_pending
+        if reading != self._reading and not self.transport.is_closing():
+            self._reading = reading
+            if reading:
+                self.transport.resume_reading()
+            else:
+                self.transport.pause_reading()
 
     def data_received(self, data):
         """Метод data_received вызывается при получении данных в сокете"""
 
+        if self.stats.enabled:
+            self.stats.bytes_in += len(data)
+        if self._replicating or self._subscriber is not None:
+            return
         self._buffer += data
 
+        # ждем данных, если команда не завершена символом \n
+        requests, negotiated = [], None
+        end = -1 if self._binary else self._buffer.find(b'\n')
+        # команда watch редкая: строки проверяются, только если она есть в пакете
+        watch = end >= 0 and b'watch ' in self._buffer
+        while end >= 0:
+            request = bytes(self._buffer[:end])
+            del self._buffer[:end + 1]
+            # без Leader команда replicate - такая же неверная команда, как прочие
+            if request == binary.NEGOTIATE or request == REPLICATE and self.leader is not None \
+                    or watch and request[:6] == b'watch ' and len(request.split()) > 1:
+                negotiated = request
+                break
+            requests.append(request)
+            end = self._buffer.find(b'\n')
+
+        self._responses.extend(self._answers(requests))
+        if negotiated == binary.NEGOTIATE:
+            self._binary = True
+            self._responses.append(self._status())
+        elif negotiated == REPLICATE:
+            self._replicating = True
+            self._buffer.clear()
+            self._responses.append(self._status())
+            self._responses.append(self.leader.subscribe(self))
+        elif negotiated is not None:
+            self._watch(negotiated)
+
+        if self._binary:
+            self._receive_frames()
+        elif len(self._buffer) > self.max_request:
+            self.transport.close()
+            return
+
+        if not self._writing:
+            self._write()
+        self._update_reading()
+
+    def _watch(self, request):
+        """watch <pattern> ...: дальше соединение только присылает новые точки"""
+
+        try:
+            patterns = request.decode().split()[1:]
+        except UnicodeDecodeError:
+            patterns = None
+        if not patterns:
+            self._responses.append(self._status(error=True))
+            return
+
+        self._buffer.clear()
+        self._subscriber = self.watchers.subscribe(patterns, self.transport)
+        # подписчик пишет в транспорт сам, после ответов на прежние команды
+        self._subscriber.pause()
+        self._responses.append(self._subscribed())
+
+    def _subscribed(self):
+        yield from self._status()
+        self._loop.call_soon(self._resume_subscriber)
+
+    def _resume_subscriber(self):
+        if not self._paused and not self._responses:
+            self._subscriber.resume()
+
+    def _answers(self, requests):
+        """Ответы на пакет команд; у каждой sample-й статистика измеряет задержку"""
+
+        if not requests:
+            return []
+        responses = [self._response(request) for request in requests]
+        stats = self.stats
+        if stats.enabled:
+            for number in stats.sampled(len(requests)):
+                responses[number] = stats.timed(stats.kind(requests[number]), responses[number])
+        responses.append(self._count_puts(len(requests)))
+        return responses
+
+    def _count_puts(self, count):
+        """Пустой ответ за пакетом из count команд.
+
+        Ответы формируются по порядку, так что к нему все команды пакета выполнены:
+        put среди них - те, что не посчитал драйвер.
+        """
+
+        others = self.driver.counted - self._counted
+        self._counted = self.driver.counted
+        if self.stats.enabled:
+            self.stats.counts['put'] += count - others
+        return
+        yield
+
+    def _receive_frames(self):
         try:
-            request = self._buffer.decode()
-            # ждем данных, если команда не завершена символом \n
-            if not request.endswith(self.sep):
+            frames = binary.frames(self._buffer)
+        except ValueError:
+            self.transport.close()
+            return
+
+        for kind, payload in frames:
+            if kind == binary.KEY:
+                # ошибка в объявлении проявится в пачке, которая ссылается на ключ
+                try:
+                    binary.declare(payload, self._keys)
+                except (ValueError, struct.error):
+                    pass
+            elif kind == binary.POINTS:
+                try:
+                    points = binary.points(payload, self._keys)
+                except (ValueError, KeyError):
+                    self._responses.append(self._status(error=True))
+                else:
+                    self._responses.append(self._points(points))
+            elif kind == binary.TEXT:
+                self._responses.extend(self._answers([payload]))
+            else:
+                self._responses.append(self._status(error=True))
+
+    def _status(self, error=False):
+        """Ответ без данных: ok или ошибка"""
+        if error:
+            yield f'{self.code_err}{self.sep}{self.error_message}{self.sep}{self.sep}'.encode()
+        else:
+            yield f'{self.code_ok}{self.sep}{self.sep}'.encode()
+
+    def _points(self, points):
+        response = self._put_many(points)
+        stats = self.stats
+        if stats.enabled:
+            stats.counts['points'] += len(points)
+            if stats.sampled():
+                response = stats.timed('points', response)
+        return response
+
+    def _put_many(self, points):
+        try:
+            self.driver.put_many(points)
+        except StorageDriverError:
+            yield from self._status(error=True)
+            return
+        yield from self._status()
+
+    def _response(self, request):
+        """Ответ на одну команду в виде кусков bytes"""
+
+        cache = self.cache if request[:4] == b'get ' else None
+        if cache is not None:
+            cached = cache.lookup(request, self.storage)
+            if cached is not None:
+                self.driver.count('get')
+                if len(cached) <= self.chunk_size:
+                    yield cached
+                else:
+                    # большой ответ - кусками, чтобы буфер транспорта оставался ограниченным
+                    view = memoryview(cached)
+                    for start in range(0, len(cached), self.chunk_size):
+                        yield view[start:start + self.chunk_size]
                 return
+            version = self.storage.version
+
+        try:
+            data = request.decode()
+        except UnicodeDecodeError:
+            self.driver.count(None)
+            yield from self._status(error=True)
+            return
+
+        try:
+            raw_data = self.driver(data)
+        except (ValueError, IndexError):
+            yield from self._status(error=True)
+            return
+
+        if not raw_data:
+            # put, mput, stats on|off: ответ без данных
+            yield f'{self.code_ok}{self.sep}{self.sep}'.encode()
+            return
+        chunks = self._encode(raw_data)
+        if cache is None:
+            yield from chunks
+            return
 
-            self._buffer, message = b'', ''
-            raw_data = self.driver(request.rstrip(self.sep))
+        # ответ копится для кэша, пока не превысит предел одной записи
+        parts, size = [], 0
+        for chunk in chunks:
+            if parts is not None and not isinstance(chunk, asyncio.Future):
+                size += len(chunk)
+                if size <= cache.max_entry:
+                    parts.append(chunk)
+                else:
+                    parts = None
+            yield chunk
+        if parts is not None:
+            cache.store(request, version, b''.join(parts))
 
-            for key, values in raw_data.items():
-                message += self.sep.join(f'{key} {value} {timestamp}' \
-                                         for timestamp, value in sorted(values.items()))
-                message += self.sep
+    def _encode(self, raw_data):
+        """Куски ответа ok с точками raw_data из Storage.get или aggregate.
 
-            code = self.code_ok
-        except (ValueError, UnicodeDecodeError, IndexError):
-            message = self.error_message + self.sep
-            code = self.code_err
+        future чтения из SQLiteStorage передаются дальше как есть, их ждет _write.
+        """
+        yield f'{self.code_ok}{self.sep}'.encode()
+        for item in raw_data:
+            if isinstance(item, asyncio.Future):
+                yield item
+                continue
+            key, timestamps, values = item
+            yield ''.join(f'{key} {value} {timestamp}{self.sep}'
+                          for timestamp, value in zip(timestamps, values)).encode()
+        yield self.sep.encode()
 
-        response = f'{code}{self.sep}{message}{self.sep}'
-        # отправляем ответ
-        self.transport.write(response.encode())
+    def _write(self):
+        """Отправляет очередную порцию ответов размером около chunk_size байт.
 
+        Ответы формируются из хранилища по мере отправки. Если клиент не успевает
+        читать, транспорт вызывает pause_writing и отправка продолжится
+        в resume_writing, так что буфер соединения не превышает buffer_limit + chunk_size.
+        Иначе продолжение планируется на следующую итерацию
+        цикла событий, чтобы большой get * не задерживал остальных клиентов.
+        Если ответ отдал future (чтение SQLiteStorage), отправка продолжится,
+        когда оно выполнится.
+        """
+
+        if self._paused or self.transport.is_closing():
+            self._writing = False
+            return
+
+        chunks, size, waiting = [], 0, None
+        while self._responses and size < self.chunk_size:
+            chunk = next(self._responses[0], None)
+            if chunk is None:
+                self._responses.popleft()
+                continue
+            if isinstance(chunk, asyncio.Future):
+                waiting = chunk
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+
+        # отправляем ответ; при переполнении буфера транспорт сразу вызовет pause_writing
+        self.transport.writelines(chunks)
+        if self.stats.enabled:
+            self.stats.bytes_out += size
+
+        if waiting is not None:
+            # _writing остается True: resume_writing не должен продолжить ответ раньше
+            self._writing = True
+            waiting.add_done_callback(lambda future: self._write())
+        else:
+            self._writing = bool(self._responses) and not self._paused
+            if self._writing:
+                self._loop.call_soon(self._write)
+        self._update_reading()
+
+
+def run_server(host, port, wal=None, snapshots=None, retention=None, follower=None):
+    """wal - WriteAheadLog, snapshots - Snapshotter, retention - RetentionTask.
+
+    При старте хранилище загружается из последнего снимка, затем из журнала
+    повторяются только put, сделанные после снимка.
+    follower - Follower: сервер только читает копию хранилища ведущего,
+    иначе он сам может быть ведущим для других.
+    Хранилище SQLiteStorage открывается здесь и закрывается при остановке.
+    """
 
-def run_server(host, port):
     loop = asyncio.get_event_loop()
+    storage = MetricsStorageServerProtocol.storage
+    segment = 0
+
+    if snapshots is not None:
+        segment = snapshots.load(storage)
+
+    if wal is not None:
+        for key, value, timestamp in wal.replay(segment):
+            storage.put(key, value, timestamp)
+        wal.open(loop)
+        MetricsStorageServerProtocol.wal = wal
+
+    if isinstance(storage, SQLiteStorage):
+        storage.open(loop)
+    if snapshots is not None:
+        snapshots.start(storage, wal, loop)
+    if retention is not None:
+        retention.start(loop)
+    if follower is not None:
+        MetricsStorageServerProtocol.follower = follower
+        follower.start(loop)
+    elif MetricsStorageServerProtocol.leader is None and isinstance(storage, Storage):
+        # снимки ключей для ведомых умеет отдавать только Storage
+        MetricsStorageServerProtocol.leader = Leader(storage)
+
     coro = loop.create_server(MetricsStorageServerProtocol, host, port)
     server = loop.run_until_complete(coro)
 
@@ -113,8 +2077,88 @@ def run_server(host, port):
 
     server.close()
     loop.run_until_complete(server.wait_closed())
+    if follower is not None:
+        loop.run_until_complete(follower.stop())
+    if retention is not None:
+        loop.run_until_complete(retention.stop())
+    if snapshots is not None:
+        loop.run_until_complete(snapshots.stop())
+    if wal is not None:
+        loop.run_until_complete(wal.close())
+    if isinstance(storage, SQLiteStorage):
+        loop.run_until_complete(storage.close())
     loop.close()
 
 
 if __name__ == "__main__":
-    run_server("127.0.0.1", 8888)
+    parser = argparse.ArgumentParser(description="async text tcp server for metrics")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--wal", help="путь к журналу put; без него метрики живут только в памяти")
+    parser.add_argument("--wal-interval", type=float, default=0.01,
+                        help="интервал group commit, секунды; 0 - fsync на каждый put")
+    parser.add_argument("--wal-batch", type=int, default=1000,
+                        help="размер пачки, при котором она сбрасывается не дожидаясь интервала")
+    parser.add_argument("--no-fsync", action="store_true",
+                        help="не вызывать fsync для пачек журнала или транзакций SQLite")
+    parser.add_argument("--snapshot", help="путь к файлу снимка хранилища")
+    parser.add_argument("--snapshot-interval", type=float, default=300,
+                        help="период снимков, секунды")
+    parser.add_argument("--segments", help="каталог сегментов истории, по умолчанию рядом со снимком")
+    parser.add_argument("--head-points", type=int,
+                        help="сколько точек держать в памяти, прежде чем запечатать их в сегмент "
+                             "(нужен --snapshot)")
+    parser.add_argument("--retention", action="append", default=[], metavar="PATTERN=RAW[:ROLLUP]",
+                        help="срок хранения сырых точек и rollup для ключей по шаблону, "
+                             "например 'cpu.*=7d:1y'; можно указать несколько раз")
+    parser.add_argument("--retention-interval", type=float, default=60,
+                        help="период применения сроков хранения, секунды")
+    parser.add_argument("--no-stats", action="store_true",
+                        help="запустить с выключенной статистикой, ее включает команда 'stats on'")
+    parser.add_argument("--stats-sample", type=int, default=256,
+                        help="задержка измеряется у каждой N-й команды")
+    parser.add_argument("--cache-size", type=int, default=64,
+                        help="память под кэш ответов на get, МиБ; 0 - без кэша")
+    parser.add_argument("--lateness", type=int, default=Series.lateness,
+                        help="окно опоздания точек в единицах меток: заполненный блок ряда "
+                             "сжимается, когда новые точки ушли от его конца дальше")
+    parser.add_argument("--watch-queue", type=int, default=10000,
+                        help="точек в очереди подписчика watch, после которых она сжимается")
+    parser.add_argument("--sqlite", metavar="PATH",
+                        help="хранить метрики в базе SQLite вместо памяти")
+    parser.add_argument("--follow", metavar="HOST:PORT",
+                        help="работать ведомым: копировать хранилище ведущего сервера "
+                             "и отвечать только на чтение")
+    args = parser.parse_args()
+    if args.follow and (args.wal or args.snapshot):
+        parser.error("ведомый хранит копию только в памяти: --follow несовместим с --wal и --snapshot")
+    if args.sqlite and (args.wal or args.snapshot or args.follow or args.retention):
+        parser.error("база SQLite сама хранит метрики на диске: --sqlite несовместим "
+                     "с --wal, --snapshot, --follow и --retention")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    MetricsStorageServerProtocol.stats.enabled = not args.no_stats
+    MetricsStorageServerProtocol.stats.sample = args.stats_sample
+    MetricsStorageServerProtocol.cache = \
+        ResponseCache(args.cache_size * 1024 * 1024) if args.cache_size > 0 else None
+    MetricsStorageServerProtocol.watchers.max_queue = args.watch_queue
+    Series.lateness = args.lateness
+
+    if args.sqlite:
+        MetricsStorageServerProtocol.storage = SQLiteStorage(args.sqlite, fsync=not args.no_fsync)
+
+    wal = snapshots = retention = None
+    if args.wal:
+        wal = WriteAheadLog(args.wal, args.wal_interval, args.wal_batch, not args.no_fsync)
+    if args.snapshot:
+        snapshots = Snapshotter(args.snapshot, args.snapshot_interval, args.segments)
+        MetricsStorageServerProtocol.storage.head_limit = args.head_points
+    if args.retention:
+        retention = RetentionTask(MetricsStorageServerProtocol.storage,
+                                  RetentionPolicy(args.retention), args.retention_interval)
+    follower = None
+    if args.follow:
+        leader_host, _, leader_port = args.follow.rpartition(":")
+        follower = Follower(MetricsStorageServerProtocol.storage, leader_host or "127.0.0.1",
+                            int(leader_port), watchers=MetricsStorageServerProtocol.watchers)
+    run_server(args.host, args.port, wal, snapshots, retention, follower)
@@ -0,0 +1,751 @@
+"""
+Запуск сервера метрик на нескольких ядрах.
+
+Пространство ключей делится на шарды по crc32 ключа. Каждый шард - отдельный
+процесс с обычным сервером (server_coursera, server или server_1) на своем
+порту loopback, он хранит только свои ключи.
+
+Клиенты подключаются к маршрутизаторам: несколько процессов слушают общий порт
+через SO_REUSEPORT, и ядро распределяет между ними соединения. Маршрутизатор
+разбирает команду ровно настолько, чтобы найти ключ, и пересылает ее владельцу
+по постоянному соединению с шардом в двоичном протоколе binary.py. Команды всех
+клиентов маршрутизатора идут в шард конвейером, ответы возвращаются клиенту
+в порядке его команд.
+
+get, agg, latest и summary по шаблону ('*', 'cpu.*') рассылаются всем шардам,
+ответы склеиваются; команда с точным ключом идет только его владельцу. Ответы
+шардов передаются клиенту по мере получения, не собираясь в памяти целиком.
+Пока клиент не забирает ответы (pause_writing), маршрутизатор не читает
+из шарда, который сейчас отвечает этому клиенту.
+stats тоже рассылается всем: отчеты склеиваются, и к имени каждой строки
+добавляется номер шарда (shard0.).
+Точки put и mput маршрутизатор разбирает сам и отправляет шардам двоичными
+пачками: подряд идущие put клиента становятся одной пачкой на шард. atomic mput
+проверяется целиком до рассылки, поэтому неверная точка не попадает ни в один шард.
+
+watch маршрутизатор открывает отдельными соединениями с шардами, которые могут
+хранить подходящие ключи, - с владельцами точных ключей или со всеми шардами
+для шаблона. Ответ клиенту - ok, когда подписались все шарды, дальше сообщения
+с точками шардов передаются ему как есть. Если шард недоступен или отказал,
+клиент получает ошибку, и соединение закрывается.
+
+    python shard.py --server server_coursera --workers 4 --port 8888
+"""
+
+
+import argparse
+import asyncio
+import importlib
+import multiprocessing
+import re
+import signal
+import socket
+import struct
+import sys
+import zlib
+from collections import deque
+from multiprocessing.connection import wait
+
+import binary
+
+
+SUCCESS = b'ok\n\n'
+WRONG = b'error\nwrong command\n\n'
+OK = b'ok\n'
+
+# команды, второе слово которых - ключ или шаблон ключей
+KEYED = (b'put', b'get', b'agg', b'latest', b'summary')
+# из них те, что по шаблону читают ключи всех шардов
+SCATTERED = (b'get', b'agg', b'latest', b'summary')
+GLOB = re.compile(rb'[*?[]')
+
+# сколько ждать, пока шарды начнут принимать соединения, секунды
+CONNECT_TIMEOUT = 30
+
+
+def shard_of(key, count):
+    """Номер шарда ключа str или bytes из count шардов"""
+    if isinstance(key, str):
+        key = key.encode()
+    return zlib.crc32(key) % count
+
+
+def parse_point(key, value, timestamp):
+    """(key, value, timestamp) из слов команды или None, если точка неверна"""
+    try:
+        point = (key.decode(), float(value), int(timestamp))
+    except ValueError:
+        return None
+    # метка должна поместиться в int64 двоичной записи
+    return point if -2 ** 63 <= point[2] < 2 ** 63 else None
+
+
+def single(parts):
+    return parts[0]
+
+
+def status(parts):
+    """ok, если все шарды ответили ok, иначе первая ошибка"""
+    return next((part for part in parts if part != SUCCESS), SUCCESS)
+
+
+def failed(parts):
+    """Ошибка при любых ответах шардов: часть точек mput отброшена маршрутизатором"""
+    return WRONG
+
+
+def concat(parts):
+    """Склеивает ответы шардов на чтение по шаблону: строки данных без заголовков ok"""
+    for part in parts:
+        if not part.startswith(OK):
+            return part
+    return OK + b''.join(part[len(OK):-1] for part in parts) + b'\n'
+
+
+def numbered(parts):
+    """Склеивает отчеты stats шардов: shard0.stats.uptime, shard1.stats.uptime, ..."""
+    for part in parts:
+        if not part.startswith(OK):
+            return part
+    return OK + b''.join(b'shard%d.%s\n' % (index, line)
+                         for index, part in enumerate(parts)
+                         for line in part[len(OK):-1].splitlines()) + b'\n'
+
+
+class Reply:
+    """Ответ на команды клиента, собираемый из ответов count шардов.
+
+    answers - сколько раз ответ повторяется клиенту (пачка put).
+    """
+
+    __slots__ = ('owner', 'parts', 'waiting', 'merge', 'answers')
+    # части ответа передаются клиенту, не дожидаясь конца, см. StreamedReply
+    streamed = False
+
+    def __init__(self, owner, count, merge=single, answers=1):
+        self.owner = owner
+        self.parts = [None] * count
+        self.waiting = count
+        self.merge = merge
+        self.answers = answers
+
+    @classmethod
+    def ready(cls, owner, data):
+        """Ответ, который маршрутизатор дает сам, без шардов"""
+        reply = cls(owner, 0)
+        reply.parts = [data]
+        return reply
+
+    def fill(self, index, part):
+        self.parts[index] = part
+        self.waiting -= 1
+
+    def take(self):
+        """Куски ответа, которые уже можно отправить клиенту"""
+        if self.waiting:
+            return []
+        return [self.merge(self.parts) * self.answers]
+
+
+class StreamedReply(Reply):
+    """Ответ одного шарда: куски передаются клиенту по мере получения"""
+
+    __slots__ = ('chunks',)
+    streamed = True
+
+    def __init__(self, owner):
+        super().__init__(owner, 1)
+        self.chunks = []
+
+    def extend(self, index, chunk):
+        """Начало ответа шарда, пока конец еще не получен"""
+        self.chunks.append(chunk)
+
+    def fill(self, index, part):
+        self.chunks.append(part)
+        self.waiting -= 1
+
+    def take(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+class ScatteredReply(Reply):
+    """Ответ на чтение по шаблону из ответов всех count шардов, склеенных как concat.
+
+    Куски передаются клиенту по мере получения, по порядку шардов, но только
+    когда все шарды начали ответ с ok: ошибка любого шарда заменяет весь ответ.
+    """
+
+    __slots__ = ('finished', 'current', 'started')
+    streamed = True
+
+    def __init__(self, owner, count):
+        super().__init__(owner, count, concat)
+        self.parts = [bytearray() for _ in range(count)]
+        self.finished = [False] * count
+        # часть, которая сейчас передается клиенту
+        self.current = 0
+        # None - заголовки еще не получены, False - ответ с ошибкой, отправляется целиком
+        self.started = None
+
+    def extend(self, index, chunk):
+        self.parts[index] += chunk
+
+    def fill(self, index, part):
+        self.parts[index] += part
+        self.finished[index] = True
+        self.waiting -= 1
+
+    def take(self):
+        parts, out = self.parts, []
+        if self.started is None:
+            if any(len(part) >= len(OK) and not part.startswith(OK) for part in parts):
+                self.started = False
+            elif all(len(part) >= len(OK) for part in parts):
+                self.started = True
+                for part in parts:
+                    del part[:len(OK)]
+                out.append(OK)
+        if not self.started:
+            if self.started is None or self.waiting:
+                return out
+            return [self.merge([bytes(part) for part in parts])]
+
+        while self.current < len(parts):
+            part = parts[self.current]
+            if not self.finished[self.current]:
+                # конец части - пустая строка - еще не получен
+                if part:
+                    out.append(bytes(part))
+                    part.clear()
+                break
+            out.append(bytes(part[:-1]))
+            part.clear()
+            self.current += 1
+            if self.current == len(parts):
+                out.append(b'\n')
+        return out
+
+
+class ShardConnection(asyncio.Protocol):
+    """Соединение маршрутизатора с шардом, общее для всех его клиентов.
+
+    Команды копятся в _out и уходят одной записью в flush. Шард отвечает
+    по порядку, поэтому ответ n-й команды относится к n-му ожиданию в _waiting.
+    """
+
+    def __init__(self, closed):
+        self._closed = closed
+        self._buffer = bytearray()
+        # с этого места буфера продолжается поиск конца ответа
+        self._scanned = 0
+        # клиент, который не забирает ответы: чтение из шарда ждет его resume_writing
+        self._blocked = None
+        self._out = []
+        # (Reply, номер части) для каждой отправленной команды
+        self._waiting = deque()
+        # номера ключей в двоичном протоколе этого соединения
+        self._ids = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(binary.NEGOTIATE + b'\n')
+        self._waiting.append((None, 0))
+
+    def connection_lost(self, exc):
+        if not self._closed.done():
+            self._closed.set_result(exc)
+
+    def send_command(self, line, reply, index):
+        self._out.append(binary.FRAME_HEADER.pack(binary.TEXT, len(line)) + line)
+        self._waiting.append((reply, index))
+
+    def send_points(self, points, reply, index):
+        out, ids, records = self._out, self._ids, []
+        for key, value, timestamp in points:
+            key_id = ids.get(key)
+            if key_id is None:
+                key_id = ids[key] = len(ids)
+                name = key.encode()
+                out.append(binary.FRAME_HEADER.pack(binary.KEY, binary.KEY_ID.size + len(name))
+                           + binary.KEY_ID.pack(key_id) + name)
+            records.append(binary.RECORD.pack(key_id, timestamp, value))
+
+        data = b''.join(records)
+        out.append(binary.FRAME_HEADER.pack(binary.POINTS, len(data)) + data)
+        self._waiting.append((reply, index))
+
+    def flush(self):
+        if self._out:
+            self.transport.writelines(self._out)
+            self._out = []
+
+    def resume(self, owner):
+        """Продолжает чтение, если оно ждало клиента owner"""
+        if self._blocked is owner:
+            self._blocked = None
+            self.transport.resume_reading()
+
+    def data_received(self, data):
+        buffer = self._buffer
+        buffer += data
+
+        # ответ заканчивается пустой строкой, строки данных пустыми не бывают;
+        # уже просмотренное на прошлых пакетах не просматривается заново
+        owners, start = set(), 0
+        end = buffer.find(b'\n\n', self._scanned)
+        while end >= 0:
+            reply, index = self._waiting.popleft()
+            if reply is not None:
+                reply.fill(index, bytes(buffer[start:end + 2]))
+                owners.add(reply.owner)
+            start = end + 2
+            end = buffer.find(b'\n\n', start)
+
+        reply, index = self._waiting[0] if self._waiting else (None, 0)
+        if reply is not None and reply.streamed and len(buffer) - start > 1:
+            # последний байт может оказаться началом завершающей пустой строки
+            reply.extend(index, bytes(buffer[start:-1]))
+            owners.add(reply.owner)
+            start = len(buffer) - 1
+        del buffer[:start]
+        self._scanned = max(len(buffer) - 1, 0)
+
+        for owner in owners:
+            owner.write_replies()
+        if reply is not None and reply.owner.paused:
+            self._blocked = reply.owner
+            self.transport.pause_reading()
+
+
+class WatchRelay(asyncio.Protocol):
+    """Подписка watch клиента маршрутизатора в одном шарде.
+
+    Первое сообщение шарда - ответ на команду watch, часть index ответа reply;
+    следующие - точки, они передаются клиенту owner.
+    """
+
+    def __init__(self, owner, line, reply, index):
+        self.owner = owner
+        self.line = line
+        self.reply = reply
+        self.index = index
+        self.transport = None
+        self._buffer = bytearray()
+        self._answered = False
+
+    def connect(self, loop, host, port):
+        connecting = loop.create_task(loop.create_connection(lambda: self, host, port))
+        connecting.add_done_callback(self._connected)
+
+    def _connected(self, connecting):
+        if connecting.cancelled() or connecting.exception() is not None:
+            self.connection_lost(None)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.owner.transport.is_closing():
+            transport.close()
+            return
+        transport.write(self.line + b'\n')
+        if self.owner.paused:
+            transport.pause_reading()
+
+    def connection_lost(self, exc):
+        if self.owner.transport.is_closing():
+            return
+        if self._answered:
+            # подписка оборвалась: клиент узнает об этом по закрытому соединению
+            self.owner.transport.close()
+        else:
+            self._answer(WRONG)
+
+    def data_received(self, data):
+        buffer = self._buffer
+        buffer += data
+        end = buffer.rfind(b'\n\n')
+        if end < 0:
+            return
+        messages = bytes(buffer[:end + 2])
+        del buffer[:end + 2]
+
+        if not self._answered:
+            answer = messages.index(b'\n\n') + 2
+            self._answer(messages[:answer])
+            messages = messages[answer:]
+        if messages:
+            self.owner.push(messages)
+
+    def _answer(self, part):
+        self._answered = True
+        if part != SUCCESS:
+            self.owner.watch_failed = True
+        self.reply.fill(self.index, part)
+        self.owner.write_replies()
+
+    def pause(self):
+        if self.transport is not None:
+            self.transport.pause_reading()
+
+    def resume(self):
+        if self.transport is not None:
+            self.transport.resume_reading()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class RouterProtocol(asyncio.Protocol):
+    """Клиентское соединение маршрутизатора: тот же протокол, что у серверов"""
+
+    # ответов в ожидании, после которых соединение перестает читать команды
+    max_pending = 1024
+    # неполная команда длиннее этого - ошибка клиента, соединение закрывается
+    max_request = 16 * 1024 * 1024
+
+    def __init__(self, shards, addresses):
+        self.shards = shards
+        # адреса шардов для отдельных соединений подписок watch
+        self.addresses = addresses
+        self._buffer = bytearray()
+        self._replies = deque()
+        self._binary = False
+        self._keys = {}
+        self.paused = False
+        self._reading = True
+        # после команды watch: подписки в шардах и их сообщения, пришедшие раньше ответа на watch
+        self._relays = None
+        self._held = []
+        self.watch_failed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self._replies.clear()
+        self.paused = False
+        for shard in self.shards:
+            shard.resume(self)
+        for relay in self._relays or ():
+            relay.close()
+
+    def pause_writing(self):
+        self.paused = True
+        for relay in self._relays or ():
+            relay.pause()
+        self._update_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        for shard in self.shards:
+            shard.resume(self)
+        for relay in self._relays or ():
+            relay.resume()
+        self._update_reading()
+
+    def _update_reading(self):
+        reading = not self.paused and len(self._replies) < self.max_pending
+        if reading != self._reading and not self.transport.is_closing():
+            self._reading = reading
+            if reading:
+                self.transport.resume_reading()
+            else:
+                self.transport.pause_reading()
+
+    def data_received(self, data):
+        if self._relays is not None:
+            return
+        buffer = self._buffer
+        buffer += data
+
+        if not self._binary:
+            end = buffer.rfind(b'\n')
+            if end < 0:
+                if len(buffer) > self.max_request:
+                    self.transport.close()
+                return
+
+            lines = bytes(buffer[:end]).split(b'\n')
+            # после переключения на двоичный протокол или watch строки - уже не команды
+            negotiated = None
+            if binary.NEGOTIATE in lines or buffer.find(b'watch ', 0, end) >= 0:
+                negotiated = next((line for line in lines if line == binary.NEGOTIATE
+                                   or line[:6] == b'watch ' and len(line.split()) > 1), None)
+            if negotiated is not None:
+                lines = lines[:lines.index(negotiated)]
+                end = sum(len(line) + 1 for line in lines) + len(negotiated)
+            del buffer[:end + 1]
+
+            self._lines(lines)
+            if negotiated == binary.NEGOTIATE:
+                self._binary = True
+                self._replies.append(Reply.ready(self, SUCCESS))
+            elif negotiated is not None:
+                buffer.clear()
+                self._watch(negotiated)
+
+        if self._binary:
+            self._receive_frames()
+
+        for shard in self.shards:
+            shard.flush()
+        self.write_replies()
+
+    def _lines(self, lines):
+        # подряд идущие верные put уходят в шарды двоичными пачками, как mput
+        run = []
+        for line in lines:
+            parts = line.split()
+            if len(parts) == 4 and parts[0] == b'put':
+                point = parse_point(*parts[1:])
+                if point is not None:
+                    run.append(point)
+                    continue
+            if run:
+                self._points(run, answers=len(run))
+                run = []
+            self._command(line, parts)
+        if run:
+            self._points(run, answers=len(run))
+
+    def _receive_frames(self):
+        try:
+            frames = binary.frames(self._buffer)
+        except ValueError:
+            self.transport.close()
+            return
+
+        for kind, payload in frames:
+            if kind == binary.KEY:
+                # ошибка в объявлении проявится в пачке, которая ссылается на ключ
+                try:
+                    binary.declare(payload, self._keys)
+                except (ValueError, struct.error):
+                    pass
+            elif kind == binary.POINTS:
+                try:
+                    points = binary.points(payload, self._keys)
+                except (ValueError, KeyError):
+                    self._replies.append(Reply.ready(self, WRONG))
+                else:
+                    self._points(points)
+            elif kind == binary.TEXT:
+                self._command(payload, payload.split())
+            else:
+                self._replies.append(Reply.ready(self, WRONG))
+
+    def _command(self, line, parts):
+        if parts[:1] == [b'stats']:
+            # stats [on|off|reset]: отчет или переключение на всех шардах
+            merge = numbered if len(parts) == 1 else status
+            self._scatter(line, Reply(self, len(self.shards), merge))
+        elif len(parts) < 2:
+            self._replies.append(Reply.ready(self, WRONG))
+        elif parts[0] == b'mput':
+            self._mput(parts[1:])
+        elif parts[0] not in KEYED:
+            # команды без ключа (например, DATABASE у server.py) не маршрутизируются
+            self._replies.append(Reply.ready(self, WRONG))
+        elif parts[0] in SCATTERED and GLOB.search(parts[1]):
+            self._scatter(line, ScatteredReply(self, len(self.shards)))
+        else:
+            # неверный put тоже уходит в шард: ошибку дает сам сервер
+            reply = StreamedReply(self)
+            self.shards[shard_of(parts[1], len(self.shards))].send_command(line, reply, 0)
+            self._replies.append(reply)
+
+    def _watch(self, line):
+        """watch <pattern> ...: подписки в шардах, которые могут хранить такие ключи"""
+
+        patterns, count = line.split()[1:], len(self.shards)
+        if any(GLOB.search(pattern) for pattern in patterns):
+            numbers = range(count)
+        else:
+            numbers = sorted({shard_of(pattern, count) for pattern in patterns})
+
+        reply = Reply(self, len(numbers), status)
+        self._replies.append(reply)
+        self._relays = [WatchRelay(self, line, reply, index) for index in range(len(numbers))]
+        loop = asyncio.get_event_loop()
+        for relay, number in zip(self._relays, numbers):
+            relay.connect(loop, *self.addresses[number])
+
+    def push(self, message):
+        """Передает клиенту сообщение с точками подписки после ответа на watch"""
+        if self._replies:
+            self._held.append(message)
+        elif not self.transport.is_closing():
+            self.transport.write(message)
+
+    def _scatter(self, line, reply):
+        for index, shard in enumerate(self.shards):
+            shard.send_command(line, reply, index)
+        self._replies.append(reply)
+
+    def _mput(self, params):
+        # mput [atomic] <key> <value> <timestamp> ...
+        atomic = len(params) % 3 == 1 and params[0] == b'atomic'
+        if atomic:
+            params = params[1:]
+        if not params or len(params) % 3:
+            self._replies.append(Reply.ready(self, WRONG))
+            return
+
+        points = []
+        for index in range(0, len(params), 3):
+            point = parse_point(*params[index:index + 3])
+            if point is not None:
+                points.append(point)
+            elif atomic:
+                # точки проверены до рассылки, поэтому atomic действует на все шарды
+                self._replies.append(Reply.ready(self, WRONG))
+                return
+
+        # без atomic верные точки записываются, но клиент узнает об отброшенных
+        rejected = len(points) < len(params) // 3
+        self._points(points, merge=failed if rejected else status)
+
+    def _points(self, points, answers=1, merge=status):
+        """Рассылает точки (key, value, timestamp) по шардам.
+
+        answers - число команд, которым отвечает результат: пачке put
+        клиент ждет по ответу на каждую.
+        """
+
+        groups = {}
+        for point in points:
+            groups.setdefault(shard_of(point[0], len(self.shards)), []).append(point)
+
+        reply = Reply(self, len(groups), merge, answers)
+        if not groups:
+            reply.parts = [SUCCESS]
+        for index, (shard, group) in enumerate(groups.items()):
+            self.shards[shard].send_points(group, reply, index)
+        self._replies.append(reply)
+
+    def write_replies(self):
+        """Отправляет клиенту готовые ответы, сохраняя порядок команд"""
+
+        replies, out = self._replies, []
+        while replies:
+            out += replies[0].take()
+            if replies[0].waiting:
+                break
+            replies.popleft()
+        if not replies and self._held and not self.watch_failed:
+            out += self._held
+            self._held = []
+        if out and not self.transport.is_closing():
+            self.transport.writelines(out)
+        # неудавшаяся подписка: после ответа с ошибкой соединение закрывается
+        if self.watch_failed and not replies:
+            self.transport.close()
+        self._update_reading()
+
+
+async def connect_shards(loop, addresses, closed):
+    """Соединения со всеми шардами; шарды могут еще запускаться"""
+
+    shards = []
+    deadline = loop.time() + CONNECT_TIMEOUT
+    for host, port in addresses:
+        while True:
+            try:
+                _, shard = await loop.create_connection(
+                    lambda: ShardConnection(closed), host, port)
+                break
+            except OSError:
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        shards.append(shard)
+    return shards
+
+
+def route(host, port, addresses, reuse_port=False):
+    """Процесс маршрутизатора; завершается, если потеряно соединение с шардом"""
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    closed = loop.create_future()
+    shards = loop.run_until_complete(connect_shards(loop, addresses, closed))
+
+    coro = loop.create_server(lambda: RouterProtocol(shards, addresses), host, port,
+                              reuse_port=reuse_port)
+    server = loop.run_until_complete(coro)
+
+    try:
+        loop.run_until_complete(closed)
+    except KeyboardInterrupt:
+        pass
+
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+
+def serve_shard(server, host, port):
+    """Процесс шарда: run_server модуля server на своем порту"""
+
+    module = importlib.import_module(server)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    try:
+        module.run_server(host, port)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_cluster(server, host, port, workers, routers=None, shard_port=None):
+    """Запускает workers шардов модуля server и маршрутизаторы на host:port.
+
+    Шарды слушают 127.0.0.1 на портах shard_port, shard_port + 1, ...
+    (по умолчанию сразу за port). Без SO_REUSEPORT маршрутизатор один.
+    Если любой процесс завершился, останавливаются все.
+    """
+
+    shard_port = shard_port or port + 1
+    addresses = [('127.0.0.1', shard_port + number) for number in range(workers)]
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    if not reuse_port:
+        routers = 1
+    routers = routers or workers
+
+    processes = [multiprocessing.Process(target=serve_shard, args=(server, *address))
+                 for address in addresses]
+    processes += [multiprocessing.Process(target=route,
+                                          args=(host, port, addresses, reuse_port and routers > 1))
+                  for _ in range(routers)]
+
+    for process in processes:
+        process.start()
+    # SIGTERM останавливает и дочерние процессы, а не только этот
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        wait([process.sentinel for process in processes])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="metrics server sharded over processes")
+    parser.add_argument("--server", default="server_coursera",
+                        choices=("server_coursera", "server", "server_1"),
+                        help="модуль сервера, который запускается в каждом шарде")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="число шардов, по умолчанию - число ядер")
+    parser.add_argument("--routers", type=int,
+                        help="число процессов-маршрутизаторов, по умолчанию равно --workers")
+    parser.add_argument("--shard-port", type=int,
+                        help="первый порт шардов на 127.0.0.1, по умолчанию --port + 1")
+    args = parser.parse_args()
+    run_cluster(args.server, args.host, args.port, args.workers, args.routers, args.shard_port)
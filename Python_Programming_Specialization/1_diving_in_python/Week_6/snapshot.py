@@ -0,0 +1,167 @@
+"""
+Периодические двоичные снимки хранилища метрик.
+
+Хранилище копируется в цикле событий квантами по slice секунд (Storage.copy),
+а сериализуется и пишется на диск в потоке-исполнителе, так что цикл событий
+продолжает обслуживать клиентов. os.fork не используется: в процессе уже работают
+потоки журнала и исполнителей, и потомок мог бы зависнуть на блокировке, которую
+в момент fork держал один из них.
+
+Ключи, скопированные в следующих квантах, могут уже содержать put после поворота
+журнала. Это безопасно: повтор журнала поверх снимка запишет те же значения заново.
+
+При старте снимок читается одним mmap, без разбора текстовых строк журнала.
+
+Если голова хранилища переросла Storage.head_limit, тот же снимок запечатывает ее
+в новый файл сегмента: голова отделяется в момент снимка, исполнитель пишет ее
+в сегмент, а снимок ссылается на этот сегмент и содержит только новую голову.
+
+Файлы сегментов, выведенных уплотнением (retention.py), удаляются только после
+того, как на диске оказался снимок, который на них уже не ссылается.
+"""
+
+
+import asyncio
+import mmap
+import os
+from functools import partial
+
+from segment import segment_files, write_segment
+
+
+class Snapshotter:
+    """Снимки Storage в файл path каждые interval секунд.
+
+    Файлы сегментов лежат в каталоге directory, по умолчанию - рядом со снимком.
+    slice - длительность кванта копирования в цикле событий, секунды.
+    """
+
+    def __init__(self, path, interval=300, directory=None, slice=0.005):
+        self.path = path
+        self.interval = interval
+        self.directory = directory or os.path.dirname(os.path.abspath(path))
+        self.slice = slice
+
+        self._storage = None
+        self._wal = None
+        self._loop = None
+        self._timer = None
+        self._task = None
+        self._stopped = False
+
+    def load(self, storage):
+        """Загружает последний снимок в storage.
+
+        Возвращает первый сегмент журнала, который нужно повторить поверх снимка.
+        """
+
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            return 0
+
+        storage.segment_directory = self.directory
+        with open(self.path, 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            segment = storage.load(data, self.directory)
+
+        # сегменты, на которые снимок не ссылается, остались от прерванного снимка
+        # или уже заменены сжатыми копиями
+        used = {os.path.basename(path) for path in storage.segment_paths()}
+        for path in segment_files(self.directory):
+            if os.path.basename(path) not in used:
+                os.remove(path)
+
+        return segment
+
+    def start(self, storage, wal=None, loop=None):
+        self._storage = storage
+        self._wal = wal
+        self._loop = loop or asyncio.get_event_loop()
+        storage.on_full = self.request
+        storage.segment_directory = self.directory
+        self._schedule()
+
+    def request(self):
+        """Снимок вне расписания, например когда голова хранилища переполнилась"""
+
+        if self._task is None and not self._stopped:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._run()
+
+    async def take(self):
+        """Делает снимок, после него удаляет вошедшие в снимок сегменты журнала"""
+
+        storage = self._storage
+
+        # с этого момента put пишутся в новый сегмент журнала и в новую голову,
+        # а снимок и запечатанный сегмент содержат все, что было до этого
+        segment = self._wal.rotate() if self._wal is not None else 0
+        frozen = path = None
+        if storage.head_limit and storage.head_points >= storage.head_limit:
+            frozen = storage.freeze()
+            path = storage.new_segment_path()
+
+        names = [os.path.basename(name) for name in storage.segment_paths()]
+        if path is not None:
+            names.append(os.path.basename(path))
+
+        try:
+            copy = storage.copy(())
+            deadline = self._loop.time() + self.slice
+            for key in storage.snapshot_keys():
+                storage.copy((key,), copy)
+                if self._loop.time() >= deadline:
+                    await asyncio.sleep(0)
+                    deadline = self._loop.time() + self.slice
+
+            await self._loop.run_in_executor(
+                None, self._write_all, frozen, path,
+                partial(copy.dump, segment=segment, segments=names))
+        except BaseException:
+            if frozen is not None:
+                storage.thaw()
+            raise
+
+        if frozen is not None:
+            storage.attach(path)
+        # выведенные из хранилища сегменты больше не нужны, если снимок на них не ссылается
+        storage.remove_retired(keep=names)
+        if self._wal is not None:
+            self._wal.remove_before(segment)
+
+    async def stop(self):
+        self._stopped = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def _schedule(self):
+        self._timer = self._loop.call_later(self.interval, self._run)
+
+    def _run(self):
+        self._task = self._loop.create_task(self.take())
+        self._task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._task = None
+        if not self._stopped:
+            self._schedule()
+        task.result()
+
+    def _write_all(self, frozen, path, dump):
+        if frozen is not None:
+            write_segment(path, frozen)
+        self._write(dump)
+
+    def _write(self, dump):
+        """Пишет снимок во временный файл и атомарно заменяет им прежний"""
+
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as file:
+            dump(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
@@ -0,0 +1,182 @@
+"""
+Счетчики и гистограммы задержек сервера метрик.
+
+Команды считаются точно: сервер увеличивает счетчик вида команды там, где
+разбирает ее, - кроме put. Даже один счетчик на put стоит нескольких процентов
+его времени, поэтому put считаются целыми пакетами: это строки пакета, которые
+не посчитаны как другие команды (OTHER - неизвестные и неверные строки).
+
+Задержка измеряется только у каждой sample-й команды: ее ответ оборачивается
+генератором, который суммирует время формирования кусков ответа, без ожидания
+в очереди и медленного клиента.
+
+Гистограмма устроена как HdrHistogram: диапазоны по степеням двойки, каждый
+поделен на SUB равных частей, поэтому относительная ошибка перцентиля не больше
+1 / SUB при любом масштабе, от микросекунд до секунд.
+
+Команда stats протокола: "stats" - отчет строками "<имя> <значение> <метка>",
+как ответ get; "stats on", "stats off" - включить и выключить сбор, "stats reset" -
+обнулить накопленное.
+"""
+
+
+from time import perf_counter_ns, time
+
+
+# команды текстового протокола, которые считаются и измеряются
+TEXT_COMMANDS = ('put', 'mput', 'get', 'agg', 'latest', 'summary')
+# и точки из кадров P двоичного протокола
+COMMANDS = TEXT_COMMANDS + ('points',)
+# остальные строки: stats, неизвестные и неразборчивые команды - только счетчик
+OTHER = 'other'
+
+# вид измеряемой команды по первым четырем байтам ее строки
+PREFIXES = {command.encode()[:4].ljust(4): command for command in TEXT_COMMANDS}
+
+SUB_BITS = 5
+SUB = 1 << SUB_BITS
+
+PERCENTILES = (('p50', 50), ('p90', 90), ('p99', 99), ('p999', 99.9))
+
+
+class Histogram:
+    """Гистограмма целых неотрицательных значений (наносекунд)"""
+
+    __slots__ = ('counts', 'count', 'max')
+
+    def __init__(self):
+        # значения меньше 2 * SUB - каждое в своей ячейке, дальше по SUB ячеек на степень двойки
+        self.counts = [0] * (64 * SUB)
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        shift = value.bit_length() - SUB_BITS - 1
+        if shift > 0:
+            self.counts[(shift << SUB_BITS) + (value >> shift)] += 1
+        else:
+            self.counts[value] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Добавляет значения гистограммы other, например из другого процесса"""
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    @staticmethod
+    def _highest(index):
+        """Наибольшее значение, попадающее в ячейку index"""
+        if index < 2 * SUB:
+            return index
+        shift = (index >> SUB_BITS) - 1
+        return ((index - (shift << SUB_BITS) + 1) << shift) - 1
+
+    def percentile(self, percent):
+        """Значение, не меньше которого percent процентов записанных; 0 для пустой"""
+
+        if not self.count:
+            return 0
+        rank = max(1, round(self.count * percent / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._highest(index), self.max)
+        return self.max
+
+
+class Stats:
+    """Статистика сервера, общая для всех соединений.
+
+    sample - задержка измеряется у каждой sample-й команды.
+    """
+
+    def __init__(self, sample=256):
+        self.enabled = True
+        self.sample = sample
+        # число открытых соединений ведется и при выключенной статистике
+        self.connections = 0
+        self.reset()
+
+    def reset(self):
+        self.started = time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.counts = dict.fromkeys(COMMANDS + (OTHER,), 0)
+        self.latency = {kind: Histogram() for kind in COMMANDS}
+        # сколько команд пропустить до следующей измеряемой
+        self._skip = 0
+
+    def sampled(self, count=1):
+        """Номера измеряемых среди следующих count команд"""
+        first = self._skip
+        if first >= count:
+            self._skip -= count
+            return range(0)
+        numbers = range(first, count, self.sample)
+        self._skip = numbers[-1] + self.sample - count
+        return numbers
+
+    @staticmethod
+    def kind(command):
+        """Вид команды по ее строке (bytes) или None для неизмеряемых"""
+        return PREFIXES.get(bytes(command[:4]))
+
+    def timed(self, kind, answer):
+        """Ответ answer (итератор кусков), время формирования которого записывается"""
+        if kind is None:
+            return answer
+        return self._timed(self.latency[kind], answer)
+
+    @staticmethod
+    def _timed(histogram, answer):
+        elapsed = 0
+        while True:
+            began = perf_counter_ns()
+            piece = next(answer, None)
+            elapsed += perf_counter_ns() - began
+            if piece is None:
+                break
+            yield piece
+        histogram.record(elapsed)
+
+    def report(self):
+        """Пары (имя, значение) для ответа на stats"""
+
+        uptime = max(time() - self.started, 1e-9)
+        lines = [('stats.enabled', int(self.enabled)),
+                 ('stats.connections', self.connections),
+                 ('stats.uptime', round(uptime, 3)),
+                 ('stats.bytes_in', self.bytes_in),
+                 ('stats.bytes_out', self.bytes_out)]
+
+        for kind in COMMANDS:
+            histogram = self.latency[kind]
+            lines.append((f'stats.{kind}.count', self.counts[kind]))
+            lines.append((f'stats.{kind}.rate', round(self.counts[kind] / uptime, 3)))
+            lines.append((f'stats.{kind}.sampled', histogram.count))
+            # задержки в микросекундах
+            for name, percent in PERCENTILES:
+                lines.append((f'stats.{kind}.{name}_us', histogram.percentile(percent) / 1000))
+            lines.append((f'stats.{kind}.max_us', histogram.max / 1000))
+        lines.append((f'stats.{OTHER}.count', self.counts[OTHER]))
+        return lines
+
+    def command(self, params):
+        """Выполняет stats [on|off|reset]; отчет или None для ответа ok.
+
+        Неизвестный аргумент - ValueError.
+        """
+
+        if not params:
+            return self.report()
+        if len(params) == 1 and params[0] in ('on', 'off'):
+            self.enabled = params[0] == 'on'
+            return None
+        if len(params) == 1 and params[0] == 'reset':
+            self.reset()
+            return None
+        raise ValueError(f'unknown stats command {params!r}')
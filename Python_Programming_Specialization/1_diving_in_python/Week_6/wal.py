@@ -0,0 +1,178 @@
+"""
+Журнал упреждающей записи (write-ahead log) для серверов метрик.
+
+Каждый put дописывается в журнал строкой "key value timestamp".
+Строки копятся в памяти и сбрасываются на диск пачками (group commit):
+по истечении flush_interval секунд или при накоплении batch_size записей.
+write и fsync выполняются в отдельном потоке, цикл событий не блокируется.
+
+Журнал разбит на сегменты path.000001, path.000002, ...: каждый запуск сервера
+и каждый снимок хранилища начинают новый сегмент, а сегменты, целиком вошедшие
+в снимок, удаляются.
+"""
+
+
+import asyncio
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class WriteAheadLog:
+    """Журнал операций put с групповой фиксацией.
+
+    flush_interval=0 - синхронная запись и fsync на каждый put,
+    fsync=False - пачки только передаются ОС, без ожидания записи на диск.
+    """
+
+    def __init__(self, path, flush_interval=0.01, batch_size=1000, fsync=True):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+
+        self._file = None
+        self._loop = None
+        self._segment = 0
+        # один поток: записи, fsync и закрытие сегментов идут строго по очереди
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = bytearray()
+        self._count = 0
+        self._timer = None
+        # текущая пачка, которая пишется в потоке-исполнителе
+        self._flushing = None
+
+    @property
+    def segment(self):
+        """Номер сегмента, в который сейчас пишутся put"""
+        return self._segment
+
+    def segments(self):
+        """Номера сегментов журнала на диске по возрастанию"""
+        numbers = (name.rsplit('.', 1)[1] for name in glob.glob(glob.escape(self.path) + '.*'))
+        return sorted(int(number) for number in numbers if number.isdigit())
+
+    def replay(self, start=0):
+        """Записи (key, value, timestamp) из сегментов с номера start в порядке добавления.
+
+        Недописанная последняя строка сегмента (сбой посреди записи) отбрасывается.
+        """
+
+        for segment in self.segments():
+            if segment < start:
+                continue
+
+            with open(self._segment_path(segment), 'rb') as file:
+                data = file.read()
+
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                key, value, timestamp = line.decode().split()
+                yield key, float(value), int(timestamp)
+
+    def open(self, loop=None):
+        """Открывает для записи новый сегмент после всех существующих"""
+        self._loop = loop or asyncio.get_event_loop()
+        self._segment = max(self.segments(), default=0) + 1
+        self._file = open(self._segment_path(self._segment), 'ab')
+
+    def rotate(self):
+        """Начинает новый сегмент и возвращает его номер.
+
+        Все put до вызова попадают в предыдущие сегменты, все после - в новый.
+        Остаток старого сегмента дописывается и закрывается в потоке журнала.
+        """
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        old_file, data = self._file, self._take()
+        self._segment += 1
+        self._file = open(self._segment_path(self._segment), 'ab')
+
+        self._executor.submit(self._write, old_file, data)
+        self._executor.submit(old_file.close)
+        return self._segment
+
+    def remove_before(self, segment):
+        """Удаляет сегменты с номерами меньше segment"""
+        for number in self.segments():
+            if number < segment:
+                os.remove(self._segment_path(number))
+
+    def append(self, key, value, timestamp):
+        self._pending += f'{key} {value} {timestamp}\n'.encode()
+        self._count += 1
+        self._appended()
+
+    def append_many(self, points):
+        """Добавляет пачку записей (key, value, timestamp) разом"""
+        self._pending += ''.join(f'{key} {value} {timestamp}\n'
+                                 for key, value, timestamp in points).encode()
+        self._count += len(points)
+        self._appended()
+
+    def _appended(self):
+        if not self.flush_interval:
+            self._write(self._file, self._take())
+        elif self._count >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Отдает накопленную пачку потоку-исполнителю"""
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # пачки пишутся строго по одной, чтобы сохранить порядок записей;
+        # накопленное за время записи уйдет следующей пачкой из _flushed
+        if not self._pending or self._flushing is not None:
+            return
+
+        self._flushing = self._loop.run_in_executor(self._executor, self._write,
+                                                    self._file, self._take())
+        self._flushing.add_done_callback(self._flushed)
+
+    async def close(self):
+        """Дожидается записи всех пачек и закрывает файл журнала"""
+
+        # _flushing сбрасывает колбэк _flushed: если пачка уже записана,
+        # а колбэк еще не выполнен, циклу событий нужно дать ход
+        while self._flushing is not None:
+            if self._flushing.done():
+                await asyncio.sleep(0)
+            else:
+                await asyncio.shield(self._flushing)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._executor.shutdown()
+        if self._pending:
+            self._write(self._file, self._take())
+        self._file.close()
+
+    def _take(self):
+        data, self._pending, self._count = self._pending, bytearray(), 0
+        return data
+
+    def _segment_path(self, segment):
+        return f'{self.path}.{segment:06d}'
+
+    def _write(self, file, data):
+        file.write(data)
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+
+    def _flushed(self, future):
+        self._flushing = None
+        future.result()
+
+        if self._count >= self.batch_size:
+            self.flush()
+        elif self._pending and self._timer is None:
+            self._timer = self._loop.call_later(self.flush_interval, self.flush)
@@ -0,0 +1,157 @@
+"""
+Подписки на новые точки: команда watch.
+
+"watch <pattern> [<pattern> ...]" получает ответ "ok\\n\\n", после чего сервер
+сам присылает в это соединение точки, записанные под подходящими ключами
+(точный ключ, '*' или шаблон вроде cpu.host42.*), сообщениями в формате ответа
+get: "ok\\n<key> <value> <timestamp>\\n...\\n\\n". Больше команд соединение
+не принимает, подписка живет, пока оно открыто.
+
+Сервер передает записанные пачки в Watchers.publish. Подписчики ключа
+находятся один раз и запоминаются до изменения набора подписок, так что put
+ключа, за которым никто не следит, стоит поиска в словаре. Точки копятся
+в очереди подписчика и отправляются одним сообщением за итерацию цикла событий.
+
+Пока подписчик не успевает читать (транспорт вызвал pause_writing), очередь
+растет до max_queue точек. Переполненная очередь сжимается: от каждого ключа
+остается только самая новая точка - для алертов важно последнее значение.
+Если сжатие не освободило и половины очереди (ключей слишком много), новые
+точки отбрасываются до следующей отправки.
+Отброшенные и слитые точки видны в ответе stats.
+"""
+
+
+import asyncio
+
+from keyindex import matches
+
+
+class Subscriber:
+    """Подписка соединения с транспортом transport на ключи по шаблонам patterns"""
+
+    def __init__(self, patterns, transport, max_queue):
+        self.patterns = patterns
+        self.transport = transport
+        self.max_queue = max_queue
+        self.paused = False
+        # точки (key, value, timestamp), ждущие отправки
+        self._pending = []
+        # сжатие не освободило и половины очереди: до отправки новые точки отбрасываются
+        self._full = False
+        # отправленные, слитые при сжатии очереди и отброшенные точки
+        self.pushed = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def wants(self, key):
+        return any(matches(pattern, key) for pattern in self.patterns)
+
+    def push(self, point):
+        """Ставит точку в очередь или отбрасывает, если очередь полна"""
+
+        pending = self._pending
+        if len(pending) >= self.max_queue:
+            if not self._full:
+                self._coalesce()
+                # иначе при числе ключей около max_queue сжатие повторялось бы на каждой точке
+                self._full = len(pending) > self.max_queue // 2
+            if self._full:
+                self.dropped += 1
+                return
+        pending.append(point)
+
+    def _coalesce(self):
+        """Оставляет в очереди по одной, самой новой, точке каждого ключа"""
+
+        latest = {}
+        for point in self._pending:
+            previous = latest.get(point[0])
+            if previous is None or point[2] >= previous[2]:
+                latest[point[0]] = point
+        self.merged += len(self._pending) - len(latest)
+        self._pending[:] = sorted(latest.values(), key=lambda point: point[2])
+
+    def write(self):
+        """Отправляет накопленные точки одним сообщением, если клиент успевает читать"""
+
+        if self.paused or not self._pending or self.transport.is_closing():
+            return
+        pending, self._pending = self._pending, []
+        self._full = False
+        self.pushed += len(pending)
+        self.transport.write(('ok\n' + ''.join(f'{key} {value} {timestamp}\n'
+                                               for key, value, timestamp in pending)
+                              + '\n').encode())
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.write()
+
+
+class Watchers:
+    """Подписки всех соединений сервера.
+
+    max_queue - предел очереди неотправленных точек одного подписчика.
+    """
+
+    def __init__(self, max_queue=10000):
+        self.max_queue = max_queue
+        self.subscribers = set()
+        # ключ -> подписчики, которым он нужен; сбрасывается при изменении подписок
+        self._routes = {}
+        self._dirty = set()
+        self._loop = None
+        self._scheduled = False
+        # счетчики закрытых подписок
+        self._closed = {'pushed': 0, 'merged': 0, 'dropped': 0}
+
+    def subscribe(self, patterns, transport):
+        """Новая подписка: Subscriber, отписаться - unsubscribe"""
+
+        self._loop = asyncio.get_event_loop()
+        subscriber = Subscriber(tuple(patterns), transport, self.max_queue)
+        self.subscribers.add(subscriber)
+        self._routes.clear()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if subscriber not in self.subscribers:
+            return
+        for name in self._closed:
+            self._closed[name] += getattr(subscriber, name)
+        self.subscribers.discard(subscriber)
+        self._dirty.discard(subscriber)
+        self._routes.clear()
+
+    def publish(self, points):
+        """Раздает записанные точки (key, value, timestamp) подписчикам"""
+
+        routes, dirty = self._routes, self._dirty
+        for point in points:
+            subscribers = routes.get(point[0])
+            if subscribers is None:
+                subscribers = routes[point[0]] = tuple(
+                    subscriber for subscriber in self.subscribers if subscriber.wants(point[0]))
+            for subscriber in subscribers:
+                subscriber.push(point)
+                dirty.add(subscriber)
+
+        if dirty and not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._scheduled = False
+        dirty, self._dirty = self._dirty, set()
+        for subscriber in dirty:
+            subscriber.write()
+
+    def report(self):
+        """Пары (имя, значение) для ответа на stats"""
+
+        return [('watch.subscribers', len(self.subscribers))] + [
+            (f'watch.{name}', total + sum(getattr(subscriber, name) for subscriber in self.subscribers))
+            for name, total in self._closed.items()]